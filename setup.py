@@ -22,6 +22,10 @@ setup(
 		# 'Sphinx>=1.6.3',
 	],
 
+	# compact binary websocket encoding for clients which ask for it
+	extras_require={'msgpack': ['msgpack>=0.5'],
+					'fast': ['orjson']},
+
     package_data={
         '': [
 			'static/*.js',
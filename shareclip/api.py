@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+"""JSON API for scripts to post and read messages without a websocket.
+
+Routes, below `<prefix>/api`:
+
+	GET /slots            page of slots newest first, selected by `before` and `limit`
+	POST /slots           post `{"text": ..., "nickname": ...}`, or a list of them
+	POST /slots/delete    delete `{"uids": [...]}`
+	GET /slots/{uid}      a single slot
+	DELETE /slots/{uid}   delete a single slot
+	GET /export           all slots as newline delimited JSON, one slot per line
+	POST /import          add slots from newline delimited JSON, skipping known uids
+
+Posts and deletes are passed to the process owning the statefile as the same commands
+websocket clients send, so every client sees the change. Responses to reads carry an
+ETag naming the version of the state they were made from, and a request giving it back
+in If-None-Match gets an empty 304 response until something changes.
+
+Imported timestamps must be in UTC without a time zone. They are exported in
+`datetime.isoformat` form, which leaves out a zero fraction of a second."""
+
+import logging
+
+from aiohttp import web
+
+from shareclip import config
+from shareclip import server
+from shareclip.slot import pack_uid
+from shareclip.slot import decode_lines
+
+logger = logging.getLogger('api')
+
+
+def add_routes(app, prefix):
+	"""Add the API routes to `app` below `prefix`."""
+
+	app.router.add_get(prefix + '/slots', list_slots, name='api_slots')
+	app.router.add_post(prefix + '/slots', post_slots)
+	app.router.add_post(prefix + '/slots/delete', delete_slots)
+	app.router.add_get(prefix + '/slots/{uid}', get_slot, name='api_slot')
+	app.router.add_delete(prefix + '/slots/{uid}', delete_slot)
+	app.router.add_get(prefix + '/export', export_slots, name='api_export')
+	app.router.add_post(prefix + '/import', import_slots, name='api_import')
+
+
+def state_etag(statefile):
+	"""Return an entity tag changing whenever the slots of `statefile` may have.
+
+	Every change gets a new sequence number, and edits start a new epoch. Replicas
+	follow the epoch and sequence numbers of the owner so all processes give the same
+	tag for the same state."""
+
+	return '"{e}-{s}"'.format(e=statefile.epoch, s=statefile.seq)
+
+
+def not_modified(request, etag):
+	"""Test if `request` says it already holds the response tagged `etag`."""
+
+	header = request.headers.get('If-None-Match')
+	if header is None:
+		return False
+
+	tags = [tag.strip() for tag in header.split(',')]
+	return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def cached_response(request, data):
+	"""Return `data` as JSON tagged with the state version, or a 304 response if the
+	client already has it."""
+
+	etag = state_etag(request.app['statefile'])
+	headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+	if not_modified(request, etag):
+		return web.Response(status=304, headers=headers)
+
+	return web.json_response(data, headers=headers)
+
+
+async def read_json(request):
+	"""Return the decoded JSON body of `request`."""
+
+	try:
+		return await request.json()
+
+	except ValueError:
+		raise web.HTTPBadRequest(text='Body is not JSON')
+
+
+async def list_slots(request):
+	"""Return a page of slots and the cursor for the next page, or null."""
+
+	slots, more = server.query_page(request)
+	return cached_response(request, {'slots': [s.to_dict() for s in slots], 'more': more})
+
+
+async def get_slot(request):
+	"""Return a single slot."""
+
+	slot = request.app['statefile'].slots.get(pack_uid(request.match_info['uid']))
+	if slot is None:
+		raise web.HTTPNotFound(text='No such slot')
+
+	return cached_response(request, slot.to_dict())
+
+
+async def post_slots(request):
+	"""Post a message, or a list of them in order, returning the new slots.
+
+	Each is handled exactly as if posted by a websocket client, so URLs become links and
+	long messages are stored as blobs."""
+
+	body = await read_json(request)
+	posts = body if isinstance(body, list) else [body]
+	if len(posts) > config.API_BULK_LIMIT:
+		raise web.HTTPRequestEntityTooLarge(max_size=config.API_BULK_LIMIT,
+											actual_size=len(posts))
+
+	for post in posts:
+		if not isinstance(post, dict) or not isinstance(post.get('text'), str) or \
+		   not isinstance(post.get('nickname', ''), str):
+			raise web.HTTPBadRequest(text='Each post needs a text string and may have a '
+									 'nickname string')
+
+	slots = []
+	for post in posts:
+		slots.append(await server.add_slot(app=request.app,
+										   nickname=post.get('nickname', ''),
+										   text=post['text'],
+										   host=request.host))
+
+	logger.info('API posted {c} slots'.format(c=len(slots)))
+	if isinstance(body, list):
+		return web.json_response({'slots': slots}, status=201)
+
+	return web.json_response(slots[0], status=201)
+
+
+async def delete_slot(request):
+	"""Move a single slot to the undo queue."""
+
+	uid = request.match_info['uid']
+	if pack_uid(uid) not in request.app['statefile'].slots:
+		raise web.HTTPNotFound(text='No such slot')
+
+	await request.app['bus'].command({'type': 'delete', 'uid': uid})
+	return web.Response(status=204)
+
+
+async def delete_slots(request):
+	"""Move several slots to the undo queue as a single change, returning the uids
+	which were found."""
+
+	body = await read_json(request)
+	uids = body.get('uids') if isinstance(body, dict) else None
+	if not isinstance(uids, list) or not all(isinstance(uid, str) for uid in uids):
+		raise web.HTTPBadRequest(text='Give a list of uid strings as uids')
+
+	if len(uids) > config.API_BULK_LIMIT:
+		raise web.HTTPRequestEntityTooLarge(max_size=config.API_BULK_LIMIT,
+											actual_size=len(uids))
+
+	slots = request.app['statefile'].slots
+	found = [uid for uid in uids if pack_uid(uid) in slots]
+	if len(found) > 0:
+		await request.app['bus'].command({'type': 'delete_many', 'uids': found})
+
+	return web.json_response({'deleted': found})
+
+
+async def export_slots(request):
+	"""Stream all slots as newline delimited JSON.
+
+	Lines are sent a piece at a time as they are encoded so the whole export is never
+	held in memory."""
+
+	response = web.StreamResponse()
+	response.content_type = 'application/x-ndjson'
+	response.charset = 'utf-8'
+	await response.prepare(request)
+	pending = []
+	size = 0
+	for line in request.app['statefile'].export_lines():
+		pending.append(line)
+		size += len(line)
+		if size >= config.STREAM_CHUNK:
+			await response.write(''.join(pending).encode())
+			pending = []
+			size = 0
+
+	await response.write(''.join(pending).encode())
+	await response.write_eof()
+	return response
+
+
+async def import_slots(request):
+	"""Add slots from a newline delimited JSON body, skipping any uid already known.
+
+	The body is read and passed on `config.IMPORT_CHUNK` slots at a time, each as a
+	single command, and the resulting changes reach clients in batches as for any burst
+	of posts. A bad line stops the import there, leaving earlier chunks imported."""
+
+	received = 0
+	number = 1
+	lines = []
+	while True:
+		line = await request.content.readline()
+		if line:
+			lines.append(line)
+			if len(lines) < config.IMPORT_CHUNK:
+				continue
+
+		if len(lines) > 0:
+			try:
+				slots = decode_lines(lines, number)
+
+			except ValueError as exc:
+				raise web.HTTPBadRequest(text='{e}, {r} slots imported before it'.format(
+					e=exc, r=received))
+
+			await request.app['bus'].command({'type': 'import', 'slots': slots})
+			received += len(slots)
+			number += len(lines)
+			lines = []
+
+		if not line:
+			break
+
+	logger.info('API imported {r} slots'.format(r=received))
+	return web.json_response({'received': received})
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""Content-addressed store for large message bodies.
+
+Each body is a file named after the SHA-256 of its contents, so posting the same text
+twice stores it once. Bodies can be uploaded in chunks, which are appended to a
+partial file in an uploads directory and moved into place once complete. Nothing about
+an upload is held in memory, so worker processes sharing the directory can each take
+some of its chunks.
+
+Processes serving the same board must share the directory: a worker joining from another
+host needs it on a shared filesystem. Otherwise blobs uploaded through the worker cannot
+be served by the other processes, and are never removed since only the owner collects
+unused blobs."""
+
+import os
+import re
+import time
+import uuid
+import hashlib
+import logging
+
+from shareclip import config
+
+logger = logging.getLogger('blobs')
+
+# Form of digests and upload ids, which are used as filenames
+DIGEST = re.compile('^[0-9a-f]{64}$')
+UPLOAD = re.compile('^[0-9a-f]{32}$')
+# Subdirectories holding blobs, named after the first two digits of their digests
+SUBDIR = re.compile('^[0-9a-f]{2}$')
+
+# Bytes read at a time when hashing a finished upload
+READ_SIZE = 1 << 20
+
+
+class UploadError(Exception):
+	"""A chunk was refused, because the upload is unknown, out of order or too big."""
+
+
+class BlobStore():
+	"""Files named by digest under `directory`, with in-progress uploads beneath it."""
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.uploads_dir = directory.joinpath('uploads')
+
+	def init(self):
+		"""Create our directories if needed."""
+
+		if not self.uploads_dir.exists():
+			logger.info('Creating dir {d}'.format(d=self.uploads_dir))
+			self.uploads_dir.mkdir(parents=True, exist_ok=True)
+
+	def path(self, digest):
+		"""Return the filename holding blob `digest`."""
+
+		return self.directory.joinpath(digest[:2], digest[2:])
+
+	def exists(self, digest):
+		"""Test if blob `digest` is stored."""
+
+		return DIGEST.match(digest) is not None and self.path(digest).exists()
+
+	def put(self, data):
+		"""Store `data`, unless identical contents are already stored, and return the
+		digest."""
+
+		digest = hashlib.sha256(data).hexdigest()
+		if not self.exists(digest):
+			partial = self.uploads_dir.joinpath(uuid.uuid4().hex)
+			partial.write_bytes(data)
+			self.commit(partial, digest)
+
+		return digest
+
+	def read(self, digest, length):
+		"""Return up to the first `length` bytes of blob `digest`."""
+
+		with self.path(digest).open('rb') as handle:
+			return handle.read(length)
+
+	def partial(self, upload):
+		"""Return the file holding upload `upload` so far, which must exist."""
+
+		if UPLOAD.match(upload) is None or not self.uploads_dir.joinpath(upload).exists():
+			raise UploadError('Unknown upload {u}'.format(u=upload))
+
+		return self.uploads_dir.joinpath(upload)
+
+	def begin_upload(self):
+		"""Start a chunked upload and return its id."""
+
+		upload = uuid.uuid4().hex
+		self.uploads_dir.joinpath(upload).touch()
+		return upload
+
+	def append(self, upload, offset, data):
+		"""Add chunk `data`, which must start at `offset` bytes into the upload, and
+		return the size received so far.
+
+		A chunk repeating one already received is ignored so clients can safely retry."""
+
+		partial = self.partial(upload)
+		size = partial.stat().st_size
+		if offset + len(data) <= size:
+			return size
+
+		if offset != size:
+			raise UploadError('Chunk at {o} but {s} bytes received'.format(o=offset, s=size))
+
+		if size + len(data) > config.BLOB_MAX_SIZE:
+			partial.unlink()
+			raise UploadError('Upload larger than {m} bytes'.format(m=config.BLOB_MAX_SIZE))
+
+		with partial.open('ab') as handle:
+			handle.write(data)
+
+		return size + len(data)
+
+	def finish_upload(self, upload):
+		"""Move a completed upload into the store and return its digest and size."""
+
+		partial = self.partial(upload)
+		sha = hashlib.sha256()
+		size = 0
+		with partial.open('rb') as handle:
+			for block in iter(lambda: handle.read(READ_SIZE), b''):
+				sha.update(block)
+				size += len(block)
+
+		digest = sha.hexdigest()
+		if self.exists(digest):
+			partial.unlink()
+
+		else:
+			self.commit(partial, digest)
+
+		return digest, size
+
+	def commit(self, partial, digest):
+		"""Move finished file `partial` into place as blob `digest`."""
+
+		path = self.path(digest)
+		path.parent.mkdir(exist_ok=True)
+		os.replace(str(partial), str(path))
+
+	def collect(self, keep):
+		"""Delete blobs whose digests are not in `keep`, and uploads abandoned for
+		`config.UPLOAD_EXPIRY` seconds. Returns the number of blobs removed."""
+
+		# only files named as we name them are touched, in case of a wrong directory
+		removed = 0
+		for subdir in self.directory.iterdir():
+			if SUBDIR.fullmatch(subdir.name) is None or not subdir.is_dir():
+				continue
+
+			for path in subdir.iterdir():
+				digest = subdir.name + path.name
+				if DIGEST.fullmatch(digest) is not None and digest not in keep and path.is_file():
+					path.unlink()
+					removed += 1
+
+		expired = time.time() - config.UPLOAD_EXPIRY
+		for partial in self.uploads_dir.iterdir():
+			if UPLOAD.fullmatch(partial.name) is not None and partial.stat().st_mtime < expired:
+				partial.unlink()
+
+		if removed > 0:
+			logger.info('Removed {r} unused blobs'.format(r=removed))
+
+		return removed
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+"""Message bus connecting server processes which share a single Statefile.
+
+One process owns the Statefile and is the only one which changes it or writes to
+storage. Other worker processes, on the same host or others, serve their own clients
+from an in-memory replica. Workers pass client commands to the owner over the bus. The
+owner applies each one and publishes the resulting change message, which every worker
+applies to its replica and sends on to its clients.
+
+A bus provides:
+
+	`owner`: True in the process owning the Statefile
+	`start(statefile, execute, deliver, reset)`: Connect. `execute(command)` is a
+		coroutine run by the owner for each client command from any process.
+		`deliver(frame)` is a coroutine run by workers to send an encoded change to their
+		clients, once it has been applied to `statefile`. `reset()` is a coroutine run by
+		workers after `statefile` has been replaced by a fresh copy of the owner's state
+	`command(command)`: Pass a client command to the owner. Raises BusError if a worker
+		cannot pass it on
+	`publish(epoch, frame)`: Owner only. Send a change to all workers
+	`stop()`: Disconnect
+
+`LocalBus` serves a single process. `BrokerBus` works over any publish/subscribe broker
+offering the interface of `MemoryBroker`:
+
+	`connect(on_connect)`: Connect, running coroutine `on_connect()` after each
+		(re)connection once subscriptions are in place
+	`subscribe(channel, callback)`: Run coroutine `callback(data)` for each message
+		published to `channel`, in order
+	`publish(channel, data)`: Send text `data` to all subscribers of `channel`. Raises
+		BusError if it cannot be sent
+	`close()`: Disconnect
+
+`MemoryBroker` works within a single process and is used for testing. `SocketBroker`
+uses a hub in the owner process listening on a Unix socket, or a TCP port for workers
+on other hosts. A client for an external broker can be wrapped the same way.
+"""
+
+import json
+import uuid
+import asyncio
+import logging
+from pathlib import Path
+from collections import defaultdict
+
+from shareclip import config
+
+logger = logging.getLogger('bus')
+
+# Channel carrying client commands from workers to the owner, plus requests for state
+COMMANDS = 'commands'
+
+# Channel carrying changes, and full state for newly connected workers, from the owner
+CHANGES = 'changes'
+
+
+class BusError(Exception):
+	"""A message could not be passed on, as a worker is not connected to the owner."""
+
+
+class LocalBus():
+	"""Bus for a single server process which owns its Statefile."""
+
+	owner = True
+
+	def __init__(self):
+		self.execute = None
+
+	async def start(self, statefile, execute, deliver, reset):
+		"""Remember how to run commands."""
+
+		self.execute = execute
+
+	async def command(self, command):
+		"""Run `command` straight away."""
+
+		await self.execute(command)
+
+	async def publish(self, epoch, frame):
+		"""No other processes to tell."""
+
+		pass
+
+	async def stop(self):
+		"""Nothing to do."""
+
+		pass
+
+
+class BrokerBus():
+	"""Bus over a publish/subscribe `broker`, for the owner process if `owner` is set
+	otherwise for a worker."""
+
+	def __init__(self, broker, owner):
+		self.broker = broker
+		self.owner = owner
+		# identifies our requests for state
+		self.name = uuid.uuid4().hex
+		self.statefile = None
+		self.execute = None
+		self.deliver = None
+		self.reset = None
+		# set once a worker has a copy of the owner's state
+		self.synced = asyncio.Event()
+
+	async def start(self, statefile, execute, deliver, reset):
+		"""Connect to the broker. Workers wait until they have a copy of the owner's
+		state."""
+
+		self.statefile = statefile
+		self.execute = execute
+		self.deliver = deliver
+		self.reset = reset
+		if self.owner:
+			await self.broker.subscribe(COMMANDS, self.on_command)
+
+		else:
+			await self.broker.subscribe(CHANGES, self.on_change)
+
+		await self.broker.connect(self.on_connect)
+		if not self.owner:
+			await self.synced.wait()
+
+	async def on_connect(self):
+		"""Workers ask for a fresh copy of the state after every (re)connection, as changes
+		may have been missed."""
+
+		if not self.owner:
+			logger.info('Requesting state')
+			self.synced.clear()
+			await self.broker.publish(COMMANDS, json.dumps({'kind': 'sync', 'worker': self.name}))
+
+	async def on_command(self, data):
+		"""Owner handles a message from a worker."""
+
+		message = json.loads(data)
+		if message['kind'] == 'sync':
+			state = self.statefile.replica_state()
+			state['kind'] = 'state'
+			state['worker'] = message['worker']
+			logger.info('Sending {s} slots to worker {w}'.format(
+				s=len(state['slots']), w=message['worker']))
+			await self.broker.publish(CHANGES, json.dumps(state))
+
+		else:
+			await self.execute(message['command'])
+
+	async def on_change(self, data):
+		"""Worker handles a message from the owner."""
+
+		message = json.loads(data)
+		if message['kind'] == 'state':
+			if message['worker'] == self.name:
+				logger.info('Received {s} slots from owner'.format(s=len(message['slots'])))
+				self.statefile.load_replica(message)
+				self.synced.set()
+				await self.reset()
+
+		elif self.synced.is_set():
+			self.statefile.follow(message['epoch'], message['frame'])
+			await self.deliver(message['frame'])
+
+	async def command(self, command):
+		"""Run `command` here if we are the owner otherwise pass it on."""
+
+		if self.owner:
+			await self.execute(command)
+
+		else:
+			await self.broker.publish(COMMANDS, json.dumps({'kind': 'command',
+															'command': command}))
+
+	async def publish(self, epoch, frame):
+		"""Send a change to all workers."""
+
+		await self.broker.publish(CHANGES, json.dumps({'kind': 'change',
+													   'epoch': epoch,
+													   'frame': frame}))
+
+	async def stop(self):
+		"""Disconnect from the broker."""
+
+		await self.broker.close()
+
+
+class MemoryBroker():
+	"""Broker within a single process.
+
+	Messages are queued for each subscriber and delivered by a separate task, as they
+	would be by a real broker, so several BrokerBus objects sharing one MemoryBroker
+	behave like separate processes."""
+
+	def __init__(self):
+		# queues of messages waiting for delivery, by channel
+		self.subscribers = defaultdict(list)
+		self.tasks = []
+
+	async def connect(self, on_connect):
+		"""Nothing to connect to."""
+
+		await on_connect()
+
+	async def subscribe(self, channel, callback):
+		"""Start delivering messages on `channel` to `callback`."""
+
+		queue = asyncio.Queue()
+		self.subscribers[channel].append(queue)
+		self.tasks.append(asyncio.ensure_future(self.dispatch(queue, callback)))
+
+	async def dispatch(self, queue, callback):
+		"""Deliver messages from `queue` to `callback` one at a time."""
+
+		while True:
+			data = await queue.get()
+			try:
+				await callback(data)
+
+			except Exception:  # pylint: disable=broad-except
+				logger.exception('Failed to handle bus message')
+
+	async def publish(self, channel, data):
+		"""Queue `data` for all subscribers to `channel`."""
+
+		for queue in self.subscribers.get(channel, ()):
+			queue.put_nowait(data)
+
+	async def close(self):
+		"""Stop delivering messages."""
+
+		for task in self.tasks:
+			task.cancel()
+
+		self.tasks = []
+
+
+def parse_address(address):
+	"""Split a "host:port" TCP address, returning (host, port), or return None for a Unix
+	socket path."""
+
+	host, sep, port = str(address).rpartition(':')
+	if sep and port.isdigit():
+		return host, int(port)
+
+	return None
+
+
+class SocketBroker(MemoryBroker):
+	"""Broker over a Unix socket or TCP connection.
+
+	With `hub` set we listen on `address` and route messages between connections, as
+	well as to subscribers in this process. Otherwise we connect to the hub at `address`,
+	reconnecting if the connection is lost.
+
+	Each message is a line of JSON, either `{"subscribe": channel}` or `{"channel":
+	channel, "data": data}`. A connection which does not keep up with the messages sent
+	to it is dropped, so a stuck worker cannot hold up the owner; it will reconnect and
+	fetch a fresh copy of the state."""
+
+	def __init__(self, address, hub=False):
+		super().__init__()
+		self.address = address
+		self.hub = hub
+		# hub: channels subscribed to by each connected writer
+		self.connections = {}
+		# hub: tasks handling each connection
+		self.handlers = set()
+		# client: connection to the hub, or None while disconnected
+		self.writer = None
+		self.server = None
+
+	async def connect(self, on_connect):
+		"""Start listening if we are the hub, otherwise connect to the hub."""
+
+		if self.hub:
+			tcp = parse_address(self.address)
+			if tcp is None:
+				path = Path(self.address)
+				if path.exists():
+					path.unlink()
+
+				elif not path.parent.exists():
+					path.parent.mkdir(parents=True)
+
+				self.server = await asyncio.start_unix_server(
+					self.serve_connection, str(path), limit=config.BUS_LINE_LIMIT)
+
+			else:
+				self.server = await asyncio.start_server(
+					self.serve_connection, tcp[0], tcp[1], limit=config.BUS_LINE_LIMIT)
+
+			logger.info('Bus hub listening on {a}'.format(a=self.address))
+			await on_connect()
+
+		else:
+			connected = asyncio.Event()
+			self.tasks.append(asyncio.ensure_future(self.run_client(on_connect, connected)))
+			await connected.wait()
+
+	async def open_connection(self):
+		"""Open a connection to the hub."""
+
+		tcp = parse_address(self.address)
+		if tcp is None:
+			return await asyncio.open_unix_connection(str(self.address),
+													  limit=config.BUS_LINE_LIMIT)
+
+		return await asyncio.open_connection(tcp[0], tcp[1], limit=config.BUS_LINE_LIMIT)
+
+	async def run_client(self, on_connect, connected):
+		"""Keep a connection to the hub open, passing messages from it to our
+		subscribers."""
+
+		while True:
+			try:
+				reader, writer = await self.open_connection()
+
+			except OSError as exc:
+				logger.warning('Cannot connect to bus hub {a} ({exc}), retrying'.format(
+					a=self.address, exc=exc))
+				await asyncio.sleep(config.BUS_RETRY)
+				continue
+
+			logger.info('Connected to bus hub {a}'.format(a=self.address))
+			for channel in self.subscribers:
+				writer.write(encode_line({'subscribe': channel}))
+
+			self.writer = writer
+			try:
+				await on_connect()
+				connected.set()
+				while True:
+					line = await reader.readline()
+					if not line:
+						break
+
+					message = json.loads(line)
+					await super().publish(message['channel'], message['data'])
+
+			except (OSError, ValueError, BusError) as exc:
+				logger.warning('Bus connection failed ({exc})'.format(exc=exc))
+
+			logger.warning('Lost connection to bus hub {a}'.format(a=self.address))
+			self.writer = None
+			writer.close()
+			await asyncio.sleep(config.BUS_RETRY)
+
+	async def serve_connection(self, reader, writer):
+		"""Hub handles a connection from a client."""
+
+		self.connections[writer] = set()
+		self.handlers.add(asyncio.current_task())
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+
+				message = json.loads(line)
+				if 'subscribe' in message:
+					self.connections[writer].add(message['subscribe'])
+
+				else:
+					await self.publish(message['channel'], message['data'])
+
+		except (OSError, ValueError) as exc:
+			logger.warning('Bus connection failed ({exc})'.format(exc=exc))
+
+		self.connections.pop(writer, None)
+		self.handlers.discard(asyncio.current_task())
+		writer.close()
+
+	async def publish(self, channel, data):
+		"""Send `data` to all subscribers of `channel`."""
+
+		if not self.hub:
+			if self.writer is None:
+				raise BusError('Not connected to the server owning the messages')
+
+			try:
+				self.writer.write(encode_line({'channel': channel, 'data': data}))
+				await self.writer.drain()
+
+			except OSError as exc:
+				raise BusError('Lost connection to the server owning the messages '
+							   '({exc})'.format(exc=exc))
+
+			return
+
+		await super().publish(channel, data)
+		line = None
+		for writer, channels in list(self.connections.items()):
+			if channel in channels:
+				if line is None:
+					line = encode_line({'channel': channel, 'data': data})
+
+				writer.write(line)
+				if writer.transport.get_write_buffer_size() > config.BUS_BUFFER_LIMIT:
+					logger.warning('Bus client is not keeping up, disconnecting')
+					del self.connections[writer]
+					writer.transport.abort()
+
+	async def close(self):
+		"""Close all connections."""
+
+		await super().close()
+		if self.server is not None:
+			self.server.close()
+			self.server = None
+
+		for writer in list(self.connections):
+			writer.close()
+
+		# let connection handlers see the close and finish
+		if len(self.handlers) > 0:
+			await asyncio.wait(list(self.handlers), timeout=1.0)
+
+		if self.hub and parse_address(self.address) is None:
+			path = Path(self.address)
+			if path.exists():
+				path.unlink()
+
+		self.connections = {}
+		if self.writer is not None:
+			self.writer.close()
+			self.writer = None
+
+
+def encode_line(message):
+	"""Encode a message sent over a bus connection."""
+
+	return (json.dumps(message, separators=(',', ':')) + '\n').encode()
@@ -2,27 +2,830 @@
 
 """Command line shareclip client.
 
-Will allow posting from args, post from clipboard, copy to clipboard,
-delete, undo delete, shutdown, etc."""
+`Client` keeps a single connection to a server for the client options of the main
+command line, posting, deleting, undoing, and showing or watching messages:
 
+	shareclip --url http://localhost:8080 --post-lines notes.txt --tail 20 --watch
+
+Run as a module this is a load generator for the websocket protocol. It opens many
+clients, replays a mix of traffic and reports how quickly changes reach every client:
+
+	python3 -m shareclip.client --clients 200 --duration 30 --mix post=80,delete=15,undo=4,delete_all=1
+
+By default it spawns its own server with an empty statefile and reports its memory use.
+"""
+
+import os
+import sys
+import json
+import time
+import random
 import asyncio
+import logging
+import tempfile
+import argparse
+import itertools
+import subprocess
+from collections import deque
+from collections import Counter
+from collections import OrderedDict
 
 import aiohttp
-import async_timeout
+from yarl import URL
+
+from shareclip import config
+
+logger = logging.getLogger('client')
+
+# Traffic mix used if none is given, as relative weights
+DEFAULT_MIX = 'post=80,delete=15,undo=4,delete_all=1,helo=0'
+
+# Operations which can be replayed
+OPERATIONS = ('post', 'delete', 'undo', 'delete_all', 'helo')
 
 
 async def fetch(session, url):
 	"""Pull a single URL."""
-	with async_timeout.timeout(10):
-		async with session.get(url) as response:
-			return await response.text()
+	async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+		return await response.text()
 
 
-async def main():
-	"""Command line entry point."""
-	async with aiohttp.ClientSession() as session:
-		html = await fetch(session, 'http://localhost:8080')
-		print(html)
+def parse_mix(mix):
+	"""Convert "post=80,delete=20" to a dict of weights by operation."""
+	weights = {}
+	for item in mix.split(','):
+		name, _, weight = item.partition('=')
+		if name not in OPERATIONS:
+			raise ValueError('Unknown operation {n}'.format(n=name))
+
+		weights[name] = float(weight)
+
+	return weights
+
+
+def percentile(values, fraction):
+	"""Return the value `fraction` of the way through sorted `values`."""
+	if len(values) == 0:
+		return float('nan')
+
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def process_rss(pid):
+	"""Return resident memory in bytes of process `pid` and all its children."""
+	total = 0
+	try:
+		with open('/proc/{p}/status'.format(p=pid)) as handle:
+			for line in handle:
+				if line.startswith('VmRSS:'):
+					total += int(line.split()[1]) * 1024
+
+		with open('/proc/{p}/task/{p}/children'.format(p=pid)) as handle:
+			for child in handle.read().split():
+				total += process_rss(int(child))
+
+	except OSError:
+		pass
+
+	return total
+
+
+def spawn_server(port, workers, directory):
+	"""Start a server with a new statefile in `directory`."""
+	env = dict(os.environ, XDG_DATA_HOME=directory)
+	log = open(os.path.join(directory, 'server.log'), 'w')
+	return subprocess.Popen([sys.executable, '-m', 'shareclip.main',
+							 '--serve',
+							 '--port', str(port),
+							 '--workers', str(workers),
+							 '--statefile', os.path.join(directory, 'state')],
+							env=env,
+							stdout=log,
+							stderr=subprocess.STDOUT)
+
+
+async def wait_for_server(session, url, timeout):
+	"""Wait until the server at `url` answers."""
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			await fetch(session, url + '/info')
+			return
+
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			if time.monotonic() > deadline:
+				raise
+
+			await asyncio.sleep(0.1)
+
+
+class Client():
+	"""Persistent connection to a server for the command line client options.
+
+	Posts, deletes and page requests go over a single websocket, each sent without
+	waiting for those before it. Each carries a `ref` which the server returns in an
+	`ack` once it has been handled, and up to `config.CLIENT_PIPELINE` may be waiting for
+	theirs at once. Undo and messages too large for a websocket message are sent as HTTP
+	requests over the same keep-alive session.
+
+	Changes to the board arrive over the socket and are passed to `on_change`. If the
+	connection drops the client reconnects giving the epoch and seq of the last change it
+	saw, so only later changes are sent, then sends again any requests not yet
+	acknowledged. A request whose ack was lost with the connection is made twice.
+
+	A server which falls behind sending to us may replace what it had queued with a
+	snapshot, losing acks and page replies, so waits for them give up with
+	asyncio.TimeoutError after `config.CLIENT_TIMEOUT` seconds."""
+
+	def __init__(self, session, url, nickname='', on_change=None):
+		self.session = session
+		self.url = url.rstrip('/')
+		self.nickname = nickname
+		self.on_change = on_change
+		self.ws = None
+		self.receiver = None
+		self.closing = False
+		# epoch and seq of the last change seen
+		self.epoch = None
+		self.seq = None
+		# requests not yet acknowledged by ref, in the order sent
+		self.unacked = OrderedDict()
+		self.refs = itertools.count(1)
+		self.window = asyncio.Semaphore(config.CLIENT_PIPELINE)
+		self.idle = asyncio.Event()
+		self.idle.set()
+		# held while sending so requests go out in order, and resends before new ones
+		self.lock = asyncio.Lock()
+		# futures waiting for replies to page requests, in the order asked
+		self.pages = deque()
+
+	async def connect(self):
+		"""Open the websocket, resuming from the last change seen if there was one."""
+
+		ws = await self.session.ws_connect(self.url + '/ws')
+		helo = {'type': 'helo'}
+		if self.epoch is not None:
+			helo['epoch'] = self.epoch
+			helo['seq'] = self.seq
+
+		async with self.lock:
+			self.ws = ws
+			await ws.send_str(json.dumps(helo))
+			for message in list(self.unacked.values()):
+				await ws.send_str(json.dumps(message))
+
+		self.receiver = asyncio.ensure_future(self.receive(ws))
+
+	async def reconnect(self):
+		"""Connect again after losing the server, retrying until it answers."""
+
+		self.ws = None
+		while not self.closing:
+			await asyncio.sleep(config.CLIENT_RETRY)
+			logger.info('Reconnecting to {u}'.format(u=self.url))
+			try:
+				await self.connect()
+				return
+
+			except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as exc:
+				logger.warning('Cannot reconnect: {e}'.format(e=exc))
+
+	async def receive(self, ws):
+		"""Handle messages from the server until the socket closes."""
+
+		async for msg in ws:
+			if msg.type != aiohttp.WSMsgType.TEXT:
+				break
+
+			message = json.loads(msg.data)
+			if message['type'] == 'batch':
+				for change in message['messages']:
+					self.change(change)
+
+			else:
+				self.dispatch(message)
+
+		if not self.closing:
+			logger.warning('Lost connection to {u}'.format(u=self.url))
+			await self.reconnect()
+
+	def dispatch(self, message):
+		"""Handle a single message from the server."""
+
+		kind = message['type']
+		if kind in ('ack', 'error'):
+			# a refused request is done with too, it will not succeed if sent again
+			if kind == 'error':
+				logger.error('Server refused a request: {m}'.format(m=message['message']))
+
+			request = self.unacked.pop(message.get('ref'), None)
+			if request is not None:
+				# page replies come in the order asked, so this is the one waiting now
+				if kind == 'error' and request['type'] == 'page':
+					page = self.next_page()
+					if page is not None:
+						page.set_exception(aiohttp.ClientError(message['message']))
+
+				self.window.release()
+				if len(self.unacked) == 0:
+					self.idle.set()
+
+		elif kind == 'snapshot':
+			if self.epoch is not None:
+				logger.warning('Changes missed while disconnected are not shown')
+
+			self.epoch = message['epoch']
+			self.seq = message['seq']
+
+		elif kind == 'page':
+			page = self.next_page()
+			if page is not None:
+				page.set_result(message)
+
+		elif 'seq' in message:
+			self.change(message)
+
+	def next_page(self):
+		"""Return the future waiting for the next page reply, skipping any we gave up
+		waiting for, or None if there is none."""
+
+		while len(self.pages) > 0:
+			page = self.pages.popleft()
+			if not page.done():
+				return page
+
+		return None
+
+	def change(self, message):
+		"""Note a change to the board and pass it on, unless it was seen already."""
+
+		# a change made while a snapshot was on its way may also arrive after it
+		if self.seq is not None and message['seq'] <= self.seq:
+			return
+
+		self.seq = message['seq']
+		if self.on_change is not None:
+			self.on_change(message)
+
+	async def request(self, message):
+		"""Send `message` with a new ref, waiting first if too many are unacknowledged."""
+
+		await asyncio.wait_for(self.window.acquire(), config.CLIENT_TIMEOUT)
+		message['ref'] = next(self.refs)
+		async with self.lock:
+			self.unacked[message['ref']] = message
+			self.idle.clear()
+			if self.ws is not None:
+				try:
+					await self.ws.send_str(json.dumps(message))
+
+				except (ConnectionError, aiohttp.ClientError):
+					# sent again once we reconnect
+					pass
+
+	async def drain(self):
+		"""Wait until every request sent has been acknowledged."""
+
+		await asyncio.wait_for(self.idle.wait(), config.CLIENT_TIMEOUT)
+
+	async def post(self, text):
+		"""Post a message."""
+
+		if len(text) > config.UPLOAD_CHUNK:
+			await self.drain()
+			await self.upload(text)
+
+		else:
+			await self.request({'type': 'post', 'nickname': self.nickname, 'message': text})
+
+	async def upload(self, text):
+		"""Post a large message as a chunked upload."""
+
+		data = text.encode()
+		async with self.session.post(self.url + '/upload') as response:
+			response.raise_for_status()
+			upload = await response.json()
+
+		url = str(URL(self.url).join(URL(upload['url'])))
+		for offset in range(0, len(data), upload['chunk']):
+			async with self.session.put(url,
+										params={'offset': offset},
+										data=data[offset:offset + upload['chunk']]) as response:
+				response.raise_for_status()
+
+		async with self.session.post(url, data={'nickname': self.nickname}) as response:
+			response.raise_for_status()
+
+	async def delete(self, uid):
+		"""Move a slot to the undo queue."""
+
+		await self.request({'type': 'delete', 'uid': uid})
+
+	async def undo(self):
+		"""Restore the most recently deleted slot, once earlier requests are done."""
+
+		await self.drain()
+		async with self.session.get(self.url + '/undo') as response:
+			response.raise_for_status()
+
+	async def latest(self, count):
+		"""Return the newest `count` slots, newest first, once earlier requests are done,
+		and the seq of the last change they include."""
+
+		slots = []
+		seq = None
+		more = None
+		while len(slots) < count:
+			page = asyncio.get_event_loop().create_future()
+			self.pages.append(page)
+			await self.request({'type': 'page', 'before': more})
+			reply = await asyncio.wait_for(page, config.CLIENT_TIMEOUT)
+			if seq is None:
+				seq = reply['at_seq']
+
+			slots.extend(reply['slots'][:count - len(slots)])
+			more = reply['more']
+			if more is None:
+				break
+
+		return slots, seq
+
+	async def close(self):
+		"""Disconnect from the server."""
+
+		self.closing = True
+		if self.ws is not None:
+			await self.ws.close()
+
+		if self.receiver is not None:
+			await self.receiver
+
+
+def format_slot(slot):
+	"""Return a line showing `slot`."""
+
+	text = slot['text'] if slot['clipboard'] is None else slot['clipboard']
+	if 'blob' in slot:
+		text += '... ({s} bytes)'.format(s=slot['size'])
+
+	return '{t} {u} {n}: {x}'.format(t=slot['timestamp'],
+									 u=slot['uid'],
+									 n=slot['nickname'] or '-',
+									 x=text)
+
+
+def show_change(message):
+	"""Print a change to the board."""
+
+	kind = message['type']
+	if kind == 'new_slot':
+		print(format_slot(message), flush=True)
+
+	elif kind == 'delete_slot':
+		print('Deleted {u}'.format(u=message['uid']), flush=True)
+
+	elif kind == 'delete_many':
+		print('Deleted {c} messages'.format(c=len(message['uids'])), flush=True)
+
+
+class Watcher():
+	"""Print changes to the board as they arrive, holding them back until `start` so
+	they follow anything printed before."""
+
+	def __init__(self):
+		self.held = []
+		# changes up to this seq are not printed, and all are held while it is None
+		self.seq = None
+
+	def __call__(self, message):
+		if self.seq is None:
+			self.held.append(message)
+
+		elif message['seq'] > self.seq:
+			show_change(message)
+
+	def start(self, seq):
+		"""Print held changes after `seq`, then print changes as they arrive."""
+
+		self.seq = seq
+		for message in self.held:
+			self(message)
+
+		self.held = []
+
+
+async def read_lines(handle):
+	"""Yield the lines of binary file `handle` as they arrive, reading in another thread
+	so the event loop keeps running."""
 
 	loop = asyncio.get_event_loop()
-	loop.run_until_complete(main())
+	partial = b''
+	while True:
+		data = await loop.run_in_executor(None, handle.read1, config.STREAM_CHUNK)
+		if len(data) == 0:
+			break
+
+		lines = (partial + data).split(b'\n')
+		partial = lines.pop()
+		for line in lines:
+			yield line.decode(errors='replace')
+
+	if len(partial) > 0:
+		yield partial.decode(errors='replace')
+
+
+async def run_commands(url, nickname, posts=(), paste=False, lines_file=None, deletes=(),
+					   undo=False, tail=None, watch=False):
+	"""Connect to the server at `url` and carry out the client options in order: post
+	each of `posts`, standard input if `paste`, and each line of `lines_file` ('-' for
+	standard input), delete `deletes`, undo, show the newest `tail` messages, and finally
+	print changes as they happen if `watch`, until interrupted."""
+
+	watcher = Watcher() if watch else None
+	async with aiohttp.ClientSession() as session:
+		client = Client(session, url, nickname, on_change=watcher)
+		await client.connect()
+		try:
+			for text in posts:
+				await client.post(text)
+
+			if paste:
+				text = await asyncio.get_event_loop().run_in_executor(None, sys.stdin.read)
+				if len(text.strip()) > 0:
+					await client.post(text.rstrip('\n'))
+
+			if lines_file is not None:
+				handle = sys.stdin.buffer if lines_file == '-' else open(lines_file, 'rb')
+				count = 0
+				try:
+					async for line in read_lines(handle):
+						line = line.rstrip('\r')
+						if len(line.strip()) > 0:
+							await client.post(line)
+							count += 1
+
+				finally:
+					if handle is not sys.stdin.buffer:
+						handle.close()
+
+				logger.info('Sent {c} posts'.format(c=count))
+
+			for uid in deletes:
+				await client.delete(uid)
+
+			if undo:
+				await client.undo()
+
+			# changes after those shown by tail are watched, or all since connecting
+			seq = 0
+			if tail is not None:
+				slots, seq = await client.latest(tail)
+				for slot in reversed(slots):
+					print(format_slot(slot))
+
+			await client.drain()
+			if watch:
+				sys.stdout.flush()
+				watcher.start(seq)
+				await asyncio.Event().wait()
+
+		finally:
+			await client.close()
+
+
+def run_client(url, nickname, **kwargs):
+	"""Run the client options as for `run_commands`. Returns False if the server could
+	not be reached or refused a request."""
+
+	try:
+		asyncio.run(run_commands(url, nickname, **kwargs))
+
+	except aiohttp.ClientError as exc:
+		logger.error('Cannot talk to {u}: {e}'.format(u=url, e=exc))
+		return False
+
+	except asyncio.TimeoutError:
+		logger.error('No answer from {u}'.format(u=url))
+		return False
+
+	except KeyboardInterrupt:
+		pass
+
+	return True
+
+
+class LoadTest():
+	"""Drive a server with many websocket clients and measure change fan-out.
+
+	Each operation sent is matched to the change message it causes: posts by their
+	unique text, single deletes by uid, and undos and delete alls in order, with at most
+	one of each outstanding. The latency from sending an operation to each client
+	receiving its change is recorded."""
+
+	def __init__(self, session, url, clients, weights, rate, size):
+		self.session = session
+		self.url = url
+		self.client_count = clients
+		self.weights = weights
+		self.rate = rate
+		self.size = size
+		self.clients = [None] * clients
+		# epoch and seq of the last change seen by each client
+		self.positions = [None] * clients
+		self.tasks = []
+		# send times of changes not yet seen by every client, by match key
+		self.pending = {}
+		# number of clients yet to see each pending change
+		self.waiting = {}
+		# send times of outstanding undos and delete alls
+		self.queued = {'undo': deque(), 'delete_all': deque()}
+		# latency of every client receiving every change, and of the slowest client
+		self.latencies = []
+		self.fanouts = []
+		self.helo_latencies = []
+		# slots and undo queue length as seen by the first client
+		self.live = set()
+		self.undoable = 0
+		self.sent = Counter()
+		self.received = 0
+		self.posted = 0
+
+	async def connect(self, index):
+		"""Open client `index`, wait for its initial snapshot and start receiving."""
+
+		start = time.perf_counter()
+		ws = await self.session.ws_connect(self.url + '/ws')
+		await ws.send_str(json.dumps({'type': 'helo'}))
+		snapshot = await ws.receive_json()
+		self.helo_latencies.append(time.perf_counter() - start)
+		self.positions[index] = (snapshot['epoch'], snapshot['seq'])
+		if index == 0:
+			self.live = set(slot['uid'] for slot in snapshot['slots'])
+
+		self.clients[index] = ws
+		self.tasks.append(asyncio.ensure_future(self.receive(index, ws)))
+
+	async def reconnect(self, index):
+		"""Close client `index` and connect it again, resuming from the last change it
+		saw so changes sent meanwhile arrive as a batch."""
+
+		ws = self.clients[index]
+		self.clients[index] = None
+		await ws.close()
+		ws = await self.session.ws_connect(self.url + '/ws')
+		epoch, seq = self.positions[index]
+		await ws.send_str(json.dumps({'type': 'helo', 'epoch': epoch, 'seq': seq}))
+		self.clients[index] = ws
+		self.tasks.append(asyncio.ensure_future(self.receive(index, ws)))
+
+	async def receive(self, index, ws):
+		"""Record arrival of messages at client `index`."""
+
+		async for msg in ws:
+			if msg.type != aiohttp.WSMsgType.TEXT:
+				break
+
+			now = time.perf_counter()
+			self.received += 1
+			message = json.loads(msg.data)
+			if message['type'] == 'snapshot':
+				# resync failed, changes missed meanwhile will not arrive
+				self.positions[index] = (message['epoch'], message['seq'])
+				continue
+
+			for change in message.get('messages', [message]):
+				self.positions[index] = (self.positions[index][0], change['seq'])
+				key = self.match(change, index)
+				if key is not None:
+					self.arrived(key, now)
+
+	def match(self, change, index):
+		"""Return the key of the pending operation which caused `change`."""
+
+		kind = change['type']
+		if kind == 'new_slot':
+			key = ('post', change['text'])
+			if key not in self.pending:
+				key = ('undo', change['uid'])
+				if index == 0:
+					self.undoable -= 1
+
+			if index == 0:
+				self.live.add(change['uid'])
+
+		elif kind == 'delete_slot':
+			key = ('delete', change['uid'])
+			if index == 0:
+				self.live.discard(change['uid'])
+				self.undoable = min(self.undoable + 1, config.UNDO_QUEUE_LENGTH)
+
+		elif kind == 'delete_many':
+			key = ('delete_all', change['seq'])
+			if index == 0:
+				self.live.difference_update(change['uids'])
+				self.undoable = min(self.undoable + len(change['uids']), config.UNDO_QUEUE_LENGTH)
+
+		else:
+			return None
+
+		# the first client to see an undo or delete all claims the oldest one sent
+		queue = self.queued.get(key[0])
+		if queue is not None and key not in self.pending and len(queue) > 0:
+			self.pending[key] = queue.popleft()
+			self.waiting[key] = self.client_count
+
+		return key
+
+	def arrived(self, key, now):
+		"""Record a client receiving the change for `key`."""
+
+		sent = self.pending.get(key)
+		if sent is None:
+			return
+
+		self.latencies.append(now - sent)
+		self.waiting[key] -= 1
+		if self.waiting[key] == 0:
+			self.fanouts.append(now - sent)
+			del self.pending[key]
+			del self.waiting[key]
+
+	def choose(self):
+		"""Pick the next operation, falling back to a post if it would have no effect."""
+
+		op = random.choices(list(self.weights), weights=list(self.weights.values()))[0]
+		if op in ('delete', 'delete_all') and len(self.live) == 0:
+			return 'post'
+
+		if op in self.queued and len(self.queued[op]) > 0:
+			return 'post'
+
+		if op == 'undo' and self.undoable <= 0:
+			return 'post'
+
+		return op
+
+	async def send(self, op):
+		"""Send one operation from a random client."""
+
+		index = random.randrange(self.client_count)
+		ws = self.clients[index]
+		if ws is None:
+			return
+
+		self.sent[op] += 1
+		now = time.perf_counter()
+		if op == 'post':
+			self.posted += 1
+			text = 'load {n:08d} '.format(n=self.posted).ljust(self.size, 'x')
+			self.pending[('post', text)] = now
+			self.waiting[('post', text)] = self.client_count
+			await ws.send_str(json.dumps({'type': 'post', 'nickname': 'load', 'message': text}))
+
+		elif op == 'delete':
+			uid = random.choice(tuple(self.live))
+			self.pending[('delete', uid)] = now
+			self.waiting[('delete', uid)] = self.client_count
+			await ws.send_str(json.dumps({'type': 'delete', 'uid': uid}))
+
+		elif op == 'delete_all':
+			self.queued[op].append(now)
+			await ws.send_str(json.dumps({'type': 'delete_all'}))
+
+		elif op == 'undo':
+			self.queued[op].append(now)
+			await fetch(self.session, self.url + '/undo')
+
+		elif op == 'helo':
+			if index > 0:
+				await self.reconnect(index)
+
+	async def run(self, duration):
+		"""Connect all clients then send operations for `duration` seconds."""
+
+		await asyncio.gather(*(self.connect(i) for i in range(self.client_count)))
+		start = time.perf_counter()
+		self.received = 0
+		count = 0
+		while time.perf_counter() - start < duration:
+			await self.send(self.choose())
+			count += 1
+			if self.rate > 0:
+				delay = start + count / self.rate - time.perf_counter()
+				if delay > 0:
+					await asyncio.sleep(delay)
+
+			else:
+				await asyncio.sleep(0)
+
+		# allow stragglers to arrive
+		deadline = time.perf_counter() + 5.0
+		while len(self.pending) > 0 and time.perf_counter() < deadline:
+			await asyncio.sleep(0.05)
+
+		elapsed = time.perf_counter() - start
+		for ws in self.clients:
+			if ws is not None:
+				await ws.close()
+
+		for task in self.tasks:
+			task.cancel()
+
+		return elapsed
+
+	def report(self, elapsed):
+		"""Print results."""
+
+		ms = 1000.0
+		self.latencies.sort()
+		self.fanouts.sort()
+		self.helo_latencies.sort()
+		print('Clients: {c}  elapsed: {t:.1f}s'.format(c=self.client_count, t=elapsed))
+		print('Sent {s} operations ({r:.1f}/s): {ops}'.format(
+			s=sum(self.sent.values()),
+			r=sum(self.sent.values()) / elapsed,
+			ops=', '.join('{k} {v}'.format(k=k, v=v) for k, v in sorted(self.sent.items()))))
+		print('Received {m} messages ({r:.1f}/s)'.format(m=self.received, r=self.received / elapsed))
+		print('Per client latency   p50 {p50:.2f}ms  p99 {p99:.2f}ms'.format(
+			p50=percentile(self.latencies, 0.5) * ms, p99=percentile(self.latencies, 0.99) * ms))
+		print('Fan-out to all       p50 {p50:.2f}ms  p99 {p99:.2f}ms'.format(
+			p50=percentile(self.fanouts, 0.5) * ms, p99=percentile(self.fanouts, 0.99) * ms))
+		print('helo to snapshot     p50 {p50:.2f}ms  p99 {p99:.2f}ms'.format(
+			p50=percentile(self.helo_latencies, 0.5) * ms,
+			p99=percentile(self.helo_latencies, 0.99) * ms))
+		if len(self.pending) > 0:
+			print('{n} changes did not reach every client'.format(n=len(self.pending)))
+
+
+async def run_load(args):
+	"""Optionally spawn a server, then run the load test against it."""
+
+	weights = parse_mix(args.mix)
+	with tempfile.TemporaryDirectory() as directory:
+		if args.url is None:
+			url = 'http://localhost:{p}'.format(p=args.port)
+			server = spawn_server(args.port, args.workers, directory)
+
+		else:
+			url = args.url
+			server = None
+
+		try:
+			# each websocket holds a connection so lift the default limit
+			async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+				await wait_for_server(session, url, timeout=20)
+				test = LoadTest(session, url, args.clients, weights, args.rate, args.size)
+				if server is not None:
+					rss_start = process_rss(server.pid)
+
+				elapsed = await test.run(args.duration)
+				test.report(elapsed)
+				if server is not None:
+					print('Server RSS {a:.1f}MB before clients, {b:.1f}MB after'.format(
+						a=rss_start / 1e6, b=process_rss(server.pid) / 1e6))
+
+		finally:
+			if server is not None:
+				server.terminate()
+				server.wait()
+
+
+def main():
+	"""Command line entry point."""
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--url',
+						help='Test an already running server instead of spawning one')
+	parser.add_argument('--port',
+						type=int,
+						default=8099,
+						help='Port for spawned server')
+	parser.add_argument('--workers',
+						type=int,
+						default=1,
+						help='Server processes for spawned server')
+	parser.add_argument('--clients', '-c',
+						type=int,
+						default=50,
+						help='Number of websocket clients')
+	parser.add_argument('--duration', '-d',
+						type=float,
+						default=10.0,
+						help='Seconds to send operations for')
+	parser.add_argument('--rate', '-r',
+						type=float,
+						default=100.0,
+						help='Operations per second to send, or 0 for as fast as possible')
+	parser.add_argument('--mix',
+						default=DEFAULT_MIX,
+						help='Relative weights of operations {o}'.format(o=', '.join(OPERATIONS)))
+	parser.add_argument('--size',
+						type=int,
+						default=40,
+						help='Characters of text in each post')
+	args = parser.parse_args()
+
+	loop = asyncio.new_event_loop()
+	loop.run_until_complete(run_load(args))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+"""JSON decoding for statefiles, journals and saved indexes.
+
+Uses orjson if it is installed, which parses a large statefile several times faster
+than the standard library module."""
+
+import json
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+def loads(data):
+	"""Decode JSON `data`, given as bytes or str. Raises ValueError if it is invalid."""
+
+	if orjson is not None:
+		return orjson.loads(data)
+
+	return json.loads(data)
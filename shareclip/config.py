@@ -46,15 +46,158 @@ DATA_DIR = Path(os.environ.get(
 # Name of statefile used to store slot contents between invocations of the server
 STATEFILE = DATA_DIR.joinpath('state')
 
+# Statefile storage backend, 'json' or 'sqlite'
+STORAGE = 'json'
+
+# Default name of the database used by the sqlite storage backend
+SQLITE_STATEFILE = DATA_DIR.joinpath('state.sqlite')
+
+# Directory holding message bodies too large to keep in the statefile
+BLOB_DIR = DATA_DIR.joinpath('blobs')
+
+# Messages longer than this many characters are stored as blobs, with only a preview
+# kept in the slot
+BLOB_THRESHOLD = 65536
+
+# Characters of a blob kept in its slot as a preview
+BLOB_PREVIEW = 2000
+
+# Largest message in bytes which can be uploaded
+BLOB_MAX_SIZE = 256 * 1024 * 1024
+
+# Bytes sent in each request of a chunked upload. Must be below the 1MB default
+# aiohttp request size limit
+UPLOAD_CHUNK = 512 * 1024
+
+# Seconds after which an unfinished upload is discarded
+UPLOAD_EXPIRY = 3600
+
 # Number of undo slot to retain
 UNDO_QUEUE_LENGTH = 100
 
+# Retention limits. The oldest slots are expired, bypassing the undo queue, once there
+# are more than RETAIN_SLOTS, their text totals more than RETAIN_BYTES or they are
+# older than RETAIN_AGE seconds. None for no limit
+RETAIN_SLOTS = None
+RETAIN_BYTES = None
+RETAIN_AGE = None
+
+# Record each change to a journal next to the statefile as it happens, instead of
+# only saving state when the server exits
+JOURNAL = False
+
+# Fold the journal into the statefile after this many changes
+JOURNAL_COMPACT_RECORDS = 10000
+
+# Slots read from a newline delimited JSON import and stored as a single change
+IMPORT_CHUNK = 1000
+
+# Force journal writes to disk after this many changes ...
+JOURNAL_FSYNC_RECORDS = 100
+
+# ... or when writing a change this many seconds after the last fsync
+JOURNAL_FSYNC_INTERVAL = 1.0
+
+# While serving, save the statefile in the background every this many seconds if
+# anything has changed ...
+SNAPSHOT_INTERVAL = 60.0
+
+# ... or as soon as this many changes have been made
+SNAPSHOT_CHANGES = 1000
+
+# Number of slots to encode at a time when writing the statefile
+SNAPSHOT_CHUNK = 1000
+
+# Interval in seconds for sampling event loop lag
+LOOP_LAG_PROBE = 0.01
+
+# Interval in seconds for sampling event loop lag for metrics
+METRICS_LAG_INTERVAL = 0.1
+
+# Number of recent changes kept in memory so reconnecting clients can be sent only
+# what they missed
+CHANGE_LOG_LENGTH = 1000
+
+# Number of slots sent to a client at a time, newest first
+PAGE_SIZE = 100
+
+# Largest page of slots a client may ask for
+MAX_PAGE_SIZE = 1000
+
+# Most messages posted or deleted by a single JSON API request
+API_BULK_LIMIT = 1000
+
+# Most results returned by a search
+SEARCH_LIMIT = 50
+
+# Most indexed words a prefix in a search query is expanded to
+SEARCH_EXPANSIONS = 200
+
+# Bulk deletes of more than this many slots rebuild the paging index in one pass
+BULK_DELETE_REINDEX = 32
+
+# Compress the "Open all as page" page for clients which accept gzip
+COMPRESS_ALL = True
+
+# Approximate size in characters of each piece of a streamed page
+STREAM_CHUNK = 65536
+
+# Offer permessage-deflate compression to websocket clients
+WS_COMPRESS = True
+
+# Seconds over which bursts of changes are gathered into a single message to each
+# client, or 0 to send every change separately
+BATCH_WINDOW = 0.01
+
+# Seconds a client has to accept a message before it is disconnected
+SEND_TIMEOUT = 5.0
+
+# Number of messages which may wait to be sent to each client
+SEND_QUEUE_LENGTH = 256
+
+# What to do when a client's send queue is full: 'resync' replaces the queue with a
+# snapshot of the current state, 'disconnect' drops the client
+SEND_OVERFLOW = 'resync'
+
+# Requests the command line client may send before the server has acknowledged them
+CLIENT_PIPELINE = 256
+
+# Seconds the command line client waits between attempts to reconnect
+CLIENT_RETRY = 1.0
+
+# Seconds the command line client waits for the server to answer before giving up, in
+# case replies were lost when the server resynced it
+CLIENT_TIMEOUT = 60.0
+
+# Number of server processes to run, sharing the listening port
+WORKERS = 1
+
+# Address where the process owning the statefile listens for worker processes: a Unix
+# socket path, or host:port to accept workers from other hosts
+BUS_ADDRESS = DATA_DIR.joinpath('bus.sock')
+
+# Seconds between attempts by a worker to connect to the owner
+BUS_RETRY = 0.5
+
+# Longest message, in bytes, passed between processes. Newly connected workers are sent
+# the whole state in one message
+BUS_LINE_LIMIT = 1 << 30
+
+# Disconnect a worker once this many bytes are waiting to be sent to it
+BUS_BUFFER_LIMIT = 64 * 1024 * 1024
+
 # Filename for log file or None for terminal
 LOG_FILE = None  # data_dir.joinpath('log')
 
 # Base name for daily rotating log files
 ROTATING_LOG_FILE = None
 
+# Number of old daily log files kept
+LOG_BACKUPS = 30
+
+# Layout of each line written to the log
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
 # Switch on extra developer info in web interface and console log
 DEBUG = False
 
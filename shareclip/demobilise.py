@@ -15,18 +15,18 @@ replacements = (
 def process_statefile(statefile):
 	statefile.save(suffix=BACKUP_SUFFIX)
 	changes = 0
-	for slot in statefile.slots:
-		changed = False
+	for slot in statefile.slots.values():
+		text = slot.text
+		clipboard = slot.clipboard
 		for orig, repl in replacements:
-			if orig in slot['text']:
-				slot['text'] = slot['text'].replace(orig, repl)
-				changed = True
+			if orig in text:
+				text = text.replace(orig, repl)
 
-			if slot['clipboard'] is not None and orig in slot['clipboard']:
-				slot['clipboard'] = slot['clipboard'].replace(orig, repl)
-				changed = True
+			if clipboard is not None and orig in clipboard:
+				clipboard = clipboard.replace(orig, repl)
 
-		if changed:
+		if text != slot.text or clipboard != slot.clipboard:
+			statefile.update_slot(slot, text=text, clipboard=clipboard)
 			changes += 1
 
 	logger.info('Changed {cc} slots'.format(cc=changes))
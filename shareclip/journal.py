@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""Append-only journal of changes to a Statefile."""
+
+import os
+import json
+import time
+import logging
+
+from shareclip import config
+from shareclip import codec
+
+logger = logging.getLogger('journal')
+
+
+class Journal():
+	"""A file of compact JSON records, one per line, for each change made to the state
+	since the last snapshot.
+
+	Writes are flushed to the operating system immediately but only fsynced every
+	`config.JOURNAL_FSYNC_RECORDS` records or `config.JOURNAL_FSYNC_INTERVAL` seconds.
+	The interval is checked on each append, and by `sync_due` which the server calls
+	on a timer so the last records before a quiet spell are synced too."""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.handle = None
+		# records written to this journal
+		self.records = 0
+		# records written since the last fsync
+		self.unsynced = 0
+		self.last_sync = time.monotonic()
+
+	def open(self):
+		"""Open for appending, creating the file if needed."""
+
+		logger.info('Opening journal {j}'.format(j=self.filename))
+		self.handle = self.filename.open('a')
+
+	def append(self, record):
+		"""Write one record."""
+
+		self.handle.write(json.dumps(record, separators=(',', ':')) + '\n')
+		self.handle.flush()
+		self.records += 1
+		self.unsynced += 1
+		if self.unsynced >= config.JOURNAL_FSYNC_RECORDS:
+			self.sync()
+
+		else:
+			self.sync_due()
+
+	def sync_due(self):
+		"""Sync if records have waited `config.JOURNAL_FSYNC_INTERVAL` seconds."""
+
+		if self.unsynced > 0 and \
+		   time.monotonic() - self.last_sync >= config.JOURNAL_FSYNC_INTERVAL:
+			self.sync()
+
+	def sync(self):
+		"""Force written records to disk."""
+
+		if self.unsynced > 0:
+			os.fsync(self.handle.fileno())
+			self.unsynced = 0
+
+		self.last_sync = time.monotonic()
+
+	def close(self):
+		"""Sync and close the file."""
+
+		if self.handle is not None:
+			self.sync()
+			self.handle.close()
+			self.handle = None
+
+	def read(self):
+		"""Yield all records from an existing journal file.
+
+		Reading stops at the first damaged line, which is what a crash part way through
+		a write leaves behind. The damaged tail is cut off so later appends are not lost
+		behind it."""
+
+		good_size = 0
+		damaged = False
+		with self.filename.open('rb') as handle:
+			for line in handle:
+				try:
+					if not line.endswith(b'\n'):
+						raise ValueError('Incomplete line')
+
+					record = codec.loads(line)
+
+				except ValueError:
+					damaged = True
+					break
+
+				good_size += len(line)
+				self.records += 1
+				yield record
+
+		if damaged:
+			logger.warning('Truncating damaged journal {j} after {r} records'.format(
+				j=self.filename, r=self.records))
+			os.truncate(str(self.filename), good_size)
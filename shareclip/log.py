@@ -1,7 +1,67 @@
 #!/usr/bin/env python3
 
+"""Logging setup.
+
+Every logger writes to a queue, and a listener thread takes records from it and writes
+them to the terminal or log files. Code logging from the event loop only formats the
+message and queues it, never waiting for a slow terminal or disk."""
+
+import queue
+import atexit
 import logging
+import logging.handlers
+
+from shareclip import config
+
+# thread writing out queued records, while logging is set up
+listener = None
+
+
+def init_log(debug=False, log_file=None, rotating_log_file=None):
+	"""Send log records through a queue to `log_file`, to daily rotating log files
+	named from `rotating_log_file`, or to the terminal if neither is given.
+
+	Records below INFO level are dropped before they are formatted unless `debug` is
+	set."""
+
+	global listener
+
+	handlers = []
+	if log_file is not None:
+		handlers.append(logging.FileHandler(str(log_file)))
+
+	if rotating_log_file is not None:
+		handlers.append(logging.handlers.TimedRotatingFileHandler(
+			str(rotating_log_file), when='midnight', backupCount=config.LOG_BACKUPS))
+
+	if len(handlers) == 0:
+		handlers.append(logging.StreamHandler())
+
+	formatter = logging.Formatter(config.LOG_FORMAT)
+	for handler in handlers:
+		handler.setFormatter(formatter)
+
+	stop_log()
+	records = queue.SimpleQueue()
+	# the queue carries just the message, laid out by the handlers the listener feeds
+	logging.basicConfig(level=logging.DEBUG if debug else logging.INFO,
+						format='%(message)s',
+						handlers=[logging.handlers.QueueHandler(records)],
+						force=True)
+	listener = logging.handlers.QueueListener(records, *handlers)
+	listener.start()
+	atexit.unregister(stop_log)
+	atexit.register(stop_log)
+
+
+def stop_log():
+	"""Write out any queued records and stop the listener thread."""
+
+	global listener
+
+	if listener is not None:
+		listener.stop()
+		for handler in listener.handlers:
+			handler.close()
 
-def init_log():
-	logging.basicConfig(level=logging.DEBUG,
-						handlers=[logging.StreamHandler()])
+		listener = None
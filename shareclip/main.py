@@ -2,14 +2,17 @@
 
 """Web shared clipboard server command line interface."""
 
+import sys
 import logging
 import argparse
+import itertools
+from pathlib import Path
 
-from shareclip import server
 from shareclip import config
 from shareclip import log
-from shareclip.statefile import Statefile
-from shareclip import demobilise
+
+# The server, bus and statefile modules are imported only by the options using them so
+# command line tools start quickly without loading the web server
 
 logger = logging.getLogger('main')
 
@@ -19,6 +22,70 @@ def read_config_file(config_file):
 	pass
 
 
+def serve_worker(port, prefix, address, debug, log_file=None, rotating_log_file=None):
+	"""Run a server process holding a replica of the state owned by the server process
+	listening for workers on bus `address`.
+
+	Logging is set up again here as a forked worker does not inherit the thread writing
+	out the log queue."""
+
+	log.init_log(debug=debug, log_file=log_file, rotating_log_file=rotating_log_file)
+
+	from shareclip import server
+	from shareclip import bus
+	from shareclip.statefile import Statefile
+
+	server.serve(port=port,
+				 prefix=prefix,
+				 statefile=Statefile(None, backend='memory'),
+				 debug=debug,
+				 bus=bus.BrokerBus(bus.SocketBroker(address), owner=False),
+				 reuse_port=True)
+
+
+def import_file(statefile, filename):
+	"""Add slots from newline delimited JSON file `filename`, or standard input if it is
+	'-', then save. Returns False if a bad line stopped the import part way."""
+
+	from shareclip.slot import decode_lines
+
+	handle = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+	added = 0
+	number = 1
+	complete = True
+	try:
+		for lines in iter(lambda: list(itertools.islice(handle, config.IMPORT_CHUNK)), []):
+			added += len(statefile.import_slots(decode_lines(lines, number)))
+			number += len(lines)
+
+	except ValueError as exc:
+		logger.error('Import stopped at {e}'.format(e=exc))
+		complete = False
+
+	finally:
+		if handle is not sys.stdin.buffer:
+			handle.close()
+
+	logger.info('Imported {a} new messages'.format(a=added))
+	statefile.save()
+	return complete
+
+
+def export_file(statefile, filename):
+	"""Write all slots to `filename` as newline delimited JSON, or to standard output if
+	it is '-'."""
+
+	handle = sys.stdout if filename == '-' else open(filename, 'w')
+	try:
+		handle.writelines(statefile.export_lines())
+
+	finally:
+		if handle is not sys.stdout:
+			handle.close()
+
+	logger.info('Exported {s} messages'.format(s=len(statefile.slots)))
+
+
 def main():
 	"""Command line entry point."""
 	parser = argparse.ArgumentParser(add_help=False,
@@ -43,8 +110,73 @@ def main():
 						default=config.PREFIX,
 						help='URL prefix')
 	parser.add_argument('--statefile',
-						default=config.STATEFILE,
+						type=Path,
 						help='Chose alternative statefile location')
+	parser.add_argument('--storage',
+						choices=('json', 'sqlite'),
+						default=config.STORAGE,
+						help='Store state in a JSON file or an SQLite database')
+	parser.add_argument('--retain-slots',
+						type=int,
+						default=config.RETAIN_SLOTS,
+						help='Expire the oldest messages beyond this many')
+	parser.add_argument('--retain-bytes',
+						type=int,
+						default=config.RETAIN_BYTES,
+						help='Expire the oldest messages once their text totals more than '
+						'this many bytes')
+	parser.add_argument('--retain-age',
+						type=float,
+						default=config.RETAIN_AGE,
+						help='Expire messages older than this many seconds')
+	parser.add_argument('--blob-dir',
+						type=Path,
+						default=config.BLOB_DIR,
+						help='Directory for message bodies too large to keep in the statefile')
+	parser.add_argument('--blob-threshold',
+						type=int,
+						default=config.BLOB_THRESHOLD,
+						help='Store messages longer than this many characters as blobs')
+	parser.add_argument('--journal',
+						action='store_true',
+						default=config.JOURNAL,
+						help='Record each change to a journal as it happens')
+	parser.add_argument('--snapshot-interval',
+						type=float,
+						default=config.SNAPSHOT_INTERVAL,
+						help='Seconds between background saves of a changed state')
+	parser.add_argument('--snapshot-changes',
+						type=int,
+						default=config.SNAPSHOT_CHANGES,
+						help='Save in the background after this many changes')
+	parser.add_argument('--send-queue',
+						type=int,
+						default=config.SEND_QUEUE_LENGTH,
+						help='Messages which may wait to be sent to each client')
+	parser.add_argument('--send-overflow',
+						choices=('resync', 'disconnect'),
+						default=config.SEND_OVERFLOW,
+						help='Resync or disconnect a client whose send queue is full')
+	parser.add_argument('--no-ws-compress',
+						action='store_true',
+						help='Do not offer permessage-deflate compression to websocket clients')
+	parser.add_argument('--batch-window',
+						type=float,
+						default=config.BATCH_WINDOW,
+						help='Seconds over which bursts of changes are sent to clients as a '
+						'single message, or 0 to send each change as it happens')
+	parser.add_argument('--workers',
+						type=int,
+						default=config.WORKERS,
+						help='Number of server processes sharing the port')
+	parser.add_argument('--bus',
+						help='Unix socket path, or host:port, where the server owning the '
+						'statefile listens for worker processes. Implied by --workers')
+	parser.add_argument('--join',
+						metavar='BUS',
+						help='Serve as a worker of the server owning the statefile at bus '
+						'address BUS, which may be on another host if --blob-dir is on a '
+						'filesystem shared with it')
 	parser.add_argument('--title',
 						help='Web page title text',
 						default=config.TITLE)
@@ -52,8 +184,12 @@ def main():
 						action='store_true',
 						help='Hide the web tool nicknames')
 	parser.add_argument('--log',
+						type=Path,
+						default=config.LOG_FILE,
 						help='Location of log file')
 	parser.add_argument('--rotating-log',
+						type=Path,
+						default=config.ROTATING_LOG_FILE,
 						help='Root name of daily rotating log files')
 	# command line utility tool
 	parser.add_argument('--clear-statefile',
@@ -68,6 +204,56 @@ def main():
 	parser.add_argument('--demobilise',
 						action='store_true',
 						help='Convert mobile friendly links to desktop friendly links')
+	parser.add_argument('--export',
+						metavar='FILE',
+						dest='export_file',
+						help='Write messages to FILE, or - for standard output, as newline '
+						'delimited JSON')
+	parser.add_argument('--import',
+						metavar='FILE',
+						dest='import_file',
+						help='Add messages from newline delimited JSON FILE, or - for '
+						'standard input, skipping any already present. Timestamps must be '
+						'in UTC without a time zone')
+	# command line client of a running server
+	parser.add_argument('--url',
+						help='Server used by the client options, by default the local server '
+						'on --port and --prefix')
+	parser.add_argument('--nickname',
+						default='',
+						help='Nickname for messages posted by the client options')
+	parser.add_argument('--post',
+						action='append',
+						default=[],
+						metavar='TEXT',
+						help='Post TEXT as a message. May be given several times')
+	parser.add_argument('--paste-from-stdin',
+						action='store_true',
+						help='Post standard input as a single message')
+	parser.add_argument('--post-lines',
+						metavar='FILE',
+						help='Post each line of FILE, or - for standard input, as a message')
+	parser.add_argument('--delete',
+						action='append',
+						default=[],
+						metavar='UID',
+						help='Delete message UID. May be given several times')
+	parser.add_argument('--undo',
+						action='store_true',
+						help='Undo the most recent delete')
+	parser.add_argument('--tail',
+						type=int,
+						nargs='?',
+						const=10,
+						metavar='N',
+						help='Show the newest N messages, 10 if N is not given')
+	parser.add_argument('--watch',
+						action='store_true',
+						help='Show changes to the messages as they happen until interrupted')
+	parser.add_argument('--migrate-from',
+						type=Path,
+						metavar='STATEFILE',
+						help='Replace current state with the contents of a JSON statefile')
 	# meta options
 	parser.add_argument('--debug',
 						action='store_true',
@@ -81,13 +267,12 @@ def main():
 						help='Show this help message and exit')
 
 	# --copy 'Copy item to clipboard'
-	# --paste 'Paste clipboard content to share'
 	# --open
 
 	args = parser.parse_args()
 	# args = parser.parse_args(remainder)
 
-	log.init_log()
+	log.init_log(debug=args.debug, log_file=args.log, rotating_log_file=args.rotating_log)
 
 	if args.help:
 		parser.print_help()
@@ -97,14 +282,89 @@ def main():
 		print(config.VERSION)
 		parser.exit()
 
-	statefile = Statefile(args.statefile)
+	if args.statefile is None:
+		if args.storage == 'sqlite':
+			args.statefile = config.SQLITE_STATEFILE
+
+		else:
+			args.statefile = config.STATEFILE
+
+	config.TITLE = args.title
+
+	if args.hide_nickname:
+		config.NICKNAMES = False
+
+	config.SNAPSHOT_INTERVAL = args.snapshot_interval
+	config.SNAPSHOT_CHANGES = args.snapshot_changes
+	config.SEND_QUEUE_LENGTH = args.send_queue
+	config.SEND_OVERFLOW = args.send_overflow
+	config.BATCH_WINDOW = args.batch_window
+	config.RETAIN_SLOTS = args.retain_slots
+	config.RETAIN_BYTES = args.retain_bytes
+	config.RETAIN_AGE = args.retain_age
+	config.BLOB_DIR = args.blob_dir
+	config.BLOB_THRESHOLD = args.blob_threshold
+	if args.no_ws_compress:
+		config.WS_COMPRESS = False
+
+	if args.join is not None:
+		serve_worker(port=args.port,
+					 prefix=args.prefix,
+					 address=args.join,
+					 debug=args.debug,
+					 log_file=args.log,
+					 rotating_log_file=args.rotating_log)
+		parser.exit()
+
+	if len(args.post) > 0 or args.paste_from_stdin or args.post_lines is not None or \
+	   len(args.delete) > 0 or args.undo or args.tail is not None or args.watch:
+		from shareclip import client
+
+		if args.url is None:
+			args.url = 'http://localhost:{p}{pr}'.format(p=args.port, pr=args.prefix)
+
+		if not client.run_client(url=args.url,
+								 nickname=args.nickname,
+								 posts=args.post,
+								 paste=args.paste_from_stdin,
+								 lines_file=args.post_lines,
+								 deletes=args.delete,
+								 undo=args.undo,
+								 tail=args.tail,
+								 watch=args.watch):
+			parser.exit(1)
+
+		parser.exit()
+
+	from shareclip.statefile import Statefile
+
+	# loaded only by the options which read the existing state
+	statefile = Statefile(args.statefile, backend=args.storage, load=False)
 
 	done_something = False
 
+	if args.migrate_from is not None:
+		statefile.import_state(Statefile(args.migrate_from, backend='json'))
+		done_something = True
+
 	if args.clear_statefile:
 		statefile.delete()
 		done_something = True
 
+	if args.show_messages or args.show_undo or args.demobilise or args.serve or \
+	   args.export_file is not None or args.import_file is not None:
+		statefile.load()
+
+	if args.import_file is not None:
+		if not import_file(statefile, args.import_file):
+			parser.exit(1)
+
+		done_something = True
+
+	if args.export_file is not None:
+		export_file(statefile, args.export_file)
+		done_something = True
+
 	if args.show_messages:
 		statefile.show_messages()
 		parser.exit()
@@ -114,19 +374,44 @@ def main():
 		parser.exit()
 
 	if args.demobilise:
+		from shareclip import demobilise
 		demobilise.process_statefile(statefile)
 		parser.exit()
 
-	config.TITLE = args.title
+	if args.serve:
+		import multiprocessing
+		from shareclip import server
+		from shareclip import bus
 
-	if args.hide_nickname:
-		config.NICKNAMES = False
+		if args.workers > 1 or args.bus is not None:
+			if args.bus is None:
+				args.bus = config.BUS_ADDRESS
+
+			# only this process touches the statefile, the others follow over the bus
+			for _ in range(args.workers - 1):
+				multiprocessing.Process(target=serve_worker,
+										kwargs={'port': args.port,
+												'prefix': args.prefix,
+												'address': args.bus,
+												'debug': args.debug,
+												'log_file': args.log,
+												'rotating_log_file': args.rotating_log},
+										daemon=True).start()
+
+			owner_bus = bus.BrokerBus(bus.SocketBroker(args.bus, hub=True), owner=True)
+
+		else:
+			owner_bus = None
+
+		if args.journal:
+			statefile.start_journal()
 
-	if args.serve:
 		server.serve(port=args.port,
 					 prefix=args.prefix,
 					 statefile=statefile,
-					 debug=args.debug)
+					 debug=args.debug,
+					 bus=owner_bus,
+					 reuse_port=args.workers > 1)
 		parser.exit()
 
 	if not done_something:
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""Counters, gauges and histograms served in Prometheus text format at /metrics.
+
+Updating a metric is a dict lookup and an addition, cheap enough to leave on
+everywhere. Each server process keeps its own figures."""
+
+import bisect
+
+# Histogram buckets for durations in seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+				0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Histogram buckets for queue depths
+DEPTH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# All metrics in the order they are shown
+REGISTRY = []
+
+
+class Metric():
+	"""Base for a named metric, optionally split by the value of one label."""
+
+	kind = None
+
+	def __init__(self, name, description, label=None, registry=REGISTRY):
+		self.name = name
+		self.description = description
+		self.label = label
+		# values by label value, or under None if there is no label
+		self.children = {}
+		registry.append(self)
+
+	def labels(self, value):
+		"""Return the child metric for label value `value`."""
+
+		child = self.children.get(value)
+		if child is None:
+			child = self.children[value] = self.new_child()
+
+		return child
+
+	def new_child(self):
+		"""Create the storage for one label value."""
+
+		raise NotImplementedError()
+
+	def selector(self, value, extra=None):
+		"""Return the {label="value"} part of a sample line."""
+
+		pairs = []
+		if self.label is not None:
+			pairs.append('{l}="{v}"'.format(l=self.label, v=value))
+
+		if extra is not None:
+			pairs.append(extra)
+
+		if len(pairs) == 0:
+			return ''
+
+		return '{' + ','.join(pairs) + '}'
+
+	def render(self):
+		"""Return our lines of the text format."""
+
+		lines = ['# HELP {n} {d}'.format(n=self.name, d=self.description),
+				 '# TYPE {n} {k}'.format(n=self.name, k=self.kind)]
+		for value, child in sorted(self.children.items(), key=lambda c: str(c[0])):
+			lines.extend(self.render_child(value, child))
+
+		return lines
+
+	def render_child(self, value, child):
+		"""Return the sample lines for one label value."""
+
+		return ['{n}{s} {v}'.format(n=self.name, s=self.selector(value), v=child.value)]
+
+
+class Value():
+	"""A single number."""
+
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount=1):
+		"""Add `amount`."""
+
+		self.value += amount
+
+	def dec(self, amount=1):
+		"""Subtract `amount`."""
+
+		self.value -= amount
+
+	def set(self, value):
+		"""Replace the value."""
+
+		self.value = value
+
+
+class Counter(Metric):
+	"""A count which only goes up."""
+
+	kind = 'counter'
+
+	def __init__(self, name, description, label=None, registry=REGISTRY):
+		super().__init__(name, description, label, registry)
+		if label is None:
+			self.unlabelled = self.labels(None)
+
+	def new_child(self):
+		return Value()
+
+	def inc(self, amount=1):
+		"""Add `amount` to an unlabelled counter."""
+
+		self.unlabelled.value += amount
+
+
+class Gauge(Counter):
+	"""A value which goes up and down, or is read from a function when shown."""
+
+	kind = 'gauge'
+
+	def __init__(self, name, description, label=None, registry=REGISTRY):
+		super().__init__(name, description, label, registry)
+		self.function = None
+
+	def set(self, value):
+		"""Set an unlabelled gauge."""
+
+		self.unlabelled.value = value
+
+	def dec(self, amount=1):
+		"""Subtract `amount` from an unlabelled gauge."""
+
+		self.unlabelled.value -= amount
+
+	def set_function(self, function):
+		"""Read the value from `function()` whenever metrics are shown."""
+
+		self.function = function
+
+	def render_child(self, value, child):
+		if self.function is not None:
+			child.value = self.function()
+
+		return super().render_child(value, child)
+
+
+class Buckets():
+	"""Counts of observations falling into each histogram bucket."""
+
+	__slots__ = ('bounds', 'counts', 'sum', 'count')
+
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		"""Record one observation."""
+
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+
+class Histogram(Metric):
+	"""Distribution of observed values, such as durations."""
+
+	kind = 'histogram'
+
+	def __init__(self, name, description, label=None, buckets=TIME_BUCKETS, registry=REGISTRY):
+		self.buckets = buckets
+		super().__init__(name, description, label, registry)
+		if label is None:
+			self.unlabelled = self.labels(None)
+
+	def new_child(self):
+		return Buckets(self.buckets)
+
+	def observe(self, value):
+		"""Record a value for an unlabelled histogram."""
+
+		self.unlabelled.observe(value)
+
+	def render_child(self, value, child):
+		lines = []
+		total = 0
+		for bound, count in zip(self.buckets + ('+Inf',), child.counts):
+			total += count
+			lines.append('{n}_bucket{s} {c}'.format(
+				n=self.name, s=self.selector(value, 'le="{b}"'.format(b=bound)), c=total))
+
+		lines.append('{n}_sum{s} {v}'.format(n=self.name, s=self.selector(value), v=child.sum))
+		lines.append('{n}_count{s} {v}'.format(n=self.name, s=self.selector(value), v=child.count))
+		return lines
+
+
+def render(registry=REGISTRY):
+	"""Return all metrics in Prometheus text format."""
+
+	lines = []
+	for metric in registry:
+		lines.extend(metric.render())
+
+	return '\n'.join(lines) + '\n'
+
+
+WS_CONNECTS = Counter('shareclip_ws_connects_total', 'Websocket connections opened')
+WS_DISCONNECTS = Counter('shareclip_ws_disconnects_total', 'Websocket connections closed')
+WS_EVICTIONS = Counter('shareclip_ws_evictions_total',
+					   'Websocket clients disconnected for failing to accept messages')
+WS_RESYNCS = Counter('shareclip_ws_resyncs_total',
+					 'Websocket clients sent a fresh snapshot after their send queue filled')
+CLIENTS = Gauge('shareclip_clients', 'Connected websocket clients')
+MESSAGE_SECONDS = Histogram('shareclip_message_seconds',
+							'Time handling each client websocket message, by type',
+							label='type')
+BROADCAST_SECONDS = Histogram('shareclip_broadcast_seconds',
+							  'Time to send a change to every client')
+SEND_QUEUE_DEPTH = Histogram('shareclip_send_queue_depth',
+							 'Messages waiting to be sent to a client, seen on each send',
+							 buckets=DEPTH_BUCKETS)
+BATCH_SIZE = Histogram('shareclip_batch_size', 'Changes combined into each batch message',
+					   buckets=DEPTH_BUCKETS)
+SEND_QUEUED = Gauge('shareclip_send_queued', 'Messages waiting to be sent to all clients')
+SAVE_SECONDS = Histogram('shareclip_save_seconds', 'Time writing the statefile')
+SAVE_BYTES = Gauge('shareclip_save_bytes', 'Size of the last statefile written')
+SLOTS = Gauge('shareclip_slots', 'Current slots')
+UNDOS = Gauge('shareclip_undos', 'Slots in the undo queue')
+LOOP_LAG_SECONDS = Histogram('shareclip_loop_lag_seconds',
+							 'How late the event loop runs a timer')
+SNAPSHOT_STALL_SECONDS = Histogram('shareclip_snapshot_stall_seconds',
+								   'Longest event loop stall during each background save')
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""Incremental inverted index for searching slots.
+
+Slots are split into lower case words from their text (with any HTML tags removed),
+clipboard and nickname. Each word maps to the slots containing it and how often, and
+a sorted list of all words allows prefix matching. The words of every slot are kept
+too, so it can be removed without tokenising it again and so the index can be saved
+and reloaded."""
+
+import os
+import re
+import json
+import math
+import zlib
+import heapq
+import bisect
+import logging
+from collections import Counter
+
+from shareclip import config
+from shareclip import codec
+from shareclip.slot import unpack_uid
+
+logger = logging.getLogger('search')
+
+# Format of saved index files
+VERSION = 1
+
+WORD = re.compile(r'\w+')
+TAG = re.compile(r'<[^>]*>')
+
+
+def slot_words(slot):
+	"""Return a Counter of the words in `slot`."""
+
+	return Counter(WORD.findall(' '.join((TAG.sub(' ', slot.text),
+										  slot.clipboard or '',
+										  slot.nickname or '')).lower()))
+
+
+def fingerprint(slot):
+	"""Checksum of the indexed fields of `slot`, much cheaper than tokenising it."""
+
+	return zlib.crc32('\0'.join((slot.text,
+								 slot.clipboard or '',
+								 slot.nickname or '')).encode())
+
+
+class SearchIndex():
+	"""Inverted index of the words in a set of slots."""
+
+	def __init__(self):
+		# count of each word in each slot, by word then uid
+		self.postings = {}
+		# every word in `postings`, sorted for prefix lookup
+		self.words = []
+		# fingerprint and word counts of each slot, by packed uid
+		self.slots = {}
+		# timestamp of each slot, by packed uid, for ordering equally good matches
+		self.stamps = {}
+
+	def add(self, slot, words=None):
+		"""Index `slot`, replacing any earlier version. `words` are its word counts if
+		already known."""
+
+		uid = slot.key
+		if uid in self.slots:
+			self.remove(uid)
+
+		if words is None:
+			words = slot_words(slot)
+
+		for word, count in words.items():
+			uids = self.postings.get(word)
+			if uids is None:
+				uids = self.postings[word] = {}
+				bisect.insort(self.words, word)
+
+			uids[uid] = count
+
+		self.slots[uid] = (fingerprint(slot), words)
+		self.stamps[uid] = slot.stamp
+
+	def remove(self, uid):
+		"""Remove slot with packed uid `uid` from the index if present."""
+
+		entry = self.slots.pop(uid, None)
+		if entry is None:
+			return
+
+		del self.stamps[uid]
+		for word in entry[1]:
+			uids = self.postings[word]
+			del uids[uid]
+			if len(uids) == 0:
+				del self.postings[word]
+				del self.words[bisect.bisect_left(self.words, word)]
+
+	def build(self, slots, saved=None):
+		"""Index all of `slots` from scratch, reusing word counts from `saved` (as
+		returned by `dump`) for any slot whose fingerprint is unchanged."""
+
+		self.postings = {}
+		self.slots = {}
+		self.stamps = {}
+		saved = saved or {}
+		reused = 0
+		for slot in slots:
+			check = fingerprint(slot)
+			entry = saved.get(slot.uid)
+			if entry is not None and entry[0] == check:
+				words = entry[1]
+				reused += 1
+
+			else:
+				words = slot_words(slot)
+
+			self.slots[slot.key] = (check, words)
+			self.stamps[slot.key] = slot.stamp
+			for word, count in words.items():
+				self.postings.setdefault(word, {})[slot.key] = count
+
+		self.words = sorted(self.postings)
+		logger.info('Indexed {s} slots, {r} from saved index, {w} words'.format(
+			s=len(self.slots), r=reused, w=len(self.words)))
+
+	def expand(self, prefix):
+		"""Return words beginning with `prefix`, up to `config.SEARCH_EXPANSIONS` of
+		them, shortest first so an exact match is always included."""
+
+		start = bisect.bisect_left(self.words, prefix)
+		end = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+		if end - start > config.SEARCH_EXPANSIONS:
+			return sorted(self.words[start:end], key=len)[:config.SEARCH_EXPANSIONS]
+
+		return self.words[start:end]
+
+	def search(self, query, limit):
+		"""Return the packed uids of up to `limit` slots matching `query`, best first and
+		newest first among equally good matches.
+
+		Common words can match a large part of the board, so the ranking keys are plain
+		dict lookups and timestamps are only compared between slots tied for the last
+		places."""
+
+		scores = self.score(query)
+		best = heapq.nlargest(limit, scores, key=scores.__getitem__)
+		if len(best) == 0:
+			return best
+
+		threshold = scores[best[-1]]
+		above = sorted((uid for uid in best if scores[uid] > threshold),
+					   key=lambda uid: (scores[uid], self.stamps[uid]),
+					   reverse=True)
+		tied = [uid for uid, score in scores.items() if score == threshold]
+		return above + heapq.nlargest(limit - len(above), tied, key=self.stamps.__getitem__)
+
+	def score(self, query):
+		"""Return a dict of score by uid for slots matching every word of `query`, each
+		as a prefix.
+
+		Scores are the sum of term frequency times inverse document frequency of the
+		matched words, with exact matches counting double."""
+
+		total = len(self.slots)
+		matches = None
+		for prefix in set(WORD.findall(query.lower())):
+			scores = {}
+			for word in self.expand(prefix):
+				uids = self.postings[word]
+				weight = math.log(1 + total / len(uids)) * (2 if word == prefix else 1)
+				if len(scores) == 0:
+					scores = {uid: count * weight for uid, count in uids.items()}
+
+				else:
+					for uid, count in uids.items():
+						scores[uid] = scores.get(uid, 0) + count * weight
+
+			if matches is None:
+				matches = scores
+
+			else:
+				if len(scores) < len(matches):
+					matches, scores = scores, matches
+
+				matches = {uid: score + scores[uid] for uid, score in matches.items()
+						   if uid in scores}
+
+			if len(matches) == 0:
+				break
+
+		return matches or {}
+
+	def dump(self):
+		"""Return the index in a form which can be saved and passed to `build`."""
+
+		return {unpack_uid(uid): [fp, dict(words)] for uid, (fp, words) in self.slots.items()}
+
+
+def read_index(filename):
+	"""Return the saved index from `filename`, or None if there is no usable one."""
+
+	try:
+		saved = codec.loads(filename.read_bytes())
+
+	except (OSError, ValueError) as exc:
+		if filename.exists():
+			logger.warning('Ignoring search index {f}: {e}'.format(f=filename, e=exc))
+
+		return None
+
+	if saved.get('version') != VERSION:
+		return None
+
+	return saved['slots']
+
+
+def write_index(filename, index):
+	"""Save `index` to `filename`, replacing it atomically."""
+
+	temp = filename.with_name(filename.name + '.tmp')
+	with temp.open('w') as handle:
+		json.dump({'version': VERSION, 'slots': index.dump()}, handle, separators=(',', ':'))
+
+	os.replace(str(temp), str(filename))
@@ -2,11 +2,15 @@
 
 """HTTP webserver."""
 
+import time
+import asyncio
 import atexit
+import json
 import uuid
 import datetime
 import binascii
 import logging
+import functools
 
 from aiohttp import web
 from aiohttp import WSMsgType
@@ -18,10 +22,36 @@ try:
 except ImportError:
 	aiohttp_debugtoolbar = None
 
-from shareclip import config
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
 
+from shareclip import config
+from shareclip import metrics
+from shareclip import api
+from shareclip.bus import LocalBus
+from shareclip.bus import BusError
+from shareclip.blobs import BlobStore
+from shareclip.blobs import UploadError
+
+# Per message and per client debug lines pass their arguments to the logger rather than
+# formatting them first, so nothing is formatted unless debug logging is on
 logger = logging.getLogger('server')
 
+# Client message types, timed separately. Bad messages are timed as 'unknown'
+MESSAGE_TYPES = ('helo', 'page', 'search', 'post', 'delete', 'delete_all', 'empty_undo')
+
+# Name, type and whether it is required of fields checked in client messages, by type.
+# Optional fields may be missing or null
+MESSAGE_FIELDS = {'helo': (('epoch', str, False), ('seq', int, False)),
+				  'search': (('q', str, False),),
+				  'post': (('nickname', str, True), ('message', str, True)),
+				  'delete': (('uid', str, True),)}
+
+# Binary encodings a client may choose in its helo message, if the module is installed
+ENCODINGS = ('msgpack',) if msgpack is not None else ()
+
 # See https://pastebin.com/xDSACmdV for a template for writing server as a class
 
 # class WebSocket():
@@ -39,9 +69,133 @@ def datetime_to_iso8601(dt):
 	return dt.isoformat()
 
 
+async def take_snapshot(app):
+	"""Save the statefile from a worker thread, recording how long the event loop stalled.
+
+	Only the cheap copy of the slot and undo containers happens on the event loop."""
+
+	loop = asyncio.get_event_loop()
+	state = app['statefile']
+	stats = app['snapshot_stats']
+	start = loop.time()
+	copy = state.begin_snapshot()
+	copy_time = loop.time() - start
+	if copy is None:
+		return
+
+	lags = []
+	probe = asyncio.ensure_future(watch_loop_lag(lags))
+	try:
+		size = await loop.run_in_executor(None, state.write_snapshot, copy)
+
+	finally:
+		probe.cancel()
+
+	stats['count'] += 1
+	stats['duration'] = loop.time() - start
+	stats['stall'] = max([copy_time] + lags)
+	stats['max_stall'] = max(stats['max_stall'], stats['stall'])
+	metrics.SNAPSHOT_STALL_SECONDS.observe(stats['stall'])
+	stats['bytes'] = size
+	logger.info('Background save took {d:.3f}s with {s:.3f}s event loop stall'.format(
+		d=stats['duration'], s=stats['stall']))
+
+
+async def watch_loop_lag(lags):
+	"""Until cancelled, keep appending to `lags` how late the event loop wakes us."""
+
+	loop = asyncio.get_event_loop()
+	while True:
+		start = loop.time()
+		await asyncio.sleep(config.LOOP_LAG_PROBE)
+		lags.append(loop.time() - start - config.LOOP_LAG_PROBE)
+
+
+async def monitor_loop_lag(app):
+	"""Keep sampling event loop lag for metrics."""
+
+	loop = asyncio.get_event_loop()
+	while True:
+		start = loop.time()
+		await asyncio.sleep(config.METRICS_LAG_INTERVAL)
+		metrics.LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - config.METRICS_LAG_INTERVAL))
+
+
+async def snapshot_scheduler(app):
+	"""Save the statefile in the background after enough changes or enough time, or
+	when its journal has grown large enough to compact."""
+
+	loop = asyncio.get_event_loop()
+	state = app['statefile']
+	last = loop.time()
+	while True:
+		await asyncio.sleep(min(1.0, config.SNAPSHOT_INTERVAL))
+		if state.compact:
+			logger.info('Compacting journal')
+
+		if state.compact or state.dirty >= config.SNAPSHOT_CHANGES or \
+		   (state.dirty > 0 and loop.time() - last >= config.SNAPSHOT_INTERVAL):
+			try:
+				await take_snapshot(app)
+
+			except Exception:  # pylint: disable=broad-except
+				logger.exception('Background save failed')
+
+			last = loop.time()
+
+
+async def journal_syncer(app):
+	"""Sync the journal every `config.JOURNAL_FSYNC_INTERVAL` seconds, so the last changes
+	before a quiet spell reach the disk without waiting for another change."""
+
+	while True:
+		await asyncio.sleep(config.JOURNAL_FSYNC_INTERVAL)
+		app['statefile'].sync_journal()
+
+
+async def start_background_tasks(app):
+	"""Join the bus and start periodic tasks when the server starts."""
+
+	await app['bus'].start(statefile=app['statefile'],
+						   execute=lambda command: execute(app, command),
+						   deliver=lambda frame: broadcast_frame(app, frame),
+						   reset=lambda: reset_clients(app))
+	if app['bus'].owner:
+		await execute(app, {'type': 'expire'})
+		app['blobs'].collect(app['statefile'].blob_digests())
+		app['statefile'].background_saves = True
+		app['snapshot_task'] = asyncio.ensure_future(snapshot_scheduler(app))
+		app['sync_task'] = asyncio.ensure_future(journal_syncer(app))
+
+	# build the search index now rather than on the first search
+	app['statefile'].load_search()
+	app['lag_task'] = asyncio.ensure_future(monitor_loop_lag(app))
+
+
+async def stop_background_tasks(app):
+	"""Stop periodic tasks and leave the bus when the server shuts down."""
+
+	if 'snapshot_task' in app:
+		app['snapshot_task'].cancel()
+		app['sync_task'].cancel()
+		app['statefile'].background_saves = False
+
+	if app['expiry_timer'] is not None:
+		app['expiry_timer'].cancel()
+
+	if app['batch_timer'] is not None:
+		app['batch_timer'].cancel()
+		flush_batch(app)
+
+	app['lag_task'].cancel()
+
+	await app['bus'].stop()
+
+
 def shutdown(app):
 	"""Handler called during graceful shutdown sequence."""
 
+	app['statefile'].stop_journal()
 	app['statefile'].save()
 
 
@@ -55,17 +209,46 @@ async def render_index(request):
 			'all_url': app.router['all'].url_for(),
 			'info_url': app.router['info'].url_for(),
 			'undo_url': app.router['undo'].url_for(),
+			'upload_url': app.router['uploads'].url_for(),
+			'blob_url': app.router['blobs'].canonical,
+			'blob_threshold': config.BLOB_THRESHOLD,
 			'title': config.TITLE,
 			'nicknames': config.NICKNAMES,
 	}
 
 
-@aiohttp_jinja2.template('all.html')
 async def render_all(request):
-	"""Return "Open all as page" page."""
+	"""Return "Open all as page" page.
+
+	The page is streamed as it is rendered so the first bytes go out straight away and
+	the complete HTML never has to be held in memory. It is gzipped if the client accepts
+	that."""
 
 	app = request.app
-	return {'slots': app['statefile'].slots}
+	# copy the list of references in case slots change while we are sending
+	slots = list(app['statefile'].slots.values())
+	template = aiohttp_jinja2.get_env(app).get_template('all.html')
+
+	response = web.StreamResponse()
+	response.content_type = 'text/html'
+	response.charset = 'utf-8'
+	if config.COMPRESS_ALL:
+		response.enable_compression()
+
+	await response.prepare(request)
+	pending = []
+	size = 0
+	for text in template.generate(slots=slots):
+		pending.append(text)
+		size += len(text)
+		if size >= config.STREAM_CHUNK:
+			await response.write(''.join(pending).encode())
+			pending = []
+			size = 0
+
+	await response.write(''.join(pending).encode())
+	await response.write_eof()
+	return response
 
 
 @aiohttp_jinja2.template('info.html')
@@ -73,20 +256,97 @@ async def render_info(request):
 	"""Return server Info page."""
 
 	app = request.app
-	logger.debug('render info clients ' + str(app['clients']))
+	logger.debug('render info clients %s', app['clients'])
 	return {
 		'homepage': config.HOMEPAGE,
 		'version': config.VERSION,
-		'clients': app['hosts'].values(),
+		'clients': [{'host': app['hosts'][ws],
+					 'encoding': app['encodings'].get(ws, 'json'),
+					 'compressed': bool(ws.compress),
+					 'queued': app['queues'][ws].qsize()}
+					for ws in app['clients']],
+		'queue_length': config.SEND_QUEUE_LENGTH,
 		'messages': len(app['statefile'].slots),
 		'undos': len(app['statefile'].undos),
+		'snapshots': app['snapshot_stats'],
 	}
 
 
+async def render_metrics(request):
+	"""Return metrics in Prometheus text format."""
+
+	return web.Response(text=metrics.render(), content_type='text/plain')
+
+
+async def render_slots(request):
+	"""Return a page of slots as JSON, newest first.
+
+	Query parameters `before` (a cursor from a previous page) and `limit` select the
+	page. The response gives the `slots` and a `more` cursor for the next page, or null."""
+
+	slots, more = query_page(request)
+	return web.json_response({'slots': [s.to_dict() for s in slots], 'more': more})
+
+
+def query_page(request):
+	"""Return the page of slots and next cursor selected by the `before` and `limit`
+	query parameters of `request`."""
+
+	try:
+		limit = int(request.query.get('limit', config.PAGE_SIZE))
+
+	except ValueError:
+		raise web.HTTPBadRequest(text='Bad limit')
+
+	limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+	try:
+		return request.app['statefile'].page(before=request.query.get('before'), limit=limit)
+
+	except ValueError:
+		raise web.HTTPBadRequest(text='Bad cursor')
+
+
+async def render_search(request):
+	"""Return slots matching query parameter `q` as JSON, best match first.
+
+	Each word of the query matches words in the slot text, clipboard or nickname
+	beginning with it. `limit` sets the most results returned."""
+
+	try:
+		limit = int(request.query.get('limit', config.SEARCH_LIMIT))
+
+	except ValueError:
+		raise web.HTTPBadRequest(text='Bad limit')
+
+	limit = max(1, min(limit, config.MAX_PAGE_SIZE))
+	slots = request.app['statefile'].search(request.query.get('q', ''), limit)
+	return web.json_response({'slots': [s.to_dict() for s in slots]})
+
+
+async def send_search(app, ws, query):
+	"""Send a client the slots matching `query`."""
+
+	send_frame(app, ws, json.dumps({'type': 'search',
+									'q': query,
+									'slots': [s.to_dict() for s in app['statefile'].search(query)]}))
+
+
+async def send_page(app, ws, before):
+	"""Send a client the page of slots following cursor `before`, raising ValueError if
+	it is not a valid cursor."""
+
+	slots, more = app['statefile'].page(before=before)
+	# not named seq, which marks a change to the board for clients
+	send_frame(app, ws, json.dumps({'type': 'page',
+									'at_seq': app['statefile'].seq,
+									'slots': [s.to_dict() for s in slots],
+									'more': more}))
+
+
 async def render_undo(request):
 	"""A client requests undo delete."""
 
-	await undo_delete(request.app)
+	await request.app['bus'].command({'type': 'undo'})
 	return web.Response(text='')
 
 
@@ -97,7 +357,15 @@ def is_url(url):
 
 
 async def add_slot(app, nickname, text, host):
-	"""Create a new slot in response to a client posting a new message."""
+	"""Create a new slot in response to a client posting a new message, returning it.
+
+	A message over `config.BLOB_THRESHOLD` characters is moved to the blob store."""
+
+	if len(text) > config.BLOB_THRESHOLD:
+		data = text.encode()
+		digest = await asyncio.get_event_loop().run_in_executor(None, app['blobs'].put, data)
+		return await add_blob_slot(app, nickname, text[:config.BLOB_PREVIEW], digest,
+								   len(data), host)
 
 	if is_url(text):
 		show_text = '<a href="{text}" target="_blank">{text}</a>'.format(text=text)
@@ -108,137 +376,530 @@ async def add_slot(app, nickname, text, host):
 		clipboard = None
 
 	# prepare the new slot as a data structure ...
-	new_slot = {'uid': binascii.hexlify(uuid.uuid4().bytes).decode(),
-				'timestamp': datetime_to_iso8601(datetime.datetime.utcnow()),
-				'nickname': nickname,
-				'text': show_text,
-				'clipboard': clipboard,
-				'source': host}
-	app['statefile'].slots.append(new_slot)
+	new_slot = make_slot(nickname, show_text, clipboard, host)
+	# ... and pass it to the process which stores it and tells all clients
+	await app['bus'].command({'type': 'post', 'slot': new_slot})
+	return new_slot
 
-	# ... and message to send to all clients
-	message = {'type': 'new_slot'}
-	message.update(new_slot)
-	await broadcast(app, message)
 
+async def add_blob_slot(app, nickname, preview, digest, size, host):
+	"""Create a new slot showing `preview` of the `size` byte message in blob `digest`."""
 
-async def broadcast(app, message):
-	"""Take a message structure and broadcast to all active clients."""
+	new_slot = make_slot(nickname, preview, None, host)
+	new_slot['blob'] = digest
+	new_slot['size'] = size
+	await app['bus'].command({'type': 'post', 'slot': new_slot})
+	return new_slot
 
-	logger.debug('Broadcasting message {m}'.format(m=message))
-	for ws in app['clients']:
-		logger.debug('    to {c}'.format(c=str(id(ws))))
-		await ws.send_json(message)
 
+def make_slot(nickname, text, clipboard, host):
+	"""Return a new slot dictionary."""
 
-async def welcome_client(app, ws):
-	"""Welcome a new client by sending all current slots to them."""
+	return {'uid': binascii.hexlify(uuid.uuid4().bytes).decode(),
+			'timestamp': datetime_to_iso8601(datetime.datetime.utcnow()),
+			'nickname': nickname,
+			'text': text,
+			'clipboard': clipboard,
+			'source': host}
 
-	logger.debug('Welcoming {ws} with {s} initial messages'.format(
-		ws=id(ws), s=len(app['statefile'].slots)))
-	for s in app['statefile'].slots:
-		message = {'type': 'new_slot'}
-		message.update(s)
-		await ws.send_json(message)
 
+async def begin_upload(request):
+	"""Start a chunked upload of a large message.
 
-async def delete_slot(app, uid):
-	"""Respond to a client request to delete a slot.
+	The client then PUTs each chunk of the UTF-8 encoded message to the upload URL
+	with its byte `offset`, and finally POSTs to the upload URL with its `nickname` to
+	post the message."""
 
-	Remove it from the internal list then broadcast the change to all clients,
-	including the originator."""
+	upload = request.app['blobs'].begin_upload()
+	return web.json_response({'upload': upload,
+							  'url': str(request.app.router['upload'].url_for(upload=upload)),
+							  'chunk': config.UPLOAD_CHUNK})
 
-	state = app['statefile']
-	state.delete_slot(uid)
-	await broadcast(app,
-			  {'type': 'delete_slot',
-			   'uid': uid})
 
+async def upload_chunk(request):
+	"""Receive one chunk of an upload."""
 
-async def undo_delete(app):
-	"""Pop the last entry from app undos, add to current messages and inform clients."""
+	try:
+		offset = int(request.query.get('offset', 0))
 
-	state = app['statefile']
+	except ValueError:
+		raise web.HTTPBadRequest(text='Bad offset')
 
-	if len(state.undos) > 0:
-		logger.info('Undo')
-		bless = state.undos.pop(0)
-		state.slots.insert(0, bless)
-		message = {'type': 'new_slot'}
-		message.update(bless)
-		await broadcast(app, message)
+	data = await request.read()
+	try:
+		received = request.app['blobs'].append(request.match_info['upload'], offset, data)
 
-	else:
-		logger.info('No messages to undo')
+	except UploadError as exc:
+		raise web.HTTPConflict(text=str(exc))
 
+	return web.json_response({'received': received})
 
-async def websocket_handler(request):
-	"""Client requests a WebSocket for 2-way updates."""
+
+async def finish_upload(request):
+	"""Store a completed upload as a blob and post it as a new message."""
 
 	app = request.app
+	blobs = app['blobs']
+	nickname = (await request.post()).get('nickname', '')
+	loop = asyncio.get_event_loop()
+	try:
+		digest, size = await loop.run_in_executor(
+			None, blobs.finish_upload, request.match_info['upload'])
+
+	except UploadError as exc:
+		raise web.HTTPConflict(text=str(exc))
+
+	# a character takes at most 4 bytes and a cut multibyte sequence is dropped
+	head = await loop.run_in_executor(None, blobs.read, digest, config.BLOB_PREVIEW * 4)
+	preview = head.decode(errors='ignore')[:config.BLOB_PREVIEW]
+	new_slot = await add_blob_slot(app, nickname, preview, digest, size, request.host)
+	return web.json_response({'uid': new_slot['uid'], 'blob': digest, 'size': size})
+
+
+async def render_blob(request):
+	"""Return the full text of a message stored as a blob.
+
+	Blobs never change so may be cached forever, and Range requests are supported for
+	fetching part of one."""
+
+	digest = request.match_info['digest']
+	blobs = request.app['blobs']
+	if not blobs.exists(digest):
+		raise web.HTTPNotFound()
+
+	return web.FileResponse(blobs.path(digest),
+							headers={'Content-Type': 'text/plain; charset=utf-8',
+									 'Cache-Control': 'public, max-age=31536000, immutable'})
+
+
+async def execute(app, command):
+	"""Apply a client command to the statefile and send the change to every client.
+
+	Only runs in the process owning the statefile, which may have received the command
+	over the bus from another process."""
+
 	state = app['statefile']
-	ws = web.WebSocketResponse()
-	logger.info('New client {ip} requests a socket giving {ws}'.format(ip=request.host, ws=id(ws)))
+	kind = command['type']
+	# changes from a command making many at once, sent before `frame`
+	frames = []
+	if kind == 'post':
+		frame = state.add_slot(command['slot'])
 
-	await ws.prepare(request)
-	app['clients'].append(ws)
-	logger.debug('clients length ' + str(len(app['clients'])))
-	app['hosts'][ws] = request.host
+	elif kind == 'import':
+		frames = state.import_slots(command['slots'])
+		frame = None
 
-	async for msg in ws:
-		if msg.type == WSMsgType.TEXT:
-			if msg.data == 'close':
-				await ws.close()
+	elif kind == 'delete':
+		frame = state.delete_slot(command['uid'])
+
+	elif kind == 'delete_many':
+		frame = state.delete_slots(command['uids'])
+
+	elif kind == 'delete_all':
+		frame = state.delete_slots(list(state.slots))
+
+	elif kind == 'undo':
+		frame = state.undo_delete()
+		if frame is None:
+			logger.info('No messages to undo')
+
+		else:
+			logger.info('Undo')
+
+	elif kind == 'empty_undo':
+		frame = state.empty_undo()
+
+	elif kind == 'expire':
+		frame = None
+
+	else:
+		logger.error('Unknown command {t}'.format(t=kind))
+		frame = None
+
+	# anything over the retention limits goes as a change of its own, after the one
+	# which caused it
+	for frame in frames + [frame, state.expire()]:
+		if frame is not None:
+			await app['bus'].publish(state.epoch, frame)
+			await broadcast_frame(app, frame)
+
+	schedule_expiry(app)
+
+
+def schedule_expiry(app):
+	"""Set a timer to expire the oldest slot when it passes `config.RETAIN_AGE`."""
+
+	if app['expiry_timer'] is not None:
+		app['expiry_timer'].cancel()
+
+	delay = app['statefile'].next_expiry()
+	if delay is None:
+		app['expiry_timer'] = None
+
+	else:
+		# a little late so the slot has certainly expired when we look
+		app['expiry_timer'] = asyncio.get_event_loop().call_later(
+			delay + 0.01, lambda: asyncio.ensure_future(execute(app, {'type': 'expire'})))
+
+
+async def broadcast_frame(app, frame):
+	"""Queue an already encoded message for all active clients.
+
+	This never waits for a client, so one slow or stuck socket cannot hold up delivery to
+	the others.
+
+	With `config.BATCH_WINDOW` set, a change arriving after a quiet spell is sent straight
+	away and opens a window. Further changes made during the window are sent together as
+	a single `batch` message when it closes, and a new window opens while changes keep
+	coming."""
+
+	if config.BATCH_WINDOW <= 0:
+		fan_out(app, frame)
+
+	elif app['batch_timer'] is None:
+		fan_out(app, frame)
+		app['batch_timer'] = asyncio.get_event_loop().call_later(
+			config.BATCH_WINDOW, flush_batch, app)
+
+	else:
+		app['batch'].append(frame)
+
+	# let writers start sending before any further broadcast
+	await asyncio.sleep(0)
+
+
+def flush_batch(app):
+	"""Send the changes gathered during a batch window."""
+
+	frames = app['batch']
+	if len(frames) == 0:
+		app['batch_timer'] = None
+		return
+
+	app['batch'] = []
+	if len(frames) == 1:
+		fan_out(app, frames[0])
+
+	else:
+		metrics.BATCH_SIZE.observe(len(frames))
+		fan_out(app, '{"type": "batch", "messages": [' + ', '.join(frames) + ']}')
+
+	app['batch_timer'] = asyncio.get_event_loop().call_later(config.BATCH_WINDOW, flush_batch, app)
+
+
+def fan_out(app, frame):
+	"""Queue `frame` for every client."""
+
+	clients = app['clients']
+	if len(clients) > 0:
+		start = time.perf_counter()
+		for ws in list(clients):
+			send_frame(app, ws, frame)
+
+		metrics.BROADCAST_SECONDS.observe(time.perf_counter() - start)
+
+
+@functools.lru_cache(maxsize=64)
+def encode_binary(frame):
+	"""Convert JSON text `frame` to MessagePack.
+
+	Cached so a frame sent to many clients, or a snapshot sent until the state next
+	changes, is only converted once."""
+
+	return msgpack.packb(json.loads(frame))
+
+
+def send_frame(app, ws, frame):
+	"""Queue JSON text `frame` to be sent to a single client, in the encoding it chose.
+
+	If the client's queue is full it has fallen too far behind. Depending on
+	`config.SEND_OVERFLOW` its queue is replaced by a snapshot of the current state, or
+	it is disconnected and will resync when it reconnects."""
+
+	queue = app['queues'].get(ws)
+	if queue is None:
+		return
+
+	binary = ws in app['encodings']
+	if binary:
+		frame = encode_binary(frame)
+
+	try:
+		queue.put_nowait(frame)
+
+	except asyncio.QueueFull:
+		if config.SEND_OVERFLOW == 'resync':
+			logger.warning('Client {ws} send queue full, resyncing'.format(ws=id(ws)))
+			metrics.WS_RESYNCS.inc()
+			while not queue.empty():
+				queue.get_nowait()
+
+			frame = app['statefile'].snapshot_frame()
+			queue.put_nowait(encode_binary(frame) if binary else frame)
+
+		else:
+			logger.warning('Client {ws} send queue full, evicting'.format(ws=id(ws)))
+			evict_client(app, ws)
+			return
+
+	metrics.SEND_QUEUE_DEPTH.observe(queue.qsize())
+
+
+async def write_client(app, ws, queue):
+	"""Send queued frames to client `ws` one at a time until it goes away.
+
+	Each frame must be accepted within `config.SEND_TIMEOUT` seconds or the client is
+	evicted. The deadline is a plain timer rather than `asyncio.wait_for`, which would
+	start a task per frame and so let a burst of broadcasts outpace even fast clients."""
+
+	loop = asyncio.get_event_loop()
+	# cancellation when the client is dropped can be lost if it coincides with a send
+	# completing, so also stop once our queue is no longer in use
+	while app['queues'].get(ws) is queue:
+		frame = await queue.get()
+		timer = loop.call_later(config.SEND_TIMEOUT, send_timeout, app, ws)
+		try:
+			if isinstance(frame, bytes):
+				await ws.send_bytes(frame)
 
 			else:
-				logger.info('Got the message {msg}'.format(msg=msg.data))
-				msg_struct = msg.json()
+				await ws.send_str(frame)
+
+		except Exception as exc:  # pylint: disable=broad-except
+			logger.warning('Send to client {ws} failed ({exc}), evicting'.format(ws=id(ws), exc=exc))
+			evict_client(app, ws)
+			return
+
+		finally:
+			timer.cancel()
+
+
+def send_timeout(app, ws):
+	"""Evict client `ws` which has not accepted a frame in time."""
+
+	logger.warning('Client {ws} did not accept message within {t}s, evicting'.format(
+		ws=id(ws), t=config.SEND_TIMEOUT))
+	evict_client(app, ws)
+
+
+def add_client(app, ws, host):
+	"""Start sending to new client `ws` through its own queue and writer task."""
+
+	app['clients'].append(ws)
+	app['hosts'][ws] = host
+	queue = asyncio.Queue(maxsize=config.SEND_QUEUE_LENGTH)
+	app['queues'][ws] = queue
+	app['writers'][ws] = asyncio.ensure_future(write_client(app, ws, queue))
+
+
+def drop_client(app, ws):
+	"""Forget about client `ws`, discarding anything queued for it. Safe to call more
+	than once.
+
+	Returns True if the client was still known."""
+
+	if ws in app['hosts']:
+		app['clients'].remove(ws)
+		del app['hosts'][ws]
+		del app['queues'][ws]
+		app['encodings'].pop(ws, None)
+		app['writers'].pop(ws).cancel()
+		return True
+
+	return False
+
 
-				if msg_struct['type'] == 'helo':
-					await welcome_client(app, ws)
+def evict_client(app, ws):
+	"""Stop sending to client `ws` and close its socket in the background."""
 
-				elif msg_struct['type'] == 'post':
-					await add_slot(app=app,
-							 nickname=msg_struct['nickname'],
-							 text=msg_struct['message'],
-							 host=request.host)
+	if drop_client(app, ws):
+		metrics.WS_EVICTIONS.inc()
 
-				elif msg_struct['type'] == 'delete':
-					await delete_slot(app, msg_struct['uid'])
+	asyncio.ensure_future(ws.close())
 
-				elif msg_struct['type'] == 'delete_all':
-					for uid in list(s['uid'] for s in state.slots):
-						await delete_slot(app, uid)
 
-				elif msg_struct['type'] == 'empty_undo':
-					state.empty_undo()
+async def welcome_client(app, ws, epoch=None, seq=None):
+	"""Welcome a new or reconnecting client.
 
-				elif msg.type == WSMsgType.ERROR:
-					logger.error('WebSocket closed: {exc}'.format(exc=ws.exception()))
+	A client which gives the `epoch` and `seq` of the last change it saw is sent just the
+	changes since then, as a single `batch` message. Otherwise, or if those changes are no
+	longer held, all current slots are sent as one snapshot."""
 
-				else:
-					logger.error('Unkwown message {t}'.format(t=msg_struct['type']))
+	state = app['statefile']
+	if epoch is not None and seq is not None:
+		frames = state.changes_since(epoch, seq)
+		if frames is not None:
+			logger.debug('Resyncing %s with %s changes', id(ws), len(frames))
+			if len(frames) > 0:
+				send_frame(app, ws, '{"type": "batch", "messages": [' + ', '.join(frames) + ']}')
+
+			return
+
+	logger.debug('Welcoming %s with %s initial messages', id(ws), len(state.slots))
+	send_frame(app, ws, state.snapshot_frame())
+
+
+async def reset_clients(app):
+	"""Disconnect all clients after our copy of the state has been replaced, so they
+	reconnect and resync against it."""
+
+	for ws in list(app['clients']):
+		evict_client(app, ws)
+
+
+def check_message(message):
+	"""Raise ValueError unless `message` is a client message we can act on."""
+
+	if not isinstance(message, dict) or message.get('type') not in MESSAGE_TYPES:
+		raise ValueError('Unknown message')
+
+	for name, kind, required in MESSAGE_FIELDS.get(message['type'], ()):
+		if (required or message.get(name) is not None) and \
+		   not isinstance(message.get(name), kind):
+			raise ValueError('{t} message {n} must be a {k}'.format(
+				t=message['type'], n=name, k=kind.__name__))
+
+
+def send_error(app, ws, message, text):
+	"""Tell client `ws` that `message`, which may not have been decoded, failed."""
+
+	error = {'type': 'error', 'message': text}
+	if isinstance(message, dict) and message.get('ref') is not None:
+		error['ref'] = message['ref']
+
+	send_frame(app, ws, json.dumps(error))
+
+
+async def handle_message(request, ws, message):
+	"""Act on a single message from client `ws`."""
+
+	app = request.app
+	# a client pipelining requests gives each a ref and is told when it is done
+	ack = {'type': 'ack', 'ref': message.get('ref')}
+	if message['type'] == 'helo':
+		if message.get('encoding') in ENCODINGS:
+			app['encodings'][ws] = message['encoding']
+
+		await welcome_client(app, ws, epoch=message.get('epoch'), seq=message.get('seq'))
+
+	elif message['type'] == 'page':
+		await send_page(app, ws, message.get('before'))
+
+	elif message['type'] == 'search':
+		await send_search(app, ws, message.get('q') or '')
+
+	elif message['type'] == 'post':
+		new_slot = await add_slot(app=app,
+								  nickname=message['nickname'],
+								  text=message['message'],
+								  host=request.host)
+		ack['uid'] = new_slot['uid']
+
+	elif message['type'] == 'delete':
+		await app['bus'].command({'type': 'delete', 'uid': message['uid']})
+
+	elif message['type'] in ('delete_all', 'empty_undo'):
+		await app['bus'].command({'type': message['type']})
+
+	if ack['ref'] is not None:
+		send_frame(app, ws, json.dumps(ack))
+
+
+async def websocket_handler(request):
+	"""Client requests a WebSocket for 2-way updates.
+
+	A message which cannot be understood is answered with an `error` message, giving
+	its `ref` if it had one, and the connection stays open."""
+
+	app = request.app
+	ws = web.WebSocketResponse(compress=config.WS_COMPRESS)
+	logger.info('New client {ip} requests a socket giving {ws}'.format(ip=request.host, ws=id(ws)))
+
+	await ws.prepare(request)
+	metrics.WS_CONNECTS.inc()
+	add_client(app, ws, request.host)
+	logger.debug('clients length %s', len(app['clients']))
+
+	try:
+		async for msg in ws:
+			if msg.type == WSMsgType.ERROR:
+				logger.error('WebSocket closed: {exc}'.format(exc=ws.exception()))
+
+			elif msg.type != WSMsgType.TEXT:
+				continue
+
+			elif msg.data == 'close':
+				await ws.close()
+
+			else:
+				logger.debug('Got the message %s', msg.data)
+				start = time.perf_counter()
+				message = None
+				try:
+					message = msg.json()
+					check_message(message)
+
+				except ValueError as exc:
+					logger.warning('Bad message from {ws}: {e}'.format(ws=id(ws), e=exc))
+					send_error(app, ws, message, str(exc))
+					metrics.MESSAGE_SECONDS.labels('unknown').observe(time.perf_counter() - start)
+					continue
+
+				try:
+					await handle_message(request, ws, message)
+
+				except (BusError, ValueError) as exc:
+					# the request was not carried out so the client must not be told it was
+					logger.warning('Cannot handle message from {ws}: {e}'.format(
+						ws=id(ws), e=exc))
+					send_error(app, ws, message, str(exc))
+
+				metrics.MESSAGE_SECONDS.labels(message['type']).observe(
+					time.perf_counter() - start)
+
+	finally:
+		logger.info('WebSocket {ws} closed'.format(ws=id(ws)))
+		metrics.WS_DISCONNECTS.inc()
+		drop_client(app, ws)
 
-	logger.info('WebSocket {ws} closed'.format(ws=id(ws)))
-	app['clients'].remove(ws)
-	del app['hosts'][ws]
 	return web.Response(text='')
 
 
-def serve(port, prefix, statefile, debug=True):
+def serve(port, prefix, statefile, debug=True, bus=None, reuse_port=False):
 	"""Run webserver.
 
 	Args:
 		`port` (int): TCP port to listen on
 		`statefile` (Statefile): Persistent state of messages and undo queue
 		`debug` (bool): Run web server in debug mode with more verbose error traces
+		`bus` (LocalBus or BrokerBus): Connection to other server processes sharing the
+			state, if any. If we are not the owner `statefile` is an in-memory replica
+		`reuse_port` (bool): Allow other server processes to listen on the same port
 	"""
 
-	if debug:
-		middlewares = [aiohttp_debugtoolbar.toolbar_middleware_factory]
+	app = create_app(prefix=prefix, statefile=statefile, debug=debug, bus=bus)
+	atexit.register(shutdown, app=app)
+	logger.info('Starting server on port {p} prefix {pr}'.format(p=port, pr=prefix))
+	web.run_app(app, port=port, reuse_port=reuse_port)
 
-	else:
-		middlewares = None
+
+@web.middleware
+async def bus_errors(request, handler):
+	"""Answer a request whose change could not be passed to the owner with a 503."""
+
+	try:
+		return await handler(request)
+
+	except BusError as exc:
+		raise web.HTTPServiceUnavailable(text=str(exc))
+
+
+def create_app(prefix, statefile, debug=False, bus=None):
+	"""Return the web application, with arguments as for `serve`."""
+
+	middlewares = [bus_errors]
+	if debug:
+		middlewares.append(aiohttp_debugtoolbar.toolbar_middleware_factory)
 
 	app = web.Application(middlewares=middlewares)
 
@@ -251,15 +912,47 @@ def serve(port, prefix, statefile, debug=True):
 	# current clients
 	app['clients'] = []
 	app['hosts'] = {}
+	# outbound message queue and the task sending from it for each client
+	app['queues'] = {}
+	app['writers'] = {}
+	# binary encoding chosen by each client which asked for one, others are sent JSON
+	app['encodings'] = {}
+	# changes waiting for the current batch window to close, and its timer
+	app['batch'] = []
+	app['batch_timer'] = None
+	# timer for the next slot to expire by age
+	app['expiry_timer'] = None
 
 	# persistent state
 	app['statefile'] = statefile
+	app['bus'] = bus or LocalBus()
+	app['blobs'] = BlobStore(config.BLOB_DIR)
+	app['blobs'].init()
+	app['snapshot_stats'] = {'count': 0,
+							 'duration': None,
+							 'stall': None,
+							 'max_stall': 0.0,
+							 'bytes': None}
+	metrics.CLIENTS.set_function(lambda: len(app['clients']))
+	metrics.SEND_QUEUED.set_function(lambda: sum(q.qsize() for q in app['queues'].values()))
+	metrics.SLOTS.set_function(lambda: len(app['statefile'].slots))
+	metrics.UNDOS.set_function(lambda: len(app['statefile'].undos))
+	app.on_startup.append(start_background_tasks)
+	app.on_cleanup.append(stop_background_tasks)
 
 	app.router.add_get(prefix + '', render_index)
 	app.router.add_get(prefix + '/all', render_all, name='all')
 	app.router.add_get(prefix + '/info', render_info, name='info')
 	app.router.add_get(prefix + '/ws', websocket_handler, name='ws')
 	app.router.add_get(prefix + '/undo', render_undo, name='undo')
+	app.router.add_get(prefix + '/slots', render_slots, name='slots')
+	app.router.add_get(prefix + '/search', render_search, name='search')
+	app.router.add_get(prefix + '/metrics', render_metrics, name='metrics')
+	app.router.add_post(prefix + '/upload', begin_upload, name='uploads')
+	app.router.add_put(prefix + '/upload/{upload}', upload_chunk, name='upload')
+	app.router.add_post(prefix + '/upload/{upload}', finish_upload)
+	app.router.add_get(prefix + '/blobs/{digest}', render_blob, name='blobs')
+	api.add_routes(app, prefix + '/api')
 	app.router.add_static(prefix + '/static',
 						  config.STATIC_ROOT,
 						  show_index=True,
@@ -267,6 +960,4 @@ def serve(port, prefix, statefile, debug=True):
 						  name='static')
 
 	aiohttp_jinja2.setup(app, loader=jinja2.PackageLoader('shareclip', 'templates'))
-	atexit.register(shutdown, app=app)
-	logger.info('Starting server on port {p} prefix {pr}'.format(p=port, pr=prefix))
-	web.run_app(app, port=port)
+	return app
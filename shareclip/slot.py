@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""Compact in memory form of a slot.
+
+Slots are sent to clients and stored as JSON objects with keys `uid` (32 hex digits),
+`timestamp` (ISO 8601 text), `nickname`, `text`, `clipboard`, `source` and for large
+messages `blob` and `size`. Held as dicts a large board spends most of its memory on the
+dicts themselves and on the uid and timestamp strings, so in memory a Slot keeps the uid
+as 16 bytes, the timestamp as integer microseconds and shares one copy of each nickname
+and source. Slots are converted with `Slot.from_dict` and `Slot.to_dict` where they
+enter and leave the Statefile."""
+
+import re
+import sys
+import datetime
+
+from shareclip import codec
+from shareclip.blobs import DIGEST
+
+# Zero point of integer timestamps. Timestamps are naive UTC
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Uids accepted from outside, usually 32 hex digits but imported boards may have others
+UID_PATTERN = re.compile(r'[0-9A-Za-z_.:-]{1,64}')
+
+
+def pack_uid(uid):
+	"""Return the compact key for `uid`: 16 bytes for the usual 32 lower case hex digits,
+	otherwise `uid` unchanged. Keys are passed through unchanged too."""
+
+	if isinstance(uid, str) and len(uid) == 32:
+		try:
+			key = bytes.fromhex(uid)
+
+		except ValueError:
+			return uid
+
+		if key.hex() == uid:
+			return key
+
+	return uid
+
+
+def unpack_uid(key):
+	"""Return the uid string for key `key`."""
+
+	if isinstance(key, bytes):
+		return key.hex()
+
+	return key
+
+
+def pack_time(timestamp):
+	"""Return ISO 8601 `timestamp` as integer microseconds since `EPOCH`."""
+
+	when = datetime.datetime.fromisoformat(timestamp)
+	if when.tzinfo is not None:
+		when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+	delta = when - EPOCH
+	return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def unpack_time(stamp):
+	"""Return integer timestamp `stamp` in ISO 8601 form."""
+
+	return (EPOCH + datetime.timedelta(microseconds=stamp)).isoformat()
+
+
+def check_uid(uid):
+	"""Raise ValueError unless `uid` is a valid uid string."""
+
+	if not isinstance(uid, str) or UID_PATTERN.fullmatch(uid) is None:
+		raise ValueError('Bad uid {u!r}'.format(u=uid))
+
+
+def check(slot):
+	"""Raise ValueError unless `slot` is the JSON form of a slot."""
+
+	if not isinstance(slot, dict):
+		raise ValueError('Slot is not an object')
+
+	for name in ('uid', 'timestamp', 'text'):
+		if not isinstance(slot.get(name), str):
+			raise ValueError('Slot {n} is not a string'.format(n=name))
+
+	for name in ('nickname', 'clipboard', 'source'):
+		if slot.get(name) is not None and not isinstance(slot[name], str):
+			raise ValueError('Slot {n} is not a string or null'.format(n=name))
+
+	# the digest is used in file names and URLs, so must be exactly that
+	if slot.get('blob') is not None:
+		if not isinstance(slot['blob'], str) or DIGEST.fullmatch(slot['blob']) is None:
+			raise ValueError('Slot blob is not a digest')
+
+		size = slot.get('size')
+		if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+			raise ValueError('Slot size is not a byte count')
+
+	check_uid(slot['uid'])
+	# only UTC is stored, so a time zone would be lost
+	if datetime.datetime.fromisoformat(slot['timestamp']).tzinfo is not None:
+		raise ValueError('Slot timestamp has a time zone, give it in UTC without one')
+
+
+def decode_lines(lines, first=1):
+	"""Return the slots in newline delimited JSON `lines`, numbered from `first`, in
+	their JSON form with any missing optional fields filled in. Blank lines are skipped.
+	Raises ValueError giving the line number of a bad slot.
+
+	Timestamps are kept to the microsecond and given back in `datetime.isoformat` form,
+	so one with a zero fraction of a second or a space between date and time is exported
+	differently from how it was imported."""
+
+	slots = []
+	for number, line in enumerate(lines, first):
+		if len(line.strip()) == 0:
+			continue
+
+		try:
+			slot = codec.loads(line)
+			check(slot)
+
+		except ValueError as exc:
+			raise ValueError('Line {n}: {e}'.format(n=number, e=exc))
+
+		plain = {'uid': slot['uid'],
+				 'timestamp': slot['timestamp'],
+				 'nickname': slot.get('nickname'),
+				 'text': slot['text'],
+				 'clipboard': slot.get('clipboard'),
+				 'source': slot.get('source')}
+		if slot.get('blob') is not None:
+			plain['blob'] = slot['blob']
+			plain['size'] = slot.get('size')
+
+		slots.append(plain)
+
+	return slots
+
+
+def intern(name):
+	"""Return the shared copy of nickname or source `name`, which may be None."""
+
+	if name is None:
+		return None
+
+	return sys.intern(name)
+
+
+class Slot():
+	"""A single message.
+
+	Fields can also be read by their JSON name as `slot['uid']`, giving the same values
+	as the dict form. Slots are never modified once created, see `replace`."""
+
+	__slots__ = ('key', 'stamp', 'nickname', 'text', 'clipboard', 'source', 'blob', 'size')
+
+	# JSON names of the fields
+	FIELDS = frozenset(('uid', 'timestamp', 'nickname', 'text', 'clipboard', 'source', 'blob',
+						'size'))
+
+	def __init__(self, key, stamp, nickname, text, clipboard, source, blob=None, size=None):
+		# packed uid, see `pack_uid`
+		self.key = key
+		# microseconds since `EPOCH`
+		self.stamp = stamp
+		self.nickname = intern(nickname)
+		self.text = text
+		self.clipboard = clipboard
+		self.source = intern(source)
+		# digest and byte length of the full message if `text` is only a preview of it
+		self.blob = blob
+		self.size = size
+
+	@classmethod
+	def from_dict(cls, slot):
+		"""Make a Slot from its JSON form."""
+
+		return cls(pack_uid(slot['uid']),
+				   pack_time(slot['timestamp']),
+				   slot.get('nickname'),
+				   slot['text'],
+				   slot.get('clipboard'),
+				   slot.get('source'),
+				   slot.get('blob'),
+				   slot.get('size'))
+
+	def to_dict(self):
+		"""Return the JSON form of this slot."""
+
+		result = {'uid': unpack_uid(self.key),
+				  'timestamp': unpack_time(self.stamp),
+				  'nickname': self.nickname,
+				  'text': self.text,
+				  'clipboard': self.clipboard,
+				  'source': self.source}
+		if self.blob is not None:
+			result['blob'] = self.blob
+			result['size'] = self.size
+
+		return result
+
+	def replace(self, changes):
+		"""Return a copy with the fields in dict `changes`, by JSON name, replaced."""
+
+		return Slot.from_dict(dict(self.to_dict(), **changes))
+
+	@property
+	def uid(self):
+		"""Unique id as a string."""
+
+		return unpack_uid(self.key)
+
+	@property
+	def timestamp(self):
+		"""Creation time as ISO 8601 text."""
+
+		return unpack_time(self.stamp)
+
+	def __getitem__(self, name):
+		if name not in Slot.FIELDS:
+			raise KeyError(name)
+
+		return getattr(self, name)
+
+	def __eq__(self, other):
+		if not isinstance(other, Slot):
+			return NotImplemented
+
+		return all(getattr(self, name) == getattr(other, name) for name in Slot.__slots__)
+
+	def __hash__(self):
+		# equal slots have the same uid
+		return hash(self.key)
+
+	def __repr__(self):
+		return 'Slot({d!r})'.format(d=self.to_dict())
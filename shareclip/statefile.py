@@ -3,117 +3,708 @@
 """Implementation of Statefile class."""
 
 import json
+import time
+import uuid
+import datetime
+import bisect
 import logging
-from collections import namedtuple
+import itertools
+from operator import attrgetter
+from collections import deque
+from collections import OrderedDict
 
 from shareclip import config
+from shareclip import storage
+from shareclip import metrics
+from shareclip import search
+from shareclip.slot import Slot
+from shareclip.slot import pack_uid
+from shareclip.slot import unpack_uid
+from shareclip.slot import pack_time
+from shareclip.slot import unpack_time
+from shareclip.slot import check_uid
 
 logger = logging.getLogger('statefile')
 
-# not used.
-# To use it we'd need a function to convert one of these to a json message
-# Slot = namedtuple('Slot', 'uid timestamp text clipboard nickname source')
+
+def slot_key(slot):
+	"""Sort key for paging through slots in time order.
+
+	Keys of `slots` are bytes, or str for uids which do not pack (see `slot.pack_uid`).
+	The middle flag puts str keys after bytes keys of the same time so keys of the two
+	types are never compared. The slot key is always last."""
+
+	return (slot.stamp, isinstance(slot.key, str), slot.key)
+
+
+def slot_size(slot):
+	"""Bytes of message content in a slot, counted against `config.RETAIN_BYTES`.
+
+	Plain ASCII text is not encoded to find its UTF-8 length."""
+
+	text = slot.text
+	size = len(text) if text.isascii() else len(text.encode())
+	if slot.clipboard is not None:
+		size += len(slot.clipboard.encode())
+
+	return size
+
+
+def encode_cursor(key):
+	"""Convert a slot key to a cursor string for clients."""
+
+	return '{t}_{u}'.format(t=unpack_time(key[0]), u=unpack_uid(key[-1]))
+
+
+def decode_cursor(cursor):
+	"""Convert a client cursor string back to a slot key, raising ValueError if it is
+	not a valid cursor."""
+
+	if not isinstance(cursor, str):
+		raise ValueError('Cursor is not a string')
+
+	# timestamps never contain '_' but uids may
+	timestamp, _, uid = cursor.partition('_')
+	check_uid(uid)
+	key = pack_uid(uid)
+	return (pack_time(timestamp), isinstance(key, str), key)
 
 
 class Statefile():
 	"""Handle the persistent state file."""
 
-	# set a version identifier in our statefile so we can detect attempt to load an older version
-	VERSION = 1
-
-	def __init__(self, filename):
+	def __init__(self, filename, backend=None, load=True):
 		self.filename = filename
+		# Storage backend persisting our state
+		self.storage = storage.BACKENDS[backend or config.STORAGE](filename)
+		# current Slots in display order, by packed uid (see `slot.pack_uid`)
 		self.slots = None
+		# sorted keys of all slots for paging and expiry, or None while loading
+		self.order = None
+		# total `slot_size` of all slots
+		self.bytes = 0
+		# words of all slots for searching, or None until the first search
+		self.search_index = None
+		# deleted slots, most recent first
 		self.undos = None
-
-		if self.filename.exists():
+		# token identifying this run of the change log. Clients resyncing against a
+		# different epoch get a full snapshot
+		self.epoch = None
+		# sequence number of the most recent change
+		self.seq = 0
+		# encoded messages for the most recent changes, ending with `seq`
+		self.changes = deque(maxlen=config.CHANGE_LOG_LENGTH)
+		# encoded `snapshot` message of all slots, or None if it needs rebuilding
+		self.snapshot = None
+		# number of changes since the last snapshot was started
+		self.dirty = 0
+		# set while a server saves us in the background, which then also compacts the
+		# journal, otherwise a large journal is compacted straight away
+		self.background_saves = False
+		# set when storage has asked for a save to compact its journal
+		self.compact = False
+
+		if load:
 			self.load()
 
 		else:
 			self.init()
 
 	def load(self):
-		"""Load state from statefile."""
-
-		elem = json.load(self.filename.open())
-
-		if elem['version'] != Statefile.VERSION:
-			logger.warning('Loading statefile from different version')
+		"""Replace our state with that in storage. The search index is only loaded when
+		first needed."""
 
-		self.slots = elem['slots']
-		self.undos = elem['undos']
-
-		logger.info('Loaded statefile {s} with {m} messages {u} undos'.format(
-			s=self.filename, m=len(self.slots), u=len(self.undos)))
+		self.init()
+		self.order = None
+		self.storage.load(self)
+		self.reindex()
+		self.reset_changes()
 
 	def init(self):
 		"""Create a blank state."""
 
 		logger.info('Initialising new state')
-		self.slots = []
-		self.undos = []
+		self.slots = OrderedDict()
+		self.undos = deque(maxlen=config.UNDO_QUEUE_LENGTH)
+		self.order = []
+		self.bytes = 0
+		self.search_index = None
+		self.reset_changes()
 
 	def save(self, suffix=None):
-		"""Save ourselves to statefile."""
+		"""Save ourselves to storage.
 
-		statedir = self.filename.parent
-		if not statedir.exists():
-			logger.info('Creating dir {s}'.format(s=statedir))
-			statedir.mkdir()
+		For a JSON statefile this also folds in and removes any journals, and if running
+		in journal mode starts a fresh one. If `suffix` is given just write a backup
+		copy."""
 
-		if suffix is None:
-			filename = self.filename
+		if suffix is not None:
+			self.storage.backup(self, suffix)
 
 		else:
-			filename = self.filename.with_suffix(suffix)
+			self.write_snapshot(self.begin_snapshot())
+			if self.search_index is not None and self.search_filename() is not None:
+				search.write_index(self.search_filename(), self.search_index)
+
+	def begin_snapshot(self):
+		"""Start a save, returning a snapshot to pass to `write_snapshot` or None if there
+		is nothing to write.
 
-		json.dump(
-			{
-				'version': Statefile.VERSION,
-				'slots': self.slots,
-				'undos': self.undos,
-			},
-			filename.open('w'),
-			indent=2)
+		This is the only part of a save which has to run on the thread making changes."""
 
-		logger.info('Saved state to {s}'.format(s=filename))
+		self.dirty = 0
+		self.compact = False
+		return self.storage.begin_snapshot(self)
+
+	def write_snapshot(self, snapshot):
+		"""Finish a save. Safe to call from a worker thread. Returns bytes written."""
+
+		if snapshot is None:
+			return 0
+
+		start = time.perf_counter()
+		size = self.storage.write_snapshot(snapshot)
+		metrics.SAVE_SECONDS.observe(time.perf_counter() - start)
+		metrics.SAVE_BYTES.set(size)
+		return size
+
+	def import_state(self, other):
+		"""Replace our state with that of Statefile `other`, writing all of it to
+		storage."""
+
+		self.init()
+		self.slots.update(other.slots)
+		self.undos.extend(other.undos)
+		self.reindex()
+		self.storage.replace(self)
 
 	def delete(self):
 		"""Remove existing statefile."""
 
-		if self.filename.exists():
-			logger.info('Removing existing statefile {s}'.format(s=self.filename))
-			self.filename.unlink()
+		self.storage.delete()
+		if self.search_filename() is not None and self.search_filename().exists():
+			self.search_filename().unlink()
+
+	def start_journal(self):
+		"""Switch to journal mode, recording each change as it is made."""
+
+		self.storage.start_journal()
+
+	def stop_journal(self):
+		"""Flush and close the journal."""
+
+		self.storage.stop_journal()
+
+	def sync_journal(self):
+		"""Force journalled changes to disk if they have waited long enough."""
+
+		self.storage.sync_journal()
+
+	def record(self, record):
+		"""Pass a change to storage, saving if it asks for that."""
+
+		self.dirty += 1
+		if self.storage.record(record):
+			if self.background_saves:
+				self.compact = True
+
+			else:
+				logger.info('Compacting journal')
+				self.save()
+
+	def apply(self, record):
+		"""Replay a single change read from a journal.
+
+		Records are dicts with an `op` of `add` (with the new `slot`), `import` (with a
+		list of new `slots`), `delete` or `expire` (with a list of `uids`), `undo` (with
+		the `uid` restored), `empty_undo` or `update` (with the `uid` and a dict of
+		`changes`)."""
+
+		op = record['op']
+		if op == 'add':
+			if pack_uid(record['slot']['uid']) not in self.slots:
+				self.insert_slot(Slot.from_dict(record['slot']))
+
+		elif op == 'import':
+			for slot in record['slots']:
+				if pack_uid(slot['uid']) not in self.slots:
+					self.insert_slot(Slot.from_dict(slot))
+
+		elif op == 'delete':
+			for uid in record['uids']:
+				self.remove_slot(uid)
+
+		elif op == 'undo':
+			self.restore_slot(record['uid'])
+
+		elif op == 'empty_undo':
+			self.undos.clear()
+
+		elif op == 'expire':
+			for uid in record['uids']:
+				self.discard_slot(uid)
+
+		elif op == 'update':
+			slot = self.slots.get(pack_uid(record['uid']))
+			if slot is not None:
+				self.replace_slot(slot, record['changes'])
 
 		else:
-			logger.info('Not removing statefile as no existing file found')
+			logger.error('Unknown journal record {r}'.format(r=record))
+
+	def replica_state(self):
+		"""Return everything a replica in another process needs to start following our
+		changes."""
+
+		return {'epoch': self.epoch,
+				'seq': self.seq,
+				'slots': [s.to_dict() for s in self.slots.values()],
+				'undos': [s.to_dict() for s in self.undos]}
+
+	def load_replica(self, state):
+		"""Replace our state with one from `replica_state` of the owning Statefile."""
+
+		self.init()
+		self.slots.update((s.key, s) for s in map(Slot.from_dict, state['slots']))
+		self.undos.extend(map(Slot.from_dict, state['undos']))
+		self.reindex()
+		self.epoch = state['epoch']
+		self.seq = state['seq']
+
+	def follow(self, epoch, frame):
+		"""Apply a change made by the owning Statefile, given as the encoded message it
+		sent to its clients, so our change log stays in step with the owner's.
+
+		A `new_slot` is either a new post or an undo, depending on whether we hold the
+		slot in our undo queue."""
+
+		message = json.loads(frame)
+		kind = message['type']
+		if kind == 'new_slot':
+			if self.restore_slot(message['uid']) is None and \
+			   pack_uid(message['uid']) not in self.slots:
+				self.insert_slot(Slot.from_dict(message))
+
+		elif kind == 'delete_slot':
+			self.remove_slot(message['uid'])
+
+		elif kind == 'delete_many' and message.get('expired'):
+			for uid in message['uids']:
+				self.discard_slot(uid)
+
+		elif kind == 'delete_many':
+			self.remove_slots(message['uids'])
+
+		elif kind == 'empty_undo':
+			self.undos.clear()
+
+		else:
+			logger.error('Unknown change {t}'.format(t=kind))
+
+		if epoch != self.epoch:
+			self.epoch = epoch
+			self.changes.clear()
+
+		self.seq = message['seq']
+		self.changes.append(frame)
+		self.snapshot = None
+
+	def blob_digests(self):
+		"""Return the set of blobs referred to by slots or undos."""
+
+		return set(s.blob for s in itertools.chain(self.slots.values(), self.undos)
+				   if s.blob is not None)
 
 	def show_messages(self):
 		"""List stored messages to terminal."""
 
-		for m in self.slots:
-			print(m)
+		for m in self.slots.values():
+			print(m.to_dict())
 
 	def show_undo(self):
 		"""List undo queue to terminal."""
 
 		for u in self.undos:
-			print(u)
+			print(u.to_dict())
+
+	def reset_changes(self):
+		"""Start a new epoch with an empty change log."""
+
+		self.epoch = uuid.uuid4().hex
+		self.changes.clear()
+		self.snapshot = None
+
+	def log_change(self, message):
+		"""Stamp `message` with the next sequence number and add it to the change log.
+
+		Returns the message encoded as JSON text."""
+
+		self.seq += 1
+		message['seq'] = self.seq
+		frame = json.dumps(message)
+		self.changes.append(frame)
+		self.snapshot = None
+		return frame
+
+	def changes_since(self, epoch, seq):
+		"""Return the encoded messages for all changes after `seq`.
+
+		Returns None if the client is from a different epoch or the change log no longer
+		reaches back to `seq`, in which case the client needs a full snapshot."""
+
+		if epoch != self.epoch or seq > self.seq or seq < self.seq - len(self.changes):
+			return None
+
+		return list(itertools.islice(self.changes, len(self.changes) - (self.seq - seq), None))
+
+	def snapshot_frame(self):
+		"""Return a `snapshot` message holding all current slots as JSON text.
+
+		The encoding is cached until the state next changes."""
+
+		if self.snapshot is None:
+			slots, more = self.page()
+			self.snapshot = json.dumps({'type': 'snapshot',
+										'epoch': self.epoch,
+										'seq': self.seq,
+										'slots': [s.to_dict() for s in slots],
+										'more': more})
+
+		return self.snapshot
+
+	def reindex(self):
+		"""Rebuild the time ordered index of slots, and their total size."""
+
+		slots = self.slots.values()
+		self.order = sorted(zip(map(attrgetter('stamp'), slots),
+								map(isinstance, self.slots, itertools.repeat(str)),
+								self.slots))
+		self.bytes = sum(map(slot_size, slots))
+
+	def search_filename(self):
+		"""Return where the search index is saved, or None if it is not."""
+
+		if self.filename is None:
+			return None
+
+		return self.filename.with_name(self.filename.name + '.search')
+
+	def index_search(self, saved=None):
+		"""Rebuild the search index, reusing a `saved` one where it is still valid."""
+
+		index = search.SearchIndex()
+		index.build(self.slots.values(), saved)
+		self.search_index = index
+
+	def load_search(self):
+		"""Build the search index if not done yet, reusing the saved one if possible."""
+
+		if self.search_index is not None:
+			return
+
+		saved = None
+		if self.search_filename() is not None:
+			saved = search.read_index(self.search_filename())
+
+		self.index_search(saved)
+
+	def search(self, query, limit=None):
+		"""Return up to `limit` slots matching `query`, best first.
+
+		Every word of the query must match the start of a word of the slot. Equally good
+		matches are returned newest first. Returns Slots."""
+
+		self.load_search()
+		return [self.slots[uid]
+				for uid in self.search_index.search(query, limit or config.SEARCH_LIMIT)]
+
+	def page(self, before=None, limit=None):
+		"""Return a page of slots in time order, newest first.
+
+		Gives up to `limit` Slots older than cursor `before`, or the newest slots if it is
+		None, and a cursor for the following page or None if there are no older slots.
+		Raises ValueError if `before` is not a valid cursor."""
+
+		if limit is None:
+			limit = config.PAGE_SIZE
+
+		if before is None:
+			end = len(self.order)
+
+		else:
+			end = bisect.bisect_left(self.order, decode_cursor(before))
+
+		start = max(0, end - limit)
+		slots = [self.slots[key[-1]] for key in reversed(self.order[start:end])]
+		if start > 0:
+			return slots, encode_cursor(self.order[start])
+
+		else:
+			return slots, None
+
+	def insert_slot(self, slot):
+		"""Add `slot` to the end of the slots and the paging index."""
+
+		self.slots[slot.key] = slot
+		self.bytes += slot_size(slot)
+		if self.order is not None:
+			key = slot_key(slot)
+			if len(self.order) == 0 or key > self.order[-1]:
+				self.order.append(key)
+
+			else:
+				bisect.insort(self.order, key)
+
+			if self.search_index is not None:
+				self.search_index.add(slot)
+
+	def replace_slot(self, slot, changes):
+		"""Replace `slot` with a copy with `changes` applied."""
+
+		new_slot = slot.replace(changes)
+		self.slots[slot.key] = new_slot
+		self.bytes += slot_size(new_slot) - slot_size(slot)
+		if self.search_index is not None:
+			self.search_index.add(new_slot)
+
+		if self.order is not None:
+			if slot_key(new_slot) != slot_key(slot):
+				self.reindex()
+
+	def encode_slot(self, slot):
+		"""Log a `new_slot` change for `slot` and return the encoded message.
+
+		The slot is serialised once here and the same text is sent to every client and
+		kept in the change log for resyncing clients."""
+
+		message = {'type': 'new_slot'}
+		message.update(slot.to_dict())
+		return self.log_change(message)
+
+	def add_slot(self, slot):
+		"""Append a new slot, given in JSON form, and return its encoded `new_slot`
+		message."""
+
+		self.insert_slot(Slot.from_dict(slot))
+		self.record({'op': 'add', 'slot': slot})
+		message = {'type': 'new_slot'}
+		message.update(slot)
+		return self.log_change(message)
+
+	def import_slots(self, slots):
+		"""Append slots, given in JSON form, skipping any whose uid we already hold in
+		the slots or undo queue. They are recorded as a single change.
+
+		Returns the encoded `new_slot` messages for the slots added."""
+
+		undone = set(s.key for s in self.undos)
+		added = []
+		for slot in slots:
+			key = pack_uid(slot['uid'])
+			if key not in self.slots and key not in undone:
+				self.insert_slot(Slot.from_dict(slot))
+				added.append(slot)
+
+		if len(added) == 0:
+			return []
+
+		self.record({'op': 'import', 'slots': added})
+		frames = []
+		for slot in added:
+			message = {'type': 'new_slot'}
+			message.update(slot)
+			frames.append(self.log_change(message))
+
+		return frames
+
+	def export_lines(self):
+		"""Return an iterator giving each slot in display order as a line of JSON, which
+		`slot.decode_lines` reads back.
+
+		The slots are taken when this is called so changes made while the lines are being
+		written do not affect them."""
+
+		slots = list(self.slots.values())
+		return (json.dumps(slot.to_dict()) + '\n' for slot in slots)
+
+	def update_slot(self, slot, **changes):
+		"""Rewrite fields of an existing slot.
+
+		The slot is replaced rather than modified so snapshot copies being written in the
+		background are unaffected. Logged changes may hold the old content so a new epoch
+		is started, making any resyncing client fetch a full snapshot."""
+
+		self.replace_slot(slot, changes)
+		self.record({'op': 'update', 'uid': slot.uid, 'changes': changes})
+		self.reset_changes()
+
+	def undo_delete(self):
+		"""Move the most recent undo back to the slots.
+
+		Returns the encoded `new_slot` message for the restored slot, or None if the undo
+		queue is empty."""
+
+		if len(self.undos) == 0:
+			return None
+
+		slot = self.restore_slot(self.undos[0].key)
+		self.record({'op': 'undo', 'uid': slot.uid})
+		return self.encode_slot(slot)
+
+	def restore_slot(self, uid):
+		"""Move a slot from the undo queue to the front of the slots, returning it."""
+
+		key = pack_uid(uid)
+		for slot in self.undos:
+			if slot.key == key:
+				self.undos.remove(slot)
+				self.slots[key] = slot
+				self.slots.move_to_end(key, last=False)
+				self.bytes += slot_size(slot)
+				if self.order is not None:
+					bisect.insort(self.order, slot_key(slot))
+
+				if self.search_index is not None:
+					self.search_index.add(slot)
+
+				return slot
+
+		return None
+
+	def remove_slot(self, uid):
+		"""Move a slot to the front of the undo queue, returning False if it was not found.
+
+		The oldest undo is discarded if the queue is full."""
+
+		slot = self.discard_slot(uid)
+		if slot is None:
+			return False
+
+		self.undos.appendleft(slot)
+		return True
+
+	def discard_slot(self, uid):
+		"""Remove a slot without keeping it for undo, returning it or None if it was not
+		found."""
+
+		slot = self.slots.pop(pack_uid(uid), None)
+		if slot is None:
+			return None
+
+		self.bytes -= slot_size(slot)
+		if self.search_index is not None:
+			self.search_index.remove(slot.key)
+
+		if self.order is not None:
+			del self.order[bisect.bisect_left(self.order, slot_key(slot))]
+
+		return slot
+
+	def remove_slots(self, uids):
+		"""Move several slots to the undo queue, returning the uids which were found.
+
+		`uids` may be uid strings or keys of `slots`, uid strings are returned."""
+
+		# for large deletes filter the paging index once instead of per slot
+		order = self.order
+		if len(uids) > config.BULK_DELETE_REINDEX:
+			self.order = None
+
+		deleted = [unpack_uid(uid) for uid in uids if self.remove_slot(uid)]
+		if order is not None and self.order is None:
+			self.order = [key for key in order if key[-1] in self.slots]
+
+		return deleted
 
 	def delete_slot(self, uid):
-		"""Remove entry from normal queue and insert to undo queue."""
-
-		for s in self.slots:
-			if s['uid'] == uid:
-				self.slots.remove(s)
-				self.undos.insert(0, s)
-				logging.info('Removed slot {uid} remaining {slots} undos {undos}'.format(
-					uid=uid, slots=len(self.slots), undos=len(self.undos)))
-				if len(self.undos) > config.UNDO_QUEUE_LENGTH:
-					self.undos = self.undos[:config.UNDO_QUEUE_LENGTH]
-					logging.info('Trimmed undo queue length to {max}'.format(
-						max=config.UNDO_QUEUE_LENGTH))
+		"""Remove entry from normal queue and insert to undo queue.
+
+		`uid` may be a uid string or a key of `slots`. Returns the encoded `delete_slot`
+		message, or None if `uid` was not found."""
+
+		uid = unpack_uid(uid)
+		if not self.remove_slot(uid):
+			return None
+
+		self.record({'op': 'delete', 'uids': [uid]})
+		logging.info('Removed slot {uid} remaining {slots} undos {undos}'.format(
+			uid=uid, slots=len(self.slots), undos=len(self.undos)))
+		return self.log_change({'type': 'delete_slot', 'uid': uid})
+
+	def delete_slots(self, uids):
+		"""Remove several entries to the undo queue as a single change.
+
+		Returns the encoded `delete_many` message, or None if none of `uids` were found."""
+
+		deleted = self.remove_slots(uids)
+		if len(deleted) == 0:
+			return None
+
+		self.record({'op': 'delete', 'uids': deleted})
+		logging.info('Removed {d} slots remaining {slots} undos {undos}'.format(
+			d=len(deleted), slots=len(self.slots), undos=len(self.undos)))
+		return self.log_change({'type': 'delete_many', 'uids': deleted})
+
+	def expire(self):
+		"""Drop the oldest slots until the retention limits `config.RETAIN_SLOTS`,
+		`config.RETAIN_BYTES` and `config.RETAIN_AGE` are met.
+
+		The paging index is already sorted oldest first so only the slots being dropped
+		are looked at. Expired slots do not go to the undo queue. Returns the encoded
+		`delete_many` message, or None if nothing expired."""
+
+		if self.order is None:
+			return None
+
+		excess = 0
+		if config.RETAIN_SLOTS is not None:
+			excess = len(self.slots) - config.RETAIN_SLOTS
+
+		over = 0
+		if config.RETAIN_BYTES is not None:
+			over = self.bytes - config.RETAIN_BYTES
+
+		cutoff = -1
+		if config.RETAIN_AGE is not None:
+			cutoff = pack_time((datetime.datetime.utcnow() -
+								datetime.timedelta(seconds=config.RETAIN_AGE)).isoformat())
+
+		count = 0
+		while count < len(self.order) and \
+			  (count < excess or over > 0 or self.order[count][0] < cutoff):
+			over -= slot_size(self.slots[self.order[count][-1]])
+			count += 1
+
+		if count == 0:
+			return None
+
+		keys = [key[-1] for key in self.order[:count]]
+		del self.order[:count]
+		for key in keys:
+			self.bytes -= slot_size(self.slots.pop(key))
+			if self.search_index is not None:
+				self.search_index.remove(key)
+
+		uids = [unpack_uid(key) for key in keys]
+		self.record({'op': 'expire', 'uids': uids})
+		logging.info('Expired {e} slots remaining {slots}'.format(e=len(uids), slots=len(self.slots)))
+		return self.log_change({'type': 'delete_many', 'uids': uids, 'expired': True})
+
+	def next_expiry(self):
+		"""Return seconds until the oldest slot passes `config.RETAIN_AGE`, or None if no
+		slot will expire by age."""
+
+		if config.RETAIN_AGE is None or not self.order:
+			return None
+
+		oldest = datetime.datetime.fromisoformat(unpack_time(self.order[0][0]))
+		expires = oldest + datetime.timedelta(seconds=config.RETAIN_AGE)
+		return max(0.0, (expires - datetime.datetime.utcnow()).total_seconds())
 
 	def empty_undo(self):
+		"""Discard the undo queue, returning the encoded `empty_undo` message."""
+
 		logging.info('Removing {u} undo slots'.format(u=len(self.undos)))
-		self.undos = []
+		self.undos.clear()
+		self.record({'op': 'empty_undo'})
+		return self.log_change({'type': 'empty_undo'})
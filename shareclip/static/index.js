@@ -47,6 +47,18 @@ function show_time(time) {
 // websocket and message queue
 var ws = null;
 
+// distance in pixels from the bottom of the page at which we fetch more slots
+var page_margin = 800;
+
+// epoch and sequence number of the last change received, used to resync after a reconnect
+var last_epoch = null;
+var last_seq = null;
+
+// cursor for the next page of older slots, or null if we have them all
+var more_cursor = null;
+// true while waiting for a page
+var page_pending = false;
+
 function create_websocket() {
 	if ('WebSocket' in window) {
 		console.log('Looking for ws at ' + ws_url);
@@ -57,31 +69,46 @@ function create_websocket() {
 		catch(err) {
 			ws = new WebSocket('wss://' + ws_url);
 		}
+		ws.binaryType = 'arraybuffer';
 
 		ws.onopen = function() {
-			// console.log('pre set table');
-			docid('slot-table-placeholder').innerHTML =
-				'<table class="table table-bordered table-hover table-sm" id="slot-table">' +
-				'<thead class="thead-default">' +
-				'<tr>' +
-				'<th>Message</th>' +
-				'<th class="nick" style="width:5%">Sender</th>' +
-				'<th style="width:1%">Control</th>' +
-				'</tr>' +
-				'</thead>' +
-				'<tbody id="slots">' +
-				'</tbody>' +
-				'</table>';
-			// console.log('post set table');
-			websocket_send({type: 'helo'});
+			docid('connection-status').innerHTML = '';
+			page_pending = false;
+			// keep the existing table over a reconnect so only missed changes need fetching
+			if (docid('slot-table') === null) {
+				// console.log('pre set table');
+				docid('slot-table-placeholder').innerHTML =
+					'<table class="table table-bordered table-hover table-sm" id="slot-table">' +
+					'<thead class="thead-default">' +
+					'<tr>' +
+					'<th>Message</th>' +
+					'<th class="nick" style="width:5%">Sender</th>' +
+					'<th style="width:1%">Control</th>' +
+					'</tr>' +
+					'</thead>' +
+					'<tbody id="slots">' +
+					'</tbody>' +
+					'</table>';
+				// console.log('post set table');
+			}
+			// the server answers in MessagePack if it can, otherwise JSON text
+			websocket_send({type: 'helo',
+				epoch: last_epoch,
+				seq: last_seq,
+				encoding: 'msgpack'});
 		};
 
 		ws.onmessage = function(event) {
-			websocket_recv(JSON.parse(event.data));
+			if (typeof event.data === 'string') {
+				websocket_recv(JSON.parse(event.data));
+			}
+			else {
+				websocket_recv(msgpack_decode(event.data));
+			}
 		};
 
 		ws.onclose = function()	{
-			docid('slot-table-placeholder').innerHTML = '<div class="alert alert-danger" role="alert">' +
+			docid('connection-status').innerHTML = '<div class="alert alert-danger" role="alert">' +
 				'Connection to server lost' +
 				'<button class="btn" onclick="create_websocket()">Reconnect</button>' +
 				'</div>';
@@ -101,38 +128,285 @@ function websocket_send(message) {
 	ws.send(encoded);
 }
 
+// decode a MessagePack message from an ArrayBuffer
+function msgpack_decode(buffer) {
+	var view = new DataView(buffer);
+	var bytes = new Uint8Array(buffer);
+	var text = new TextDecoder();
+	var pos = 0;
+
+	function str(length) {
+		pos += length;
+		return text.decode(bytes.subarray(pos - length, pos));
+	}
+
+	function array(length) {
+		var result = new Array(length);
+		for (var i=0; i<length; i++) {
+			result[i] = value();
+		}
+		return result;
+	}
+
+	function map(length) {
+		var result = {};
+		for (var i=0; i<length; i++) {
+			var key = value();
+			result[key] = value();
+		}
+		return result;
+	}
+
+	function value() {
+		var type = bytes[pos++];
+		var result;
+		if (type < 0x80) { return type; }
+		if (type < 0x90) { return map(type & 0x0f); }
+		if (type < 0xa0) { return array(type & 0x0f); }
+		if (type < 0xc0) { return str(type & 0x1f); }
+		if (type >= 0xe0) { return type - 0x100; }
+		switch (type) {
+		case 0xc0: return null;
+		case 0xc2: return false;
+		case 0xc3: return true;
+		case 0xc4: pos += 1; return bytes.slice(pos, pos += view.getUint8(pos - 1));
+		case 0xc5: pos += 2; return bytes.slice(pos, pos += view.getUint16(pos - 2));
+		case 0xc6: pos += 4; return bytes.slice(pos, pos += view.getUint32(pos - 4));
+		case 0xca: result = view.getFloat32(pos); pos += 4; return result;
+		case 0xcb: result = view.getFloat64(pos); pos += 8; return result;
+		case 0xcc: result = view.getUint8(pos); pos += 1; return result;
+		case 0xcd: result = view.getUint16(pos); pos += 2; return result;
+		case 0xce: result = view.getUint32(pos); pos += 4; return result;
+		case 0xcf: result = Number(view.getBigUint64(pos)); pos += 8; return result;
+		case 0xd0: result = view.getInt8(pos); pos += 1; return result;
+		case 0xd1: result = view.getInt16(pos); pos += 2; return result;
+		case 0xd2: result = view.getInt32(pos); pos += 4; return result;
+		case 0xd3: result = Number(view.getBigInt64(pos)); pos += 8; return result;
+		case 0xd9: pos += 1; return str(view.getUint8(pos - 1));
+		case 0xda: pos += 2; return str(view.getUint16(pos - 2));
+		case 0xdb: pos += 4; return str(view.getUint32(pos - 4));
+		case 0xdc: pos += 2; return array(view.getUint16(pos - 2));
+		case 0xdd: pos += 4; return array(view.getUint32(pos - 4));
+		case 0xde: pos += 2; return map(view.getUint16(pos - 2));
+		case 0xdf: pos += 4; return map(view.getUint32(pos - 4));
+		}
+		throw new Error('Unsupported MessagePack type 0x' + type.toString(16));
+	}
+
+	return value();
+}
+
+// return a string which sorts slots in the same order as the server's page cursors
+function slot_key(msg) {
+	// the server leaves out the fraction of whole seconds, so pad to microseconds to
+	// keep every timestamp the same length
+	var stamp = msg.timestamp;
+	var dot = stamp.indexOf('.');
+	if (dot < 0) {
+		stamp += '.000000';
+	}
+	else {
+		stamp = stamp.padEnd(dot + 7, '0');
+	}
+	// the server stores the usual hex uids packed, and those sort first
+	var packed = /^[0-9a-f]{32}$/.test(msg.uid) ? '0' : '1';
+	return stamp + '_' + packed + msg.uid;
+}
+
+// build the table row for a slot
+function make_slot_row(msg) {
+	var new_slot = document.createElement('tr');
+	new_slot.dataset.uid = msg.uid;
+	new_slot.dataset.key = slot_key(msg);
+	new_slot.dataset.text = msg.text;
+	new_slot.dataset.clipboard = msg.clipboard;
+	// new_slot.dataset.source = msg.source;
+	// new_slot.dataset.timestamp = msg.timestamp;
+	var timestamp = new Date(msg.timestamp);
+	timestamp.setMilliseconds(0);
+	new_slot.dataset.timestamp = timestamp;
+	var text = msg.text;
+	if (msg.blob !== undefined) {
+		// only a preview is sent, the full message is fetched when wanted
+		new_slot.dataset.blob = msg.blob;
+		new_slot.dataset.size = msg.size;
+		text += '&hellip; <a href="' + blob_url.replace('{digest}', msg.blob) +
+			'" target="_blank">Full message (' + msg.size + ' bytes)</a>';
+	}
+	var innerHTML = '<td>' + text + '</td>' +
+		'<td class="nick">' + msg.nickname + '</td>' +
+		'<td><div class="btn-group" role="group">' +
+		'<button class="btn btn-info" onclick=' + "'" + 'open_info_modal("' + msg.uid + '"' +
+		")'>Info</button>" +
+		'<button class="btn" onclick=' + "'" + 'slot_to_clipboard("' + msg.uid + '"' +
+		")'>Copy</button>" +
+		'<button class="btn btn-warning" onclick=' + "'" + 'delete_click("' + msg.uid + '"' +
+		")'" + '>Delete</button>' +
+		'</div></td>';
+	// console.log('Pushing ' + innerHTML);
+	new_slot.innerHTML = innerHTML;
+	return new_slot;
+}
+
 // handle incoming structure over the WebSocket
 function websocket_recv(msg) {
-	console.log('recv ' + JSON.stringify(msg));
+	var slots = docid('slots');
+	if (msg.seq !== undefined) {
+		// a change made while a snapshot was on its way may also arrive after it
+		if (msg.type != 'snapshot' && last_seq !== null && msg.seq <= last_seq) {
+			return;
+		}
+		last_seq = msg.seq;
+	}
+
 	if (msg.type == 'new_slot') {
-		var new_slot = document.createElement('tr');
-		new_slot.dataset.uid = msg.uid;
-		new_slot.dataset.text = msg.text;
-		new_slot.dataset.clipboard = msg.clipboard;
-		// new_slot.dataset.source = msg.source;
-		// new_slot.dataset.timestamp = msg.timestamp;
-		var timestamp = new Date(msg.timestamp);
-		timestamp.setMilliseconds(0);
-		new_slot.dataset.timestamp = timestamp;
-		var innerHTML = '<td>' + msg.text + '</td>' +
-			'<td class="nick">' + msg.nickname + '</td>' +
-			'<td><div class="btn-group" role="group">' +
-			'<button class="btn btn-info" onclick=' + "'" + 'open_info_modal("' + msg.uid + '"' +
-			")'>Info</button>" +
-			'<button class="btn" onclick=' + "'" + 'slot_to_clipboard("' + msg.uid + '"' +
-			")'>Copy</button>" +
-			'<button class="btn btn-warning" onclick=' + "'" + 'delete_click("' + msg.uid + '"' +
-			")'" + '>Delete</button>' +
-			'</div></td>';
-		// console.log('Pushing ' + innerHTML);
-		new_slot.innerHTML = innerHTML;
-		var slots = docid('slots');
-		slots.insertBefore(new_slot, slots.firstChild);
+		console.log('recv ' + JSON.stringify(msg));
+		insert_slot_row(make_slot_row(msg));
+	}
+
+	else if (msg.type == 'snapshot') {
+		// replace the whole table in one go with the newest page of slots
+		console.log('recv snapshot of ' + msg.slots.length + ' slots');
+		last_epoch = msg.epoch;
+		slots.innerHTML = '';
+		page_pending = false;
+		append_page(msg);
+	}
+
+	else if (msg.type == 'page') {
+		console.log('recv page of ' + msg.slots.length + ' slots');
+		page_pending = false;
+		append_page(msg);
 	}
 
 	else if (msg.type == 'delete_slot') {
+		console.log('recv ' + JSON.stringify(msg));
 		delete_slot(msg.uid);
 	}
+
+	else if (msg.type == 'delete_many') {
+		console.log('recv delete of ' + msg.uids.length + ' slots');
+		delete_slots(msg.uids);
+	}
+
+	else if (msg.type == 'search') {
+		// ignore results for a query which has since been changed
+		if (msg.q == docid('search').value) {
+			show_search_results(msg.slots);
+		}
+	}
+
+	else if (msg.type == 'batch') {
+		// a burst of changes, or changes missed while disconnected
+		console.log('recv batch of ' + msg.messages.length + ' changes');
+		apply_batch(msg.messages);
+	}
+}
+
+// apply a list of changes with one pass over the table
+function apply_batch(messages) {
+	// rows to add by uid, and uids to remove, after the whole list is taken into account
+	var added = new Map();
+	var removed = new Set();
+	for (var i=0; i<messages.length; i++) {
+		var msg = messages[i];
+		if (msg.seq !== undefined) {
+			if (last_seq !== null && msg.seq <= last_seq) {
+				continue;
+			}
+			last_seq = msg.seq;
+		}
+
+		if (msg.type == 'new_slot') {
+			added.set(msg.uid, make_slot_row(msg));
+		}
+
+		else if (msg.type == 'delete_slot' || msg.type == 'delete_many') {
+			var uids = msg.type == 'delete_slot' ? [msg.uid] : msg.uids;
+			for (var j=0; j<uids.length; j++) {
+				added.delete(uids[j]);
+				removed.add(uids[j]);
+			}
+		}
+	}
+
+	remove_search_results(Array.from(removed));
+	var slotlist = docid('slots');
+	var rows = Array.from(slotlist.children).filter(function(row) {
+		if (removed.has(row.dataset.uid)) {
+			slotlist.removeChild(row);
+			return false;
+		}
+		return true;
+	});
+
+	// merge the new rows, newest first, into the remaining ones. A slot may already be
+	// shown if a page reply holding it overtook its change
+	var shown = new Set(rows.map(function(row) { return row.dataset.uid; }));
+	var fresh = Array.from(added.values()).filter(function(row) {
+		return !shown.has(row.dataset.uid);
+	}).sort(function(a, b) {
+		return a.dataset.key < b.dataset.key ? 1 : -1;
+	});
+	var r = 0;
+	for (var f=0; f<fresh.length; f++) {
+		while (r < rows.length && rows[r].dataset.key >= fresh[f].dataset.key) {
+			r++;
+		}
+		if (r < rows.length) {
+			slotlist.insertBefore(fresh[f], rows[r]);
+		}
+		// older than everything shown. If there are more pages it will turn up in one of them
+		else if (more_cursor === null) {
+			slotlist.appendChild(fresh[f]);
+		}
+	}
+}
+
+// insert a slot row in time order, newest at the top
+function insert_slot_row(row) {
+	var slots = docid('slots');
+	var rows = slots.children;
+	for (var i=0; i<rows.length; i++) {
+		// already shown, from a page reply which overtook this change
+		if (rows[i].dataset.uid == row.dataset.uid) {
+			return;
+		}
+		if (rows[i].dataset.key < row.dataset.key) {
+			slots.insertBefore(row, rows[i]);
+			return;
+		}
+	}
+
+	// older than everything shown. If there are more pages it will turn up in one of them
+	if (more_cursor === null) {
+		slots.appendChild(row);
+	}
+}
+
+// add a page of older slots to the bottom of the table in a single DOM update
+function append_page(msg) {
+	var rows = document.createDocumentFragment();
+	for (var i=0; i<msg.slots.length; i++) {
+		rows.appendChild(make_slot_row(msg.slots[i]));
+	}
+	docid('slots').appendChild(rows);
+	more_cursor = msg.more;
+	fetch_page_if_needed();
+}
+
+// ask for the next page of older slots if the user has scrolled near the bottom
+function fetch_page_if_needed() {
+	if (more_cursor === null || page_pending || ws === null || ws.readyState != 1) {
+		return;
+	}
+
+	var bottom = docid('slots-more').getBoundingClientRect().top;
+	if (bottom < window.innerHeight + page_margin) {
+		page_pending = true;
+		websocket_send({type: 'page',
+			before: more_cursor});
+	}
 }
 
 //
@@ -141,12 +415,17 @@ function websocket_recv(msg) {
 
 // Transfer content of message `uid` to desktop clipboard
 function slot_to_clipboard(uid) {
-	var slotlist = docid('slots');
-	var slots = slotlist.children;
+	var slots = slot_rows();
 	for(var i=0; i<slots.length; i++) {
 		if (uid == slots[i].dataset.uid) {
 			console.log('clipboard ' + slots[i].dataset.clipboard + ' type ' + typeof slots[i].dataset.clipboard);
-			if (slots[i].dataset.clipboard === 'null') {
+			if (slots[i].dataset.blob !== undefined) {
+				console.log('blob');
+				fetch(blob_url.replace('{digest}', slots[i].dataset.blob))
+					.then(function(response) { return response.text(); })
+					.then(function(text) { navigator.clipboard.writeText(text); });
+			}
+			else if (slots[i].dataset.clipboard === 'null') {
 				console.log('text');
 				string_to_clipboard(slots[i].dataset.text);
 			}
@@ -154,6 +433,7 @@ function slot_to_clipboard(uid) {
 				console.log('clip');
 				string_to_clipboard(slots[i].dataset.clipboard);
 			}
+			return;
 		}
 	}
 }
@@ -181,7 +461,7 @@ var info_modal = new RModal(
 
 // Pop up dialog with info on a single message
 function open_info_modal(uid) {
-	var slots = docid('slots').children;
+	var slots = slot_rows();
 	for(var i=0; i<slots.length; i++) {
 		var slot = slots[i];
 		if (uid == slot.dataset.uid) {
@@ -190,7 +470,11 @@ function open_info_modal(uid) {
 			// console.log(i);
 			// i.modal();
 			docid('info-modal-body').innerHTML = 'sent at ' + slot.dataset.timestamp;
+			if (slot.dataset.blob !== undefined) {
+				docid('info-modal-body').innerHTML += '<br>' + slot.dataset.size + ' bytes';
+			}
 			info_modal.open();
+			return;
 		}
 	}
 }
@@ -206,6 +490,55 @@ function delete_click(uid) {
 		uid: uid});
 }
 
+// all displayed slot rows, in the main table and the search results
+function slot_rows() {
+	return Array.from(docid('slots').children).concat(
+		Array.from(docid('search-slots').children));
+}
+
+// remove deleted slots from the search results
+function remove_search_results(uids) {
+	var doomed = new Set(uids);
+	var results = docid('search-slots');
+	var rows = Array.from(results.children);
+	for (var i=0; i<rows.length; i++) {
+		if (doomed.has(rows[i].dataset.uid)) {
+			results.removeChild(rows[i]);
+		}
+	}
+}
+
+//
+/// Search
+//
+
+// ask the server for slots matching the search box, shortly after typing stops
+var search_timer = null;
+function search_input() {
+	clearTimeout(search_timer);
+	search_timer = setTimeout(function() {
+		var query = docid('search').value;
+		if (query.trim().length == 0) {
+			docid('search-results').style.display = 'none';
+			docid('search-slots').innerHTML = '';
+			return;
+		}
+		websocket_send({type: 'search', q: query});
+	}, 150);
+}
+
+// replace the search results table
+function show_search_results(slots) {
+	var rows = document.createDocumentFragment();
+	for (var i=0; i<slots.length; i++) {
+		rows.appendChild(make_slot_row(slots[i]));
+	}
+	var results = docid('search-slots');
+	results.innerHTML = '';
+	results.appendChild(rows);
+	docid('search-results').style.display = '';
+}
+
 // handle message zapping a slot
 function delete_slot(uid) {
 	var slotlist = docid('slots');
@@ -218,6 +551,20 @@ function delete_slot(uid) {
 			slotlist.removeChild(slots[i]);
 		}
 	}
+	remove_search_results([uid]);
+}
+
+// handle message zapping several slots in a single pass over the table
+function delete_slots(uids) {
+	var doomed = new Set(uids);
+	var slotlist = docid('slots');
+	var slots = Array.from(slotlist.children);
+	for(var i=0; i<slots.length; i++) {
+		if (doomed.has(slots[i].dataset.uid)) {
+			slotlist.removeChild(slots[i]);
+		}
+	}
+	remove_search_results(uids);
 }
 
 //
@@ -296,6 +643,11 @@ function post_click() {
 	}
 	console.log('Sending new message');
 	var nickname = docid('nickname').value;
+	if (text.length > blob_threshold) {
+		upload_message(text, nickname);
+		docid('new-message').value = '';
+		return;
+	}
 	websocket_send({
 		type: 'post',
 		message: text,
@@ -304,6 +656,38 @@ function post_click() {
 	docid('new-message').value = '';
 }
 
+// post a large message over HTTP in chunks rather than over the websocket
+function upload_message(text, nickname) {
+	var data = new TextEncoder().encode(text);
+	console.log('Uploading ' + data.length + ' byte message');
+	fetch(upload_url, {method: 'POST'})
+		.then(function(response) { return response.json(); })
+		.then(function(upload) {
+			function send_chunk(offset) {
+				if (offset >= data.length) {
+					var form = new FormData();
+					form.append('nickname', nickname);
+					return fetch(upload.url, {method: 'POST', body: form});
+				}
+				var end = Math.min(offset + upload.chunk, data.length);
+				return fetch(upload.url + '?offset=' + offset,
+							 {method: 'PUT', body: data.subarray(offset, end)})
+					.then(function(response) {
+						if (!response.ok) {
+							throw new Error('Upload failed: ' + response.statusText);
+						}
+						return response.json();
+					})
+					.then(function(result) { return send_chunk(result.received); });
+			}
+			return send_chunk(0);
+		})
+		.catch(function(err) {
+			console.log(err);
+			alert('Could not post message: ' + err.message);
+		});
+}
+
 // empty the new post box
 function clear_message() {
 	console.log('Clearing new post');
@@ -342,6 +726,10 @@ document.addEventListener('DOMContentLoaded', function() {
 	// prep websocket for messages
 	create_websocket();
 
+	// load older slots as the user scrolls down
+	window.addEventListener('scroll', fetch_page_if_needed);
+	window.addEventListener('resize', fetch_page_if_needed);
+
 	// set up nickname box and button
 	nickname_init();
 
@@ -350,6 +738,7 @@ document.addEventListener('DOMContentLoaded', function() {
 	docid('post_clear').onclick = clear_message;
 	docid('new-message').addEventListener('keydown', new_post_key);
 	docid('undo').onclick = undo_click;
+	docid('search').addEventListener('input', search_input);
 
 	docid('delete_all').onclick = delete_all_click;
 	// docid('delete_all_confirm').onclick = delete_all_confirm;
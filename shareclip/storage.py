@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+
+"""Storage backends which persist the contents of a Statefile.
+
+A backend is told about each change as a journal record (see `Statefile.apply`) and
+is asked to load the whole state at startup. Backends provide:
+
+	`load(statefile)`: Fill the empty slots and undos of `statefile`
+	`record(record)`: Persist a single change. Returns True if the backend would like
+		a full save soon
+	`begin_snapshot(statefile)`: Start a full save, returning an opaque copy of the
+		state or None if no save is needed. Called on the thread making changes
+	`write_snapshot(snapshot)`: Finish a save started by `begin_snapshot`. Safe to call
+		from a worker thread. Returns bytes written
+	`replace(statefile)`: Overwrite everything stored with the state of `statefile`
+	`backup(statefile, suffix)`: Write a copy of the state alongside the normal file
+	`start_journal()`, `stop_journal()`: Begin and end recording individual changes
+	`sync_journal()`: Force recorded changes to disk if they have waited too long
+	`delete()`: Remove all stored state
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+from shareclip import config
+from shareclip import codec
+from shareclip.journal import Journal
+from shareclip.slot import Slot
+
+logger = logging.getLogger('storage')
+
+
+def dump_state(state, handle):
+	"""Write `state` to `handle` as compact JSON, with its `slots` and `undos` given as
+	Slots.
+
+	Slots are encoded a chunk at a time so a worker thread doing this does not hold the
+	GIL, and so stall the event loop, for the whole encoding."""
+
+	header = dict(state)
+	slots = header.pop('slots')
+	header['undos'] = [s.to_dict() for s in header['undos']]
+	handle.write(json.dumps(header, separators=(',', ':'))[:-1])
+	handle.write(',"slots":[')
+	for i in range(0, len(slots), config.SNAPSHOT_CHUNK):
+		if i > 0:
+			handle.write(',')
+
+		handle.write(json.dumps([s.to_dict() for s in slots[i:i + config.SNAPSHOT_CHUNK]],
+								separators=(',', ':'))[1:-1])
+
+	handle.write(']}')
+
+
+class JSONStorage():
+	"""Keep state in a single JSON statefile, plus in journal mode a journal of the
+	changes made since it was last written."""
+
+	# set a version identifier in our statefile so we can detect attempt to load an older version
+	VERSION = 1
+
+	def __init__(self, filename):
+		self.filename = filename
+		# the statefile holds all changes made before journal number `generation`
+		self.generation = 0
+		# current Journal, if running in journal mode
+		self.journal = None
+		# generation of the most recently written snapshot
+		self.saved_generation = 0
+		# serialise snapshot writes from worker threads
+		self.write_lock = threading.Lock()
+
+	def load(self, statefile):
+		"""Load state from statefile then replay any journals."""
+
+		if self.filename.exists():
+			elem = codec.loads(self.filename.read_bytes())
+
+			if elem['version'] != JSONStorage.VERSION:
+				logger.warning('Loading statefile from different version')
+
+			statefile.slots.update((s.key, s) for s in map(Slot.from_dict, elem['slots']))
+			statefile.undos.extend(map(Slot.from_dict, elem['undos']))
+			self.generation = elem.get('generation', 0)
+			self.saved_generation = self.generation
+
+			logger.info('Loaded statefile {s} with {m} messages {u} undos'.format(
+				s=self.filename, m=len(statefile.slots), u=len(statefile.undos)))
+
+		for generation, filename in self.journals():
+			if generation < self.generation:
+				# left over from a crash just after saving, already in the statefile
+				filename.unlink()
+				continue
+
+			journal = Journal(filename)
+			for record in journal.read():
+				statefile.apply(record)
+
+			logger.info('Replayed {r} changes from journal {j}'.format(
+				r=journal.records, j=filename))
+			self.generation = generation
+
+	def record(self, record):
+		"""Add `record` to the journal if there is one.
+
+		Asks for a save once the journal has grown large."""
+
+		if self.journal is None:
+			return False
+
+		self.journal.append(record)
+		return self.journal.records >= config.JOURNAL_COMPACT_RECORDS
+
+	def copy_state(self, statefile):
+		"""Return a copy of the state of `statefile` suitable for writing from another
+		thread.
+
+		Slots are never modified in place (`Statefile.update_slot` replaces them) so
+		copying the containers is enough."""
+
+		return {'version': JSONStorage.VERSION,
+				'generation': self.generation,
+				'slots': list(statefile.slots.values()),
+				'undos': list(statefile.undos)}
+
+	def begin_snapshot(self, statefile):
+		"""Start a new journal generation and return a copy of the state to pass to
+		`write_snapshot`."""
+
+		self.generation += 1
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = Journal(self.journal_filename(self.generation))
+			self.journal.open()
+
+		return self.copy_state(statefile)
+
+	def write_snapshot(self, snapshot, filename=None):
+		"""Write `snapshot` to the statefile, or to `filename` if given.
+
+		The file is written under a temporary name, synced and renamed into place so a
+		crash never leaves a partial statefile. Journals covered by the new statefile are
+		then removed. Returns the number of bytes written."""
+
+		with self.write_lock:
+			if filename is None:
+				if snapshot['generation'] <= self.saved_generation:
+					logger.info('Not saving as a newer state has already been written')
+					return 0
+
+				target = self.filename
+
+			else:
+				target = filename
+
+			statedir = target.parent
+			if not statedir.exists():
+				logger.info('Creating dir {s}'.format(s=statedir))
+				statedir.mkdir(parents=True)
+
+			temp = target.with_name(target.name + '.tmp')
+			with temp.open('w') as handle:
+				dump_state(snapshot, handle)
+				handle.flush()
+				os.fsync(handle.fileno())
+				size = handle.tell()
+
+			os.replace(str(temp), str(target))
+			dirfd = os.open(str(statedir), os.O_RDONLY)
+			try:
+				os.fsync(dirfd)
+
+			finally:
+				os.close(dirfd)
+
+			logger.info('Saved state to {s}'.format(s=target))
+			if filename is None:
+				self.saved_generation = snapshot['generation']
+				self.remove_journals(before=snapshot['generation'])
+
+			return size
+
+	def replace(self, statefile):
+		"""Write the whole state of `statefile`."""
+
+		self.write_snapshot(self.begin_snapshot(statefile))
+
+	def backup(self, statefile, suffix):
+		"""Write a copy of the state next to the statefile."""
+
+		self.write_snapshot(self.copy_state(statefile), self.filename.with_suffix(suffix))
+
+	def delete(self):
+		"""Remove existing statefile and journals."""
+
+		if self.filename.exists():
+			logger.info('Removing existing statefile {s}'.format(s=self.filename))
+			self.filename.unlink()
+
+		else:
+			logger.info('Not removing statefile as no existing file found')
+
+		self.remove_journals()
+
+	def journal_filename(self, generation):
+		"""Name of journal number `generation`."""
+
+		return self.filename.with_name('{name}.journal.{g}'.format(
+			name=self.filename.name, g=generation))
+
+	def journals(self):
+		"""Return a sorted list of (generation, filename) for all existing journals."""
+
+		result = []
+		prefix = self.filename.name + '.journal.'
+		for filename in self.filename.parent.glob(prefix + '*'):
+			generation = filename.name[len(prefix):]
+			if generation.isdigit():
+				result.append((int(generation), filename))
+
+		return sorted(result)
+
+	def remove_journals(self, before=None):
+		"""Delete journals older than generation `before`, or all of them."""
+
+		for generation, filename in self.journals():
+			if before is None or generation < before:
+				logger.info('Removing journal {j}'.format(j=filename))
+				filename.unlink()
+
+	def start_journal(self):
+		"""Switch to journal mode, recording each change as it is made."""
+
+		statedir = self.filename.parent
+		if not statedir.exists():
+			logger.info('Creating dir {s}'.format(s=statedir))
+			statedir.mkdir(parents=True)
+
+		self.journal = Journal(self.journal_filename(self.generation))
+		self.journal.open()
+
+	def stop_journal(self):
+		"""Flush and close the journal."""
+
+		if self.journal is not None:
+			self.journal.close()
+			self.journal = None
+
+	def sync_journal(self):
+		"""Sync the journal if records have waited `config.JOURNAL_FSYNC_INTERVAL`."""
+
+		if self.journal is not None:
+			self.journal.sync_due()
+
+
+class SQLiteStorage():
+	"""Keep state in an SQLite database in WAL mode, writing each change as it is made.
+
+	Slots and undos are kept in separate tables ordered by a `position` column, with the
+	full slot stored as JSON alongside indexed uid and timestamp columns."""
+
+	SCHEMA = '''
+CREATE TABLE IF NOT EXISTS slots (
+	position INTEGER PRIMARY KEY,
+	uid TEXT NOT NULL UNIQUE,
+	timestamp TEXT NOT NULL,
+	data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS slots_timestamp ON slots (timestamp, uid);
+CREATE TABLE IF NOT EXISTS undos (
+	position INTEGER PRIMARY KEY,
+	uid TEXT NOT NULL UNIQUE,
+	timestamp TEXT NOT NULL,
+	data TEXT NOT NULL);
+'''
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.conn = None
+
+	def connect(self):
+		"""Open the database, creating it if needed."""
+
+		if self.conn is not None:
+			return
+
+		statedir = self.filename.parent
+		if not statedir.exists():
+			logger.info('Creating dir {s}'.format(s=statedir))
+			statedir.mkdir(parents=True)
+
+		self.conn = sqlite3.connect(str(self.filename))
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.executescript(SQLiteStorage.SCHEMA)
+
+	def load(self, statefile):
+		"""Load slots and undos from the database."""
+
+		self.connect()
+		statefile.slots.update(
+			(s.key, s) for s in (Slot.from_dict(codec.loads(data)) for data, in
+								 self.conn.execute('SELECT data FROM slots ORDER BY position')))
+		statefile.undos.extend(
+			Slot.from_dict(codec.loads(data))
+			for data, in self.conn.execute('SELECT data FROM undos ORDER BY position DESC LIMIT ?',
+										   (config.UNDO_QUEUE_LENGTH,)))
+		logger.info('Loaded database {s} with {m} messages {u} undos'.format(
+			s=self.filename, m=len(statefile.slots), u=len(statefile.undos)))
+
+	def record(self, record):
+		"""Write a single change to the database."""
+
+		self.connect()
+		op = record['op']
+		with self.conn:
+			if op == 'add':
+				slot = record['slot']
+				self.conn.execute(
+					'INSERT OR IGNORE INTO slots (position, uid, timestamp, data) '
+					'VALUES ((SELECT IFNULL(MAX(position), 0) + 1 FROM slots), ?, ?, ?)',
+					(slot['uid'], slot['timestamp'], json.dumps(slot)))
+
+			elif op == 'import':
+				self.conn.executemany(
+					'INSERT OR IGNORE INTO slots (position, uid, timestamp, data) '
+					'VALUES ((SELECT IFNULL(MAX(position), 0) + 1 FROM slots), ?, ?, ?)',
+					((slot['uid'], slot['timestamp'], json.dumps(slot)) for slot in record['slots']))
+
+			elif op == 'delete':
+				for uid in record['uids']:
+					self.move(uid, 'slots', 'undos', 'IFNULL(MAX(position), 0) + 1')
+
+				self.conn.execute(
+					'DELETE FROM undos WHERE position <= '
+					'(SELECT position FROM undos ORDER BY position DESC LIMIT 1 OFFSET ?)',
+					(config.UNDO_QUEUE_LENGTH,))
+
+			elif op == 'undo':
+				self.move(record['uid'], 'undos', 'slots', 'IFNULL(MIN(position), 0) - 1')
+
+			elif op == 'empty_undo':
+				self.conn.execute('DELETE FROM undos')
+
+			elif op == 'expire':
+				self.conn.executemany('DELETE FROM slots WHERE uid = ?',
+									  ((uid,) for uid in record['uids']))
+
+			elif op == 'update':
+				row = self.conn.execute('SELECT data FROM slots WHERE uid = ?',
+										(record['uid'],)).fetchone()
+				if row is not None:
+					slot = json.loads(row[0])
+					slot.update(record['changes'])
+					self.conn.execute('UPDATE slots SET data = ? WHERE uid = ?',
+									  (json.dumps(slot), record['uid']))
+
+			else:
+				logger.error('Unknown change record {r}'.format(r=record))
+
+		return False
+
+	def move(self, uid, source, dest, position):
+		"""Move the row for `uid` from table `source` to table `dest` at `position`,
+		which is an SQL expression evaluated over `dest`."""
+
+		self.conn.execute(
+			'INSERT INTO {dest} (position, uid, timestamp, data) '
+			'SELECT (SELECT {position} FROM {dest}), uid, timestamp, data '
+			'FROM {source} WHERE uid = ?'.format(source=source, dest=dest, position=position),
+			(uid,))
+		self.conn.execute('DELETE FROM {source} WHERE uid = ?'.format(source=source), (uid,))
+
+	def begin_snapshot(self, statefile):
+		"""Every change is already written so no snapshot is needed."""
+
+		return None
+
+	def write_snapshot(self, snapshot):
+		"""Nothing to do."""
+
+		return 0
+
+	def replace(self, statefile):
+		"""Rewrite both tables from the state of `statefile` in a single transaction."""
+
+		self.connect()
+		with self.conn:
+			self.conn.execute('DELETE FROM slots')
+			self.conn.execute('DELETE FROM undos')
+			self.conn.executemany(
+				'INSERT INTO slots (position, uid, timestamp, data) VALUES (?, ?, ?, ?)',
+				((position, s.uid, s.timestamp, json.dumps(s.to_dict()))
+				 for position, s in enumerate(statefile.slots.values(), 1)))
+			self.conn.executemany(
+				'INSERT INTO undos (position, uid, timestamp, data) VALUES (?, ?, ?, ?)',
+				((position, s.uid, s.timestamp, json.dumps(s.to_dict()))
+				 for position, s in enumerate(reversed(statefile.undos), 1)))
+
+		logger.info('Wrote {m} messages {u} undos to database {s}'.format(
+			s=self.filename, m=len(statefile.slots), u=len(statefile.undos)))
+
+	def backup(self, statefile, suffix):
+		"""Copy the database next to the original."""
+
+		target = sqlite3.connect(str(self.filename.with_suffix(suffix)))
+		try:
+			self.conn.backup(target)
+
+		finally:
+			target.close()
+
+	def delete(self):
+		"""Remove the database."""
+
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+		for filename in (self.filename,
+						 self.filename.with_name(self.filename.name + '-wal'),
+						 self.filename.with_name(self.filename.name + '-shm')):
+			if filename.exists():
+				logger.info('Removing {s}'.format(s=filename))
+				filename.unlink()
+
+	def start_journal(self):
+		"""Changes are always written as they are made."""
+
+		pass
+
+	def stop_journal(self):
+		"""Make sure all changes are checkpointed into the main database file."""
+
+		if self.conn is not None:
+			self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+	def sync_journal(self):
+		"""Each change is committed as it is made."""
+
+		pass
+
+
+class MemoryStorage():
+	"""Keep nothing. Used for a replica of a Statefile owned by another process."""
+
+	def __init__(self, filename):
+		self.filename = filename
+
+	def load(self, statefile):
+		"""Start empty."""
+
+		pass
+
+	def record(self, record):
+		"""Changes are persisted by the owner."""
+
+		return False
+
+	def begin_snapshot(self, statefile):
+		"""Nothing to save."""
+
+		return None
+
+	def write_snapshot(self, snapshot):
+		"""Nothing to do."""
+
+		return 0
+
+	def replace(self, statefile):
+		"""Nothing to do."""
+
+		pass
+
+	def backup(self, statefile, suffix):
+		"""Nothing to do."""
+
+		pass
+
+	def delete(self):
+		"""Nothing to do."""
+
+		pass
+
+	def start_journal(self):
+		"""Nothing to do."""
+
+		pass
+
+	def stop_journal(self):
+		"""Nothing to do."""
+
+		pass
+
+	def sync_journal(self):
+		"""Nothing to do."""
+
+		pass
+
+
+# Available storage backends by name
+BACKENDS = {
+	'json': JSONStorage,
+	'sqlite': SQLiteStorage,
+	'memory': MemoryStorage,
+}
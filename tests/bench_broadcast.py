@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Measure broadcast latency with a large number of clients, some of them slow.
+
+Fake sockets stand in for real websockets so the figures show the cost of the
+fan-out itself rather than of the network."""
+
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import statistics
+
+from shareclip import config
+from shareclip import server
+from shareclip import metrics
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+
+class FakeSocket():
+	"""Minimal websocket stand in which takes `delay` seconds to accept each frame."""
+
+	def __init__(self, delay):
+		self.delay = delay
+		self.received = 0
+
+	async def send_str(self, data):
+		"""Pretend to transmit `data`."""
+		await asyncio.sleep(self.delay)
+		self.received += 1
+
+	async def close(self):
+		"""Pretend to close the socket."""
+		pass
+
+
+async def make_app(clients, slow_fraction, slow_delay):
+	"""Build an app-like dict holding `clients` fake sockets, each with its own send
+	queue."""
+	app = {'clients': [],
+		   'hosts': {},
+		   'queues': {},
+		   'writers': {},
+		   'encodings': {},
+		   'batch': [],
+		   'batch_timer': None,
+		   'statefile': Statefile(None, backend='memory')}
+	for _ in range(clients):
+		delay = slow_delay if random.random() < slow_fraction else 0
+		server.add_client(app, FakeSocket(delay), 'bench')
+
+	return app
+
+
+async def sequential_broadcast(app, frame):
+	"""The original one-at-a-time fan-out, kept for comparison."""
+	for ws in app['clients']:
+		await ws.send_str(frame)
+
+
+async def run(app, broadcaster, repeats):
+	"""Time `repeats` broadcasts through `broadcaster`, returning seconds per call,
+	seconds until every fast client had received them all, the number of fast and slow
+	clients not evicted, and the number of evictions and resyncs."""
+	fast = [ws for ws in app['clients'] if ws.delay == 0]
+	slow = [ws for ws in app['clients'] if ws.delay > 0]
+	evictions = metrics.WS_EVICTIONS.unlabelled.value
+	resyncs = metrics.WS_RESYNCS.unlabelled.value
+	start = time.perf_counter()
+	timings = []
+	for i in range(repeats):
+		call = time.perf_counter()
+		await broadcaster(app, json.dumps({'type': 'new_slot', 'uid': str(i), 'text': 'x' * 100}))
+		timings.append(time.perf_counter() - call)
+
+	# the last batch window closes and fast clients empty their queues, although they may
+	# have been resynced on the way
+	while (app['batch_timer'] is not None or
+		   any(ws.received < repeats and not app['queues'][ws].empty() for ws in fast)):
+		await asyncio.sleep(0.001)
+
+	delivered = time.perf_counter() - start
+	# give slow clients time to miss their send deadline, or to fall behind far enough
+	# to be resynced, before counting them
+	await asyncio.sleep(config.SEND_TIMEOUT + max([ws.delay for ws in slow], default=0))
+	fast_remaining = sum(ws in app['hosts'] for ws in fast)
+	slow_remaining = sum(ws in app['hosts'] for ws in slow)
+	writers = list(app['writers'].values())
+	for ws in list(app['clients']):
+		server.drop_client(app, ws)
+
+	await asyncio.wait(writers)
+	return (timings, delivered, fast_remaining, slow_remaining,
+			metrics.WS_EVICTIONS.unlabelled.value - evictions,
+			metrics.WS_RESYNCS.unlabelled.value - resyncs)
+
+
+def report(name, results):
+	"""Print summary figures for one run."""
+	timings, delivered, fast_remaining, slow_remaining, evictions, resyncs = results
+	print('{name}: mean {mean:.2f}ms max {max:.2f}ms per call, fast clients had all after '
+		  '{d:.1f}ms, {f} fast and {s} slow clients remaining, {e} evictions, '
+		  '{r} resyncs'.format(
+			  name=name,
+			  mean=statistics.mean(timings) * 1000,
+			  max=max(timings) * 1000,
+			  d=delivered * 1000,
+			  f=fast_remaining,
+			  s=slow_remaining,
+			  e=evictions,
+			  r=resyncs))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--clients',
+						type=int,
+						default=1000,
+						help='Number of connected clients')
+	parser.add_argument('--slow-fraction',
+						type=float,
+						default=0.05,
+						help='Proportion of clients which are slow')
+	parser.add_argument('--slow-delay',
+						type=float,
+						default=2.0,
+						help='Seconds a slow client takes to accept a frame')
+	parser.add_argument('--timeout',
+						type=float,
+						default=0.25,
+						help='Per client send deadline')
+	parser.add_argument('--batch-window',
+						type=float,
+						default=config.BATCH_WINDOW,
+						help='Seconds over which broadcasts are combined, or 0 for none')
+	parser.add_argument('--repeats',
+						type=int,
+						default=10,
+						help='Number of broadcasts to time')
+	parser.add_argument('--compare',
+						action='store_true',
+						help='Also time the old sequential broadcast (slow)')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.ERROR)
+	config.SEND_TIMEOUT = args.timeout
+	config.BATCH_WINDOW = args.batch_window
+	loop = asyncio.new_event_loop()
+
+	app = loop.run_until_complete(make_app(args.clients, args.slow_fraction, args.slow_delay))
+	slow = sum(ws.delay > 0 for ws in app['clients'])
+	results = loop.run_until_complete(run(app, server.broadcast_frame, args.repeats))
+	report('queued', results)
+	# slow clients must not hold up the others, and those too slow for the send deadline
+	# are evicted
+	timings, delivered, fast_remaining, slow_remaining, evictions, resyncs = results
+	assert fast_remaining == args.clients - slow
+	if args.slow_delay > args.timeout:
+		assert slow_remaining == 0 and evictions == slow
+
+	if args.compare:
+		app = loop.run_until_complete(make_app(args.clients, args.slow_fraction, args.slow_delay))
+		report('sequential', loop.run_until_complete(run(app, sequential_broadcast, 1)))
+
+if __name__ == '__main__':
+	main()
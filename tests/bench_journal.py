@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Time writing and replaying a large statefile journal."""
+
+import time
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+from shareclip import config
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--records',
+						type=int,
+						default=1000000,
+						help='Number of journal records to write')
+	parser.add_argument('--delete-every',
+						type=int,
+						default=10,
+						help='Delete a slot after every this many adds')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+	# keep everything in a single journal
+	config.JOURNAL_COMPACT_RECORDS = args.records + 1
+
+	with tempfile.TemporaryDirectory() as directory:
+		statefile = Statefile(Path(directory).joinpath('state'))
+		statefile.start_journal()
+		start = time.perf_counter()
+		for i in range(args.records):
+			if i % args.delete_every == args.delete_every - 1:
+				statefile.delete_slot('{i:032x}'.format(i=i - 1))
+
+			else:
+				statefile.add_slot({'uid': '{i:032x}'.format(i=i),
+									'timestamp': '2017-06-01T10:09:08',
+									'nickname': 'bench',
+									'text': 'message {i}'.format(i=i),
+									'clipboard': None,
+									'source': 'localhost'})
+
+		statefile.stop_journal()
+		elapsed = time.perf_counter() - start
+		size = statefile.storage.journal_filename(statefile.storage.generation).stat().st_size
+		print('Wrote {r} records ({mb:.1f}MB) in {t:.2f}s'.format(
+			r=args.records, mb=size / 1e6, t=elapsed))
+
+		start = time.perf_counter()
+		statefile = Statefile(statefile.filename)
+		elapsed = time.perf_counter() - start
+		print('Replayed to {s} slots in {t:.2f}s ({us:.1f}us per record)'.format(
+			s=len(statefile.slots), t=elapsed, us=elapsed / args.records * 1e6))
+
+if __name__ == '__main__':
+	main()
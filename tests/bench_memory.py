@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""Measure memory used per slot on large boards, held as Slots and as the dicts they
+are decoded from."""
+
+import gc
+import uuid
+import random
+import logging
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+from pathlib import Path
+from collections import OrderedDict
+
+from shareclip import codec
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+# Posters on the generated boards
+NICKNAMES = ['ann', 'bob', 'cat', 'dan', None]
+SOURCES = ['10.0.0.1', '10.0.0.2', 'laptop.example.com']
+
+
+def make_statefile(filename, count):
+	"""Write a statefile holding `count` slots like those posted through the server."""
+	rand = random.Random(1)
+	start = datetime.datetime(2017, 6, 1, 10, 9, 8)
+	statefile = Statefile(filename)
+	for i in range(count):
+		statefile.add_slot({'uid': uuid.UUID(int=rand.getrandbits(128)).hex,
+							'timestamp': (start + datetime.timedelta(seconds=i,
+																	microseconds=rand.randrange(1000000))).isoformat(),
+							'nickname': rand.choice(NICKNAMES),
+							'text': 'message {i} https://example.com/{i}'.format(i=i),
+							'clipboard': None,
+							'source': rand.choice(SOURCES)})
+
+	statefile.save()
+
+
+def measure(func):
+	"""Return the result of `func` and the bytes it leaves allocated."""
+	gc.collect()
+	before = tracemalloc.get_traced_memory()[0]
+	result = func()
+	gc.collect()
+	return result, tracemalloc.get_traced_memory()[0] - before
+
+
+def load_dicts(filename):
+	"""Return the slots of statefile `filename` as dicts by uid, as they used to be
+	kept."""
+	slots = OrderedDict((s['uid'], s) for s in codec.loads(filename.read_bytes())['slots'])
+	order = sorted((s['timestamp'], s['uid']) for s in slots.values())
+	return slots, order
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes',
+						type=int,
+						nargs='+',
+						default=[10000, 100000],
+						help='Board sizes to test')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		filename = Path(directory).joinpath('state')
+		for size in args.sizes:
+			print('{size} slots'.format(size=size))
+			make_statefile(filename, size)
+			tracemalloc.start()
+			dicts, dict_bytes = measure(lambda: load_dicts(filename))
+			del dicts
+			statefile, slot_bytes = measure(lambda: Statefile(filename))
+			tracemalloc.stop()
+			print('    dicts: {b:.0f} bytes per slot'.format(b=dict_bytes / size))
+			print('    Slots: {b:.0f} bytes per slot'.format(b=slot_bytes / size))
+			print('    saving {p:.0f}%'.format(p=100 * (1 - slot_bytes / dict_bytes)))
+			del statefile
+
+
+if __name__ == '__main__':
+	main()
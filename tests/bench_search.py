@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""Time building, reloading and querying the search index on large boards."""
+
+import time
+import random
+import logging
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+# Vocabulary for generated messages
+WORDS = ['deploy', 'server', 'logs', 'error', 'build', 'release', 'lunch', 'meeting',
+		 'https', 'example', 'com', 'branch', 'merge', 'review', 'ticket', 'database',
+		 'backup', 'restart', 'config', 'token']
+
+
+def make_statefile(directory, count):
+	"""Return a Statefile holding `count` slots of random words and numbers."""
+	rand = random.Random(1)
+	statefile = Statefile(Path(directory).joinpath('state'))
+	for i in range(count):
+		words = rand.sample(WORDS, 6) + [str(rand.randrange(100000)) for _ in range(2)]
+		statefile.add_slot({'uid': '{i:032x}'.format(i=i),
+							'timestamp': '2017-06-01T10:09:08',
+							'nickname': rand.choice(['ann', 'bob', 'cat']),
+							'text': ' '.join(words),
+							'clipboard': None,
+							'source': 'localhost'})
+
+	return statefile
+
+
+def timed(name, func, *args):
+	"""Run `func` and print how long it took, returning its result."""
+	start = time.perf_counter()
+	result = func(*args)
+	print('    {name}: {t:.1f}ms'.format(name=name, t=(time.perf_counter() - start) * 1000))
+	return result
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes',
+						type=int,
+						nargs='+',
+						default=[10000, 100000],
+						help='Board sizes to test')
+	parser.add_argument('--repeats',
+						type=int,
+						default=20,
+						help='Times to run each query')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		for size in args.sizes:
+			print('{size} slots'.format(size=size))
+			statefile = timed('add_slot each', make_statefile, directory, size)
+			timed('build index', statefile.index_search)
+			timed('save', statefile.save)
+			timed('load with saved index', Statefile(statefile.filename).load_search)
+			statefile.search_filename().unlink()
+			timed('load without saved index', Statefile(statefile.filename).load_search)
+
+			for query in ('server', 'serv logs', 'd', '123', 'deploy error restart'):
+				durations = []
+				for _ in range(args.repeats):
+					start = time.perf_counter()
+					results = statefile.search(query)
+					durations.append(time.perf_counter() - start)
+
+				print('    query {q!r}: median {m:.2f}ms max {x:.2f}ms, {r} results'.format(
+					q=query,
+					m=statistics.median(durations) * 1000,
+					x=max(durations) * 1000,
+					r=len(results)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Time how long command line options take to run, each in a fresh interpreter."""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+# Options to time, in order, with --clear-statefile last as it removes the state
+COMMANDS = [['--version'],
+			['--help'],
+			['--show-undo'],
+			['--show-messages'],
+			['--clear-statefile']]
+
+
+def make_statefile(filename, count):
+	"""Write a statefile holding `count` slots and a few undos."""
+	statefile = Statefile(filename)
+	for i in range(count):
+		statefile.add_slot({'uid': '{i:032x}'.format(i=i),
+							'timestamp': '2017-06-01T10:09:08',
+							'nickname': 'bench',
+							'text': 'message {i} with some words in it'.format(i=i),
+							'clipboard': None,
+							'source': 'localhost'})
+
+	for i in range(min(count, 10)):
+		statefile.delete_slot('{i:032x}'.format(i=i))
+
+	statefile.search('message')
+	statefile.save()
+
+
+def run(command, env):
+	"""Return how long `command` takes to run, discarding its output."""
+	start = time.perf_counter()
+	subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes',
+						type=int,
+						nargs='+',
+						default=[0, 10000, 100000],
+						help='Statefile sizes to test')
+	parser.add_argument('--repeats',
+						type=int,
+						default=5,
+						help='Times to run each command')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		env = dict(os.environ,
+				   XDG_DATA_HOME=directory,
+				   PYTHONPATH=os.pathsep.join(sys.path))
+		statefile = Path(directory).joinpath('shareclip', 'state')
+		backup = Path(directory).joinpath('backup')
+		baseline = statistics.median(run([sys.executable, '-c', 'pass'], env)
+									 for _ in range(args.repeats))
+		print('interpreter startup: {t:.1f}ms'.format(t=baseline * 1000))
+
+		for size in args.sizes:
+			print('{size} slots'.format(size=size))
+			statefile.parent.mkdir(exist_ok=True)
+			make_statefile(statefile, size)
+			statefile.rename(backup)
+			for options in COMMANDS:
+				durations = []
+				for _ in range(args.repeats):
+					shutil.copy(str(backup), str(statefile))
+					durations.append(run([sys.executable, '-m', 'shareclip.main'] + options, env))
+
+				print('    {o}: median {m:.1f}ms, {e:.1f}ms over interpreter startup'.format(
+					o=' '.join(options),
+					m=statistics.median(durations) * 1000,
+					e=(statistics.median(durations) - baseline) * 1000))
+
+			backup.unlink()
+			for leftover in statefile.parent.iterdir():
+				leftover.unlink()
+
+
+if __name__ == '__main__':
+	main()
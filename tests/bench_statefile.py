@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""Time slot deletion on large boards."""
+
+import time
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+from shareclip import config
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+
+def make_statefile(directory, count):
+	"""Return a Statefile holding `count` slots."""
+	statefile = Statefile(Path(directory).joinpath('state'))
+	for i in range(count):
+		statefile.add_slot({'uid': '{i:032x}'.format(i=i),
+							'timestamp': '2017-06-01T10:09:08',
+							'nickname': 'bench',
+							'text': 'message {i}'.format(i=i),
+							'clipboard': None,
+							'source': 'localhost'})
+
+	return statefile
+
+
+def list_delete_all(slots, undos):
+	"""The original list based delete_all, one linear delete per slot, for comparison."""
+	for uid in list(s['uid'] for s in slots):
+		for s in slots:
+			if s['uid'] == uid:
+				slots.remove(s)
+				undos.insert(0, s)
+				if len(undos) > config.UNDO_QUEUE_LENGTH:
+					del undos[config.UNDO_QUEUE_LENGTH:]
+
+
+def timed(name, func, *args):
+	"""Run `func` and print how long it took."""
+	start = time.perf_counter()
+	func(*args)
+	print('    {name}: {t:.1f}ms'.format(name=name, t=(time.perf_counter() - start) * 1000))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--sizes',
+						type=int,
+						nargs='+',
+						default=[10000, 100000],
+						help='Board sizes to test')
+	parser.add_argument('--compare',
+						action='store_true',
+						help='Also time the old list based delete all (quadratic, slow)')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		for size in args.sizes:
+			print('{size} slots'.format(size=size))
+			statefile = make_statefile(directory, size)
+			timed('delete_slot each', lambda: [statefile.delete_slot(uid)
+											   for uid in list(statefile.slots)])
+
+			statefile = make_statefile(directory, size)
+			timed('delete_slots', statefile.delete_slots, list(statefile.slots))
+
+			statefile = make_statefile(directory, size)
+			middle = list(statefile.slots)[size // 2]
+			timed('delete_slot middle', statefile.delete_slot, middle)
+			timed('undo_delete', statefile.undo_delete)
+
+			if args.compare:
+				statefile = make_statefile(directory, size)
+				timed('list delete all', list_delete_all, list(statefile.slots.values()), [])
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""Time newline delimited JSON export and import of large boards, directly and over
+HTTP."""
+
+import json
+import time
+import asyncio
+import datetime
+import logging
+import argparse
+import resource
+import tempfile
+import itertools
+from pathlib import Path
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from shareclip import config
+from shareclip import server
+from shareclip.slot import decode_lines
+from shareclip.statefile import Statefile
+
+logger = logging.getLogger()
+
+
+def write_rows(filename, count):
+	"""Write `count` slots to `filename` as newline delimited JSON."""
+	start = datetime.datetime(2017, 6, 1, 10, 9, 8)
+	with filename.open('w') as handle:
+		for i in range(count):
+			handle.write(json.dumps({'uid': '{i:032x}'.format(i=i),
+									 'timestamp': (start + datetime.timedelta(
+										 milliseconds=i)).isoformat(),
+									 'nickname': 'bench',
+									 'text': 'message {i}'.format(i=i),
+									 'clipboard': None,
+									 'source': 'localhost'}) + '\n')
+
+
+def import_rows(statefile, filename):
+	"""Import `filename` into `statefile` a chunk at a time, as `--import` does."""
+	number = 1
+	with filename.open('rb') as handle:
+		for lines in iter(lambda: list(itertools.islice(handle, config.IMPORT_CHUNK)), []):
+			statefile.import_slots(decode_lines(lines, number))
+			number += len(lines)
+
+
+def export_rows(statefile, filename):
+	"""Export `statefile` to `filename`, as `--export` does."""
+	with filename.open('w') as handle:
+		handle.writelines(statefile.export_lines())
+
+
+def timed(name, count, func, *args):
+	"""Run `func` and print how long it took and the rows per second."""
+	start = time.perf_counter()
+	result = func(*args)
+	duration = time.perf_counter() - start
+	print('    {name}: {t:.2f}s, {r:.0f} rows/s'.format(name=name, t=duration, r=count / duration))
+	return result
+
+
+async def http_transfer(directory, filename, count):
+	"""Import `filename` into a server over HTTP then export it again."""
+	app = server.create_app(prefix='', statefile=Statefile(directory.joinpath('http')))
+	async with TestClient(TestServer(app)) as client:
+		start = time.perf_counter()
+		with filename.open('rb') as handle:
+			response = await client.post('/api/import', data=handle)
+			assert (await response.json())['received'] == count
+
+		duration = time.perf_counter() - start
+		print('    HTTP import: {t:.2f}s, {r:.0f} rows/s'.format(t=duration, r=count / duration))
+
+		start = time.perf_counter()
+		response = await client.get('/api/export')
+		size = 0
+		async for data in response.content.iter_chunked(config.STREAM_CHUNK):
+			size += len(data)
+
+		duration = time.perf_counter() - start
+		print('    HTTP export: {t:.2f}s, {r:.0f} rows/s, {m:.0f}MB'.format(
+			t=duration, r=count / duration, m=size / 1e6))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--rows',
+						type=int,
+						default=1000000,
+						help='Number of slots to transfer')
+	parser.add_argument('--no-http',
+						action='store_true',
+						help='Skip the HTTP endpoints')
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.WARNING)
+
+	with tempfile.TemporaryDirectory() as directory:
+		directory = Path(directory)
+		config.BLOB_DIR = directory.joinpath('blobs')
+		filename = directory.joinpath('rows.ndjson')
+		print('{r} rows'.format(r=args.rows))
+		timed('write rows', args.rows, write_rows, filename, args.rows)
+		statefile = Statefile(directory.joinpath('state'))
+		timed('import', args.rows, import_rows, statefile, filename)
+		timed('import again, all duplicates', args.rows, import_rows, statefile, filename)
+		timed('save', args.rows, statefile.save)
+		timed('export', args.rows, export_rows, statefile, directory.joinpath('out.ndjson'))
+		assert filename.read_bytes() == directory.joinpath('out.ndjson').read_bytes()
+		print('    peak memory {m:.0f}MB'.format(
+			m=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+		del statefile
+
+		if not args.no_http:
+			asyncio.run(http_transfer(directory, filename, args.rows))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+"""Tests for the JSON API, against a server running in the test's event loop."""
+
+import asyncio
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from shareclip import config
+from shareclip import server
+from shareclip.statefile import Statefile
+
+
+def run_client(tmp_path, monkeypatch, test):
+	"""Run coroutine function `test` with a client of a fresh server."""
+	monkeypatch.setattr(config, 'BLOB_DIR', tmp_path / 'blobs')
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0)
+
+	async def run():
+		app = server.create_app(prefix='', statefile=Statefile(tmp_path / 'state'))
+		async with TestClient(TestServer(app)) as client:
+			await test(client, app['statefile'])
+
+	asyncio.run(run())
+
+
+def test_post_and_read(tmp_path, monkeypatch):
+	"""Posted slots can be listed and fetched, with 304s until something changes."""
+
+	async def test(client, statefile):
+		response = await client.post('/api/slots', json={'text': 'hello', 'nickname': 'benji'})
+		assert response.status == 201
+		first = await response.json()
+		assert first['text'] == 'hello' and first['nickname'] == 'benji'
+
+		response = await client.post('/api/slots', json=[{'text': 'https://example.com'},
+														 {'text': 'third'}])
+		uids = [s['uid'] for s in (await response.json())['slots']]
+		assert list(statefile.slots) == [bytes.fromhex(uid) for uid in [first['uid']] + uids]
+
+		response = await client.get('/api/slots', params={'limit': '2'})
+		page = await response.json()
+		assert [s['text'] for s in page['slots']][0] == 'third'
+		assert page['more'] is not None
+		etag = response.headers['ETag']
+
+		response = await client.get('/api/slots', params={'limit': '2'},
+									headers={'If-None-Match': etag})
+		assert response.status == 304
+
+		response = await client.get('/api/slots', params={'before': page['more'] + '_x'})
+		assert response.status == 200
+		response = await client.get('/api/slots', params={'before': 'x'})
+		assert response.status == 400
+
+		response = await client.get('/api/slots/' + uids[0])
+		assert (await response.json())['clipboard'] == 'https://example.com'
+		assert (await client.get('/api/slots/' + 'f' * 32)).status == 404
+
+		await client.post('/api/slots', json={'text': 'fourth'})
+		response = await client.get('/api/slots', params={'limit': '2'},
+									headers={'If-None-Match': etag})
+		assert response.status == 200
+
+		assert (await client.post('/api/slots', json={'nickname': 'benji'})).status == 400
+		assert (await client.post('/api/slots', data='{')).status == 400
+
+	run_client(tmp_path, monkeypatch, test)
+
+
+def test_delete(tmp_path, monkeypatch):
+	"""Slots are deleted to the undo queue singly or several at once."""
+
+	async def test(client, statefile):
+		response = await client.post('/api/slots', json=[{'text': str(i)} for i in range(4)])
+		uids = [s['uid'] for s in (await response.json())['slots']]
+
+		assert (await client.delete('/api/slots/' + uids[0])).status == 204
+		assert (await client.delete('/api/slots/' + uids[0])).status == 404
+
+		response = await client.post('/api/slots/delete', json={'uids': uids[1:3] + ['x']})
+		assert (await response.json())['deleted'] == uids[1:3]
+		assert [s.uid for s in statefile.slots.values()] == uids[3:]
+		assert [s.uid for s in statefile.undos] == [uids[2], uids[1], uids[0]]
+		assert (await client.post('/api/slots/delete', json={'uids': 'x'})).status == 400
+
+	run_client(tmp_path, monkeypatch, test)
+
+
+def test_export_import(tmp_path, monkeypatch):
+	"""Slots exported from one server import into another, in chunks, and importing again
+	adds nothing."""
+	monkeypatch.setattr(config, 'IMPORT_CHUNK', 2)
+	exported = []
+
+	async def export(client, statefile):
+		await client.post('/api/slots', json=[{'text': str(i)} for i in range(5)])
+		response = await client.get('/api/export')
+		assert response.content_type == 'application/x-ndjson'
+		exported.append(await response.text())
+
+	async def test(client, statefile):
+		await client.post('/api/slots', json={'text': 'already here'})
+		for _ in range(2):
+			response = await client.post('/api/import', data=exported[0])
+			assert (await response.json())['received'] == 5
+
+		assert [s.text for s in statefile.slots.values()] == ['already here', '0', '1', '2',
+															  '3', '4']
+		response = await client.post('/api/import', data='\n{"uid": "x"}\n')
+		assert response.status == 400
+		assert 'Line 2' in await response.text()
+		response = await client.post('/api/import',
+									 data='{"uid": "y", "timestamp": "2017-06-01T10:09:08", '
+										  '"text": "x", "blob": "../../etc", "size": "zz"}')
+		assert response.status == 400
+		assert 'y' not in statefile.slots
+
+	run_client(tmp_path / 'first', monkeypatch, export)
+	run_client(tmp_path / 'second', monkeypatch, test)
+
+
+def test_all_page(tmp_path, monkeypatch):
+	"""The all messages page is streamed in chunks, gzipped for clients which accept
+	that, and shows every slot with links to the full text of large ones."""
+	monkeypatch.setattr(config, 'BLOB_THRESHOLD', 100)
+	monkeypatch.setattr(config, 'STREAM_CHUNK', 256)
+
+	async def test(client, statefile):
+		await client.post('/api/slots', json=[{'text': 'message {i}'.format(i=i)}
+											   for i in range(20)])
+		await client.post('/api/slots', json={'text': 'x' * 200})
+		blob = list(statefile.slots.values())[-1].blob
+		assert blob is not None
+
+		for encoding in ('identity', 'gzip'):
+			response = await client.get('/all', headers={'Accept-Encoding': encoding})
+			assert response.status == 200
+			assert response.headers['Transfer-Encoding'] == 'chunked'
+			assert response.headers.get('Content-Encoding') == \
+				(None if encoding == 'identity' else 'gzip')
+			page = await response.text()
+			assert page.count('<li>') == len(statefile.slots) == 21
+			for i in range(20):
+				assert '<li>message {i}</li>'.format(i=i) in page
+
+			assert 'href="/blobs/{b}"'.format(b=blob) in page
+			assert '(200 bytes)' in page
+
+		response = await client.get('/blobs/{b}'.format(b=blob))
+		assert await response.text() == 'x' * 200
+
+	run_client(tmp_path, monkeypatch, test)
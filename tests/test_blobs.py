@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Tests for the content-addressed blob store."""
+
+import os
+import time
+import hashlib
+
+import pytest
+
+from shareclip import config
+from shareclip.blobs import BlobStore
+from shareclip.blobs import UploadError
+
+
+def make_store(tmp_path):
+	"""Return an initialised store in a temporary directory."""
+	blobs = BlobStore(tmp_path.joinpath('blobs'))
+	blobs.init()
+	return blobs
+
+
+def test_put_dedupe(tmp_path):
+	"""Identical contents are stored once under their digest."""
+	blobs = make_store(tmp_path)
+	digest = blobs.put(b'hello')
+	assert digest == hashlib.sha256(b'hello').hexdigest()
+	assert blobs.put(b'hello') == digest
+	assert blobs.path(digest).read_bytes() == b'hello'
+	assert len(list(blobs.path(digest).parent.iterdir())) == 1
+	assert not blobs.exists('../' + digest[3:])
+
+
+def test_chunked_upload(tmp_path):
+	"""Chunks must arrive in order, and repeats are ignored."""
+	blobs = make_store(tmp_path)
+	upload = blobs.begin_upload()
+	assert blobs.append(upload, 0, b'abc') == 3
+	assert blobs.append(upload, 0, b'abc') == 3
+	with pytest.raises(UploadError):
+		blobs.append(upload, 5, b'xyz')
+
+	assert blobs.append(upload, 3, b'def') == 6
+	digest, size = blobs.finish_upload(upload)
+	assert size == 6
+	assert blobs.read(digest, 4) == b'abcd'
+	assert list(blobs.uploads_dir.iterdir()) == []
+	with pytest.raises(UploadError):
+		blobs.append(upload, 6, b'g')
+
+	# uploading the same contents again leaves the existing blob
+	upload = blobs.begin_upload()
+	blobs.append(upload, 0, b'abcdef')
+	assert blobs.finish_upload(upload) == (digest, 6)
+	assert list(blobs.uploads_dir.iterdir()) == []
+
+
+def test_upload_too_big(tmp_path, monkeypatch):
+	"""An upload growing past the size limit is discarded."""
+	monkeypatch.setattr(config, 'BLOB_MAX_SIZE', 4)
+	blobs = make_store(tmp_path)
+	upload = blobs.begin_upload()
+	blobs.append(upload, 0, b'abc')
+	with pytest.raises(UploadError):
+		blobs.append(upload, 3, b'de')
+
+	with pytest.raises(UploadError):
+		blobs.finish_upload(upload)
+
+
+def test_collect(tmp_path):
+	"""Unreferenced blobs and stale uploads are removed."""
+	blobs = make_store(tmp_path)
+	keep = blobs.put(b'keep')
+	lose = blobs.put(b'lose')
+	fresh = blobs.begin_upload()
+	stale = blobs.begin_upload()
+	old = time.time() - config.UPLOAD_EXPIRY - 1
+	os.utime(str(blobs.uploads_dir.joinpath(stale)), (old, old))
+
+	assert blobs.collect({keep}) == 1
+	assert blobs.exists(keep)
+	assert not blobs.exists(lose)
+	assert [p.name for p in blobs.uploads_dir.iterdir()] == [fresh]
+
+
+def test_collect_foreign_files(tmp_path):
+	"""Files not named like blobs or uploads are left alone."""
+	blobs = make_store(tmp_path)
+	lose = blobs.put(b'lose')
+	others = [blobs.directory.joinpath('notes.txt'),
+			  blobs.path(lose).with_name('short'),
+			  blobs.directory.joinpath('docs', lose[2:]),
+			  blobs.directory.joinpath('AB', lose[2:]),
+			  blobs.uploads_dir.joinpath('notes.txt')]
+	for path in others:
+		path.parent.mkdir(exist_ok=True)
+		path.write_bytes(b'mine')
+		old = time.time() - config.UPLOAD_EXPIRY - 1
+		os.utime(str(path), (old, old))
+
+	assert blobs.collect(set()) == 1
+	assert not blobs.exists(lose)
+	assert all(path.exists() for path in others)
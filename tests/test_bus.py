@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""Tests for the bus shared by server processes, with the processes simulated by
+several servers in one event loop."""
+
+import asyncio
+
+import pytest
+
+from shareclip import server
+from shareclip import bus
+from shareclip.statefile import Statefile
+
+
+def make_slot(uid):
+	"""Return a minimal slot structure."""
+	return {'uid': uid,
+			'timestamp': '2017-06-01T10:09:{uid:0>2}'.format(uid=uid),
+			'nickname': 'benji',
+			'text': 'message {uid}'.format(uid=uid),
+			'clipboard': None,
+			'source': 'localhost'}
+
+
+def make_app(statefile, app_bus):
+	"""Return the parts of a server application used by the bus."""
+	return {'statefile': statefile, 'bus': app_bus, 'clients': [], 'hosts': {}, 'batch': [],
+			'batch_timer': None, 'expiry_timer': None}
+
+
+async def start(app, delivered):
+	"""Connect `app` to its bus, recording frames sent to its clients in `delivered`."""
+
+	async def deliver(frame):
+		delivered.append(frame)
+
+	async def reset():
+		pass
+
+	await app['bus'].start(statefile=app['statefile'],
+						   execute=lambda command: server.execute(app, command),
+						   deliver=deliver,
+						   reset=reset)
+
+
+async def settle(condition):
+	"""Wait for messages on the bus to be handled until `condition()` holds."""
+	for _ in range(200):
+		if condition():
+			return
+
+		await asyncio.sleep(0.01)
+
+	assert condition()
+
+
+def same_state(owner, worker):
+	"""Test if a replica matches the owner."""
+	return list(owner.slots) == list(worker.slots) and \
+		[s['uid'] for s in owner.undos] == [s['uid'] for s in worker.undos] and \
+		owner.epoch == worker.epoch and owner.seq == worker.seq
+
+
+async def run_commands(owner_bus, worker_bus, tmp_path):
+	"""Drive a worker and the owner through each kind of command."""
+	owner = Statefile(tmp_path / 'state')
+	for i in range(3):
+		owner.add_slot(make_slot(str(i)))
+
+	owner_app = make_app(owner, owner_bus)
+	worker_app = make_app(Statefile(None, backend='memory'), worker_bus)
+	worker = worker_app['statefile']
+	delivered = []
+	await start(owner_app, [])
+	await start(worker_app, delivered)
+	assert same_state(owner, worker)
+	assert worker.snapshot_frame() == owner.snapshot_frame()
+
+	await worker_bus.command({'type': 'post', 'slot': make_slot('3')})
+	await settle(lambda: len(delivered) == 1)
+	assert '3' in owner.slots
+	assert same_state(owner, worker)
+
+	# commands from the owner itself skip the queue so wait for each to arrive
+	await worker_bus.command({'type': 'delete', 'uid': '1'})
+	await settle(lambda: len(delivered) == 2)
+	await owner_bus.command({'type': 'undo'})
+	await worker_bus.command({'type': 'delete_all'})
+	await worker_bus.command({'type': 'undo'})
+	await settle(lambda: len(delivered) == 5)
+	assert same_state(owner, worker)
+	assert list(worker.slots) == ['3']
+	assert worker.page() == owner.page()
+	# the replica's change log starts from the state it was sent
+	assert worker.changes_since(owner.epoch, 3) == owner.changes_since(owner.epoch, 3)
+
+	await worker_bus.command({'type': 'empty_undo'})
+	await settle(lambda: len(delivered) == 6)
+	assert len(worker.undos) == 0
+	assert same_state(owner, worker)
+
+	await worker_bus.stop()
+	await owner_bus.stop()
+
+
+def test_memory_broker(tmp_path):
+	"""A worker's commands are applied by the owner and its replica follows the owner."""
+	async def run():
+		broker = bus.MemoryBroker()
+		await run_commands(bus.BrokerBus(broker, owner=True),
+						   bus.BrokerBus(broker, owner=False),
+						   tmp_path)
+
+	asyncio.run(run())
+
+
+def test_socket_broker(tmp_path):
+	"""As above, over a Unix socket."""
+	async def run():
+		address = tmp_path / 'bus.sock'
+		await run_commands(bus.BrokerBus(bus.SocketBroker(address, hub=True), owner=True),
+						   bus.BrokerBus(bus.SocketBroker(address), owner=False),
+						   tmp_path)
+
+	asyncio.run(run())
+
+
+def test_parse_address():
+	"""Bus addresses are Unix socket paths or TCP host:port."""
+	assert bus.parse_address('/run/shareclip/bus.sock') is None
+	assert bus.parse_address('example.com:8081') == ('example.com', 8081)
+
+
+def test_disconnected_worker(tmp_path):
+	"""A worker without a connection to the owner refuses commands rather than losing them."""
+	async def run():
+		worker_bus = bus.BrokerBus(bus.SocketBroker(tmp_path / 'bus.sock'), owner=False)
+		with pytest.raises(bus.BusError):
+			await worker_bus.command({'type': 'post', 'slot': make_slot('0')})
+
+	asyncio.run(run())
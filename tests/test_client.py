@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""Tests for the command line client, against a server running in the test's event
+loop."""
+
+import asyncio
+
+import pytest
+import aiohttp
+from aiohttp.test_utils import TestServer
+
+from shareclip import config
+from shareclip import server
+from shareclip.client import Client
+from shareclip.statefile import Statefile
+
+
+def run_server(tmp_path, monkeypatch, test):
+	"""Run coroutine function `test` with a client session and the URL of a fresh
+	server."""
+	monkeypatch.setattr(config, 'BLOB_DIR', tmp_path / 'blobs')
+	monkeypatch.setattr(config, 'CLIENT_RETRY', 0.01)
+
+	async def run():
+		app = server.create_app(prefix='', statefile=Statefile(tmp_path / 'state'))
+		async with TestServer(app) as test_server:
+			async with aiohttp.ClientSession() as session:
+				await test(session, str(test_server.make_url('')), app)
+
+	asyncio.run(run())
+
+
+def test_pipeline(tmp_path, monkeypatch):
+	"""Pipelined posts and deletes are made in order, and earlier requests are done
+	before an undo or a tail."""
+	monkeypatch.setattr(config, 'CLIENT_PIPELINE', 4)
+
+	async def test(session, url, app):
+		client = Client(session, url, nickname='benji')
+		await client.connect()
+		for i in range(50):
+			await client.post(str(i))
+
+		await client.post('x' * (config.UPLOAD_CHUNK + 1))
+		await client.drain()
+		statefile = app['statefile']
+		assert [s.text for s in statefile.slots.values()][:50] == [str(i) for i in range(50)]
+		assert statefile.slots[list(statefile.slots)[-1]].size == config.UPLOAD_CHUNK + 1
+
+		uids = [s.uid for s in statefile.slots.values()]
+		await client.delete(uids[-1])
+		await client.delete(uids[-2])
+		await client.undo()
+		slots, seq = await client.latest(3)
+		assert [s['text'] for s in slots] == ['49', '48', '47']
+		assert seq == statefile.seq
+		assert len(client.unacked) == 0
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_resume(tmp_path, monkeypatch):
+	"""A client which loses its connection reconnects and is sent only the changes it
+	missed."""
+
+	async def test(session, url, app):
+		changes = []
+		client = Client(session, url, on_change=changes.append)
+		await client.connect()
+		await client.post('first')
+		await client.drain()
+
+		snapshots = []
+		snapshot_frame = app['statefile'].snapshot_frame
+		monkeypatch.setattr(app['statefile'], 'snapshot_frame',
+							lambda: snapshots.append(1) or snapshot_frame())
+		await server.reset_clients(app)
+		await server.add_slot(app, 'benji', 'missed', 'localhost')
+		await client.post('second')
+		await client.drain()
+		await asyncio.sleep(0.1)
+
+		assert [c['text'] for c in changes] == ['first', 'missed', 'second']
+		assert [c['seq'] for c in changes] == [1, 2, 3]
+		assert snapshots == []
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_repeated_changes(tmp_path, monkeypatch):
+	"""Changes arriving again, as after a snapshot or a resync, are passed on once."""
+
+	async def test(session, url, app):
+		changes = []
+		client = Client(session, url, on_change=changes.append)
+		await client.connect()
+		await client.post('first')
+		await client.post('second')
+		await client.drain()
+		await asyncio.sleep(0.1)
+
+		statefile = app['statefile']
+		for ws in app['clients']:
+			for frame in statefile.changes_since(statefile.epoch, 0):
+				server.send_frame(app, ws, frame)
+
+		await client.post('third')
+		await client.drain()
+		await asyncio.sleep(0.1)
+
+		assert [c['seq'] for c in changes] == [1, 2, 3]
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_lost_replies(tmp_path, monkeypatch):
+	"""A client gives up waiting for replies the server has lost."""
+	monkeypatch.setattr(config, 'CLIENT_TIMEOUT', 0.2)
+
+	async def lose_page(app, ws, before):
+		pass
+
+	async def test(session, url, app):
+		client = Client(session, url)
+		await client.connect()
+		send_page = server.send_page
+		monkeypatch.setattr(server, 'send_page', lose_page)
+		with pytest.raises(asyncio.TimeoutError):
+			await client.latest(1)
+
+		monkeypatch.setattr(server, 'send_page', send_page)
+		await client.post('after')
+		slots, seq = await client.latest(1)
+		assert [s['text'] for s in slots] == ['after']
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_bad_messages(tmp_path, monkeypatch):
+	"""Bad messages are answered with errors without closing the socket, and a closed
+	socket is always forgotten."""
+
+	async def test(session, url, app):
+		ws = await session.ws_connect(url + '/ws')
+		await ws.send_str('not json')
+		assert (await ws.receive_json())['type'] == 'error'
+		await ws.send_json({'type': 'post', 'message': 'no nickname', 'ref': 7})
+		assert (await ws.receive_json()) == {'type': 'error',
+											 'message': 'post message nickname must be a str',
+											 'ref': 7}
+		assert len(app['clients']) == 1
+		await ws.close()
+		await asyncio.sleep(0.05)
+		assert len(app['clients']) == 0 and len(app['writers']) == 0
+
+		client = Client(session, url)
+		await client.connect()
+		await client.delete(None)
+		await client.drain()
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_bad_cursor(tmp_path, monkeypatch):
+	"""A page request with a bad cursor is answered with an error, which fails the
+	client's wait for the page."""
+
+	async def test(session, url, app):
+		ws = await session.ws_connect(url + '/ws')
+		await ws.send_json({'type': 'page', 'before': 'x', 'ref': 5})
+		reply = await ws.receive_json()
+		assert reply['type'] == 'error' and reply['ref'] == 5
+		await ws.close()
+
+		client = Client(session, url)
+		await client.connect()
+		page = asyncio.get_event_loop().create_future()
+		client.pages.append(page)
+		await client.request({'type': 'page', 'before': 'x'})
+		with pytest.raises(aiohttp.ClientError):
+			await page
+
+		await client.drain()
+		await client.close()
+
+	run_server(tmp_path, monkeypatch, test)
+
+
+def test_null_search(tmp_path, monkeypatch):
+	"""A search for null is a search for nothing rather than a bad message."""
+
+	async def test(session, url, app):
+		await server.add_slot(app, 'benji', 'found', 'localhost')
+		ws = await session.ws_connect(url + '/ws')
+		await ws.send_json({'type': 'search', 'q': None, 'ref': 3})
+		reply = await ws.receive_json()
+		assert reply['type'] == 'search' and reply['q'] == ''
+		assert (await ws.receive_json()) == {'type': 'ack', 'ref': 3}
+		await ws.close()
+
+	run_server(tmp_path, monkeypatch, test)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+"""Tests for the queued logging setup."""
+
+import logging
+
+from shareclip import log
+
+
+def test_log_file(tmp_path):
+	"""Records reach the log file through the listener, with debug lines only if asked
+	for."""
+	root = logging.getLogger()
+	handlers = root.handlers[:]
+	level = root.level
+	logger = logging.getLogger('test')
+	try:
+		log.init_log(log_file=tmp_path / 'log')
+		logger.info('shown %s', 1)
+		logger.debug('hidden %s', 2)
+		log.stop_log()
+		text = (tmp_path / 'log').read_text()
+		assert 'INFO test: shown 1' in text and 'hidden' not in text
+
+		log.init_log(debug=True, rotating_log_file=tmp_path / 'daily')
+		logger.debug('shown %s', 3)
+		log.stop_log()
+		assert 'DEBUG test: shown 3' in (tmp_path / 'daily').read_text()
+
+	finally:
+		log.stop_log()
+		root.handlers[:] = handlers
+		root.setLevel(level)
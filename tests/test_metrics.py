@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Tests for the metrics served at /metrics."""
+
+import asyncio
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from shareclip import config
+from shareclip import server
+from shareclip import metrics
+from shareclip.statefile import Statefile
+
+
+def test_render():
+	"""Metrics are shown in Prometheus text format."""
+	registry = []
+	counter = metrics.Counter('test_total', 'A counter', registry=registry)
+	gauge = metrics.Gauge('test_gauge', 'A gauge', registry=registry)
+	histogram = metrics.Histogram('test_seconds', 'A histogram', label='type',
+								  buckets=(0.1, 1.0), registry=registry)
+	counter.inc()
+	counter.inc(2)
+	gauge.set_function(lambda: 7)
+	histogram.labels('post').observe(0.05)
+	histogram.labels('post').observe(0.5)
+	histogram.labels('post').observe(5)
+	histogram.labels('delete').observe(1.0)
+
+	assert metrics.render(registry).splitlines() == [
+		'# HELP test_total A counter',
+		'# TYPE test_total counter',
+		'test_total 3',
+		'# HELP test_gauge A gauge',
+		'# TYPE test_gauge gauge',
+		'test_gauge 7',
+		'# HELP test_seconds A histogram',
+		'# TYPE test_seconds histogram',
+		'test_seconds_bucket{type="delete",le="0.1"} 0',
+		'test_seconds_bucket{type="delete",le="1.0"} 1',
+		'test_seconds_bucket{type="delete",le="+Inf"} 1',
+		'test_seconds_sum{type="delete"} 1.0',
+		'test_seconds_count{type="delete"} 1',
+		'test_seconds_bucket{type="post",le="0.1"} 1',
+		'test_seconds_bucket{type="post",le="1.0"} 2',
+		'test_seconds_bucket{type="post",le="+Inf"} 3',
+		'test_seconds_sum{type="post"} 5.55',
+		'test_seconds_count{type="post"} 3',
+	]
+
+
+def test_snapshot_stall(tmp_path, monkeypatch):
+	"""Each background save records its event loop stall."""
+	monkeypatch.setattr(config, 'BLOB_DIR', tmp_path / 'blobs')
+	saves = metrics.SNAPSHOT_STALL_SECONDS.unlabelled.count
+
+	async def run():
+		app = server.create_app(prefix='', statefile=Statefile(tmp_path / 'state'))
+		async with TestClient(TestServer(app)) as client:
+			await client.post('/api/slots', json={'text': 'hello'})
+			await server.take_snapshot(app)
+			lines = (await (await client.get('/metrics')).text()).splitlines()
+			assert 'shareclip_snapshot_stall_seconds_count {c}'.format(c=saves + 1) in lines
+
+	asyncio.run(run())
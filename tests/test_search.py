@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""Tests for searching slots."""
+
+from shareclip import search
+from shareclip.statefile import Statefile
+
+
+def make_slot(uid, text, nickname='benji'):
+	"""Return a minimal slot structure."""
+	return {'uid': uid,
+			'timestamp': '2017-06-01T10:09:{uid:0>2}'.format(uid=uid),
+			'nickname': nickname,
+			'text': text,
+			'clipboard': None,
+			'source': 'localhost'}
+
+
+def make_statefile(tmp_path):
+	"""Return a Statefile holding a few slots."""
+	statefile = Statefile(tmp_path / 'state')
+	statefile.add_slot(make_slot('1', 'deploy the <b>server</b> tonight'))
+	statefile.add_slot(make_slot('2', 'server logs server logs'))
+	statefile.add_slot(make_slot('3', 'lunch?', nickname='serena'))
+	statefile.add_slot(make_slot('4', 'deployment notes'))
+	return statefile
+
+
+def uids(slots):
+	"""Return the uids of a list of slots."""
+	return [s['uid'] for s in slots]
+
+
+def test_search(tmp_path):
+	"""Words match by prefix, all must match and better matches come first."""
+	statefile = make_statefile(tmp_path)
+	assert uids(statefile.search('server')) == ['2', '1']
+	assert uids(statefile.search('SER')) == ['2', '3', '1']
+	assert uids(statefile.search('deploy')) == ['1', '4']
+	assert uids(statefile.search('deploy serv')) == ['1']
+	assert uids(statefile.search('benji')) == ['4', '2', '1']
+	assert statefile.search('nothing') == []
+	assert statefile.search('') == []
+	assert uids(statefile.search('ser', limit=1)) == ['2']
+
+
+def test_search_changes(tmp_path):
+	"""The index follows deletes, undos and edits."""
+	statefile = make_statefile(tmp_path)
+	statefile.delete_slot('2')
+	assert uids(statefile.search('server')) == ['1']
+	assert uids(statefile.search('logs')) == []
+	statefile.undo_delete()
+	assert uids(statefile.search('logs')) == ['2']
+	statefile.update_slot(statefile.slots['3'], text='dinner?')
+	assert uids(statefile.search('lunch')) == []
+	assert uids(statefile.search('dinner')) == ['3']
+	assert 'lunch' not in statefile.search_index.words
+
+
+def test_saved_index(tmp_path, monkeypatch):
+	"""The index is loaded on first use, reusing the saved one for slots which have not
+	changed since."""
+	statefile = make_statefile(tmp_path)
+	statefile.load_search()
+	statefile.save()
+	# edit a slot then save the state without the index
+	statefile.update_slot(statefile.slots['3'], text='dinner?')
+	statefile.write_snapshot(statefile.begin_snapshot())
+
+	tokenised = []
+	slot_words = search.slot_words
+
+	def counting_slot_words(slot):
+		tokenised.append(slot['uid'])
+		return slot_words(slot)
+
+	monkeypatch.setattr(search, 'slot_words', counting_slot_words)
+	reloaded = Statefile(statefile.filename)
+	assert reloaded.search_index is None
+	reloaded.load_search()
+	assert tokenised == ['3']
+	assert uids(reloaded.search('dinner')) == ['3']
+	assert uids(reloaded.search('server')) == ['2', '1']
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""Tests for the per-client send queues, using stand in sockets."""
+
+import json
+import asyncio
+
+import pytest
+
+from shareclip import config
+from shareclip import server
+from shareclip.statefile import Statefile
+
+
+class FakeSocket():
+	"""Websocket stand in which records frames, or never accepts one if `stuck`."""
+
+	def __init__(self, stuck=False):
+		self.stuck = stuck
+		self.frames = []
+		self.closed = False
+
+	async def send_str(self, data):
+		"""Accept or hang on to `data`."""
+		if self.stuck:
+			await asyncio.Event().wait()
+
+		self.frames.append(data)
+
+	async def send_bytes(self, data):
+		"""Accept binary `data`."""
+		await self.send_str(data)
+
+	async def close(self):
+		"""Note the socket was closed."""
+		self.closed = True
+
+
+def make_app():
+	"""Return the parts of a server application used for sending."""
+	return {'clients': [],
+			'hosts': {},
+			'queues': {},
+			'writers': {},
+			'encodings': {},
+			'batch': [],
+			'batch_timer': None,
+			'statefile': Statefile(None, backend='memory')}
+
+
+async def send_frames(app, count):
+	"""Broadcast `count` numbered frames then let writers run."""
+	for i in range(count):
+		await server.broadcast_frame(app, json.dumps({'type': 'test', 'n': i}))
+
+	await asyncio.sleep(0.01)
+
+
+def test_send_order(monkeypatch):
+	"""Every client gets every frame in order."""
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0)
+
+	async def run():
+		app = make_app()
+		sockets = [FakeSocket() for _ in range(3)]
+		for ws in sockets:
+			server.add_client(app, ws, 'test')
+
+		await send_frames(app, 20)
+		for ws in sockets:
+			assert [json.loads(f)['n'] for f in ws.frames] == list(range(20))
+
+	asyncio.run(run())
+
+
+def test_overflow_resync(monkeypatch):
+	"""A client whose queue fills has it replaced by a snapshot, leaving others alone."""
+	monkeypatch.setattr(config, 'SEND_QUEUE_LENGTH', 4)
+	monkeypatch.setattr(config, 'SEND_OVERFLOW', 'resync')
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0)
+
+	async def run():
+		app = make_app()
+		stuck = FakeSocket(stuck=True)
+		fine = FakeSocket()
+		server.add_client(app, stuck, 'test')
+		server.add_client(app, fine, 'test')
+		await send_frames(app, 7)
+		queued = []
+		while not app['queues'][stuck].empty():
+			queued.append(json.loads(app['queues'][stuck].get_nowait()))
+
+		# the first frame is stuck in the socket, the sixth overflowed the queue
+		assert [q['type'] for q in queued] == ['snapshot', 'test']
+		assert queued[1]['n'] == 6
+		assert stuck in app['clients']
+		assert len(fine.frames) == 7
+
+	asyncio.run(run())
+
+
+def test_overflow_disconnect(monkeypatch):
+	"""With the disconnect policy a client whose queue fills is dropped."""
+	monkeypatch.setattr(config, 'SEND_QUEUE_LENGTH', 4)
+	monkeypatch.setattr(config, 'SEND_OVERFLOW', 'disconnect')
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0)
+
+	async def run():
+		app = make_app()
+		stuck = FakeSocket(stuck=True)
+		server.add_client(app, stuck, 'test')
+		await send_frames(app, 7)
+		assert stuck not in app['clients']
+		assert stuck not in app['queues']
+		assert stuck.closed
+
+	asyncio.run(run())
+
+
+def test_send_timeout(monkeypatch):
+	"""A client which does not accept a frame in time is dropped."""
+	monkeypatch.setattr(config, 'SEND_TIMEOUT', 0.01)
+
+	async def run():
+		app = make_app()
+		stuck = FakeSocket(stuck=True)
+		server.add_client(app, stuck, 'test')
+		await send_frames(app, 1)
+		await asyncio.sleep(0.05)
+		assert stuck not in app['clients']
+		assert stuck.closed
+
+	asyncio.run(run())
+
+
+def test_batch(monkeypatch):
+	"""A burst is sent as its first change followed by one batch of the rest."""
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0.02)
+
+	async def run():
+		app = make_app()
+		ws = FakeSocket()
+		server.add_client(app, ws, 'test')
+		await send_frames(app, 5)
+		assert [json.loads(f)['n'] for f in ws.frames] == [0]
+		await asyncio.sleep(0.05)
+		batch = json.loads(ws.frames[1])
+		assert batch['type'] == 'batch'
+		assert [m['n'] for m in batch['messages']] == [1, 2, 3, 4]
+		assert len(ws.frames) == 2
+
+		# the window closes once changes stop, so the next one goes straight out
+		assert app['batch_timer'] is None
+		await send_frames(app, 1)
+		assert len(ws.frames) == 3
+
+	asyncio.run(run())
+
+
+def test_binary_encoding(monkeypatch):
+	"""A client which chose MessagePack gets binary frames, encoded once for everyone."""
+	msgpack = pytest.importorskip('msgpack')
+	monkeypatch.setattr(config, 'BATCH_WINDOW', 0)
+
+	async def run():
+		app = make_app()
+		text = FakeSocket()
+		binary = [FakeSocket() for _ in range(2)]
+		server.add_client(app, text, 'test')
+		for ws in binary:
+			server.add_client(app, ws, 'test')
+			app['encodings'][ws] = 'msgpack'
+
+		await send_frames(app, 2)
+		assert [json.loads(f)['n'] for f in text.frames] == [0, 1]
+		assert [msgpack.unpackb(f)['n'] for f in binary[0].frames] == [0, 1]
+		assert binary[0].frames[0] is binary[1].frames[0]
+
+	asyncio.run(run())
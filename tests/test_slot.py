@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""Tests for the compact slot representation."""
+
+import pytest
+
+from shareclip.slot import Slot
+from shareclip.slot import check
+
+
+def test_round_trip():
+	"""Slots convert back to exactly the JSON form they were made from."""
+	plain = {'uid': '0123456789abcdef0123456789abcdef',
+			 'timestamp': '2017-06-01T10:09:08.123456',
+			 'nickname': 'benji',
+			 'text': 'hello',
+			 'clipboard': None,
+			 'source': 'localhost'}
+	slot = Slot.from_dict(plain)
+	assert slot.key == bytes.fromhex(plain['uid'])
+	assert slot.to_dict() == plain
+	assert slot['uid'] == plain['uid'] and slot['timestamp'] == plain['timestamp']
+	with pytest.raises(KeyError):
+		slot['key']
+
+	blob = dict(plain, uid='other', timestamp='2017-06-01T10:09:08', blob='ab', size=10)
+	assert Slot.from_dict(blob).to_dict() == blob
+	assert Slot.from_dict(blob).key == 'other'
+
+
+def test_shared_names():
+	"""Each nickname and source is held once however many slots use it."""
+	first = Slot.from_dict({'uid': '1',
+							'timestamp': '2017-06-01T10:09:08',
+							'nickname': ''.join(['ben', 'ji']),
+							'text': 'a',
+							'clipboard': None,
+							'source': ''.join(['local', 'host'])})
+	second = first.replace({'uid': '2', 'nickname': ''.join(['be', 'nji'])})
+	assert second.nickname is first.nickname
+	assert second.source is first.source
+	assert second.text == 'a' and second.uid == '2'
+
+
+def test_check_blob():
+	"""A slot's blob must be a digest, with a byte count for its size."""
+	plain = {'uid': 'a', 'timestamp': '2017-06-01T10:09:08', 'text': 'hello'}
+	check(dict(plain, blob=None, size='ignored'))
+	check(dict(plain, blob='ab' * 32, size=0))
+	for blob, size in (('../../etc', 10), ('AB' * 32, 10), ('ab' * 32 + '\n', 10),
+					   (123, 10), ('ab' * 32, 'zz'), ('ab' * 32, -1), ('ab' * 32, None),
+					   ('ab' * 32, True), ('ab' * 32, 1.5)):
+		with pytest.raises(ValueError):
+			check(dict(plain, blob=blob, size=size))
+
+
+def test_check_timestamp():
+	"""Timestamps are in UTC without a time zone, and are given back in isoformat form."""
+	plain = {'uid': 'a', 'timestamp': '2020-01-01T00:00:00.000000', 'text': 'hello'}
+	check(plain)
+	assert Slot.from_dict(plain).timestamp == '2020-01-01T00:00:00'
+	for timestamp in ('2020-01-01T00:00:00+05:00', '2020-01-01T00:00:00+00:00', 'soon'):
+		with pytest.raises(ValueError):
+			check(dict(plain, timestamp=timestamp))
+
+
+def test_hash():
+	"""Slots can be held in sets, where equal slots are the same member."""
+	plain = {'uid': 'a', 'timestamp': '2020-01-01T00:00:00', 'text': 'hello'}
+	assert len({Slot.from_dict(plain), Slot.from_dict(plain)}) == 1
+	assert len({Slot.from_dict(plain), Slot.from_dict(dict(plain, text='other'))}) == 2
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""Tests for the Statefile class which do not need a running server."""
+
+import json
+import datetime
+
+import pytest
+
+from shareclip import config
+from shareclip import slot
+from shareclip.statefile import Statefile
+
+
+def make_slot(uid):
+	"""Return a minimal slot structure."""
+	return {'uid': uid,
+			'timestamp': '2017-06-01T10:09:08',
+			'nickname': 'benji',
+			'text': 'message {uid}'.format(uid=uid),
+			'clipboard': None,
+			'source': 'localhost'}
+
+
+def make_statefile(tmp_path, count=0):
+	"""Return a new Statefile in `tmp_path` holding `count` slots."""
+	statefile = Statefile(tmp_path / 'state')
+	for i in range(count):
+		statefile.add_slot(make_slot(str(i)))
+
+	return statefile
+
+
+def test_delete_and_undo(tmp_path):
+	"""A deleted slot moves to the undo queue and undo puts it back at the front."""
+	statefile = make_statefile(tmp_path, 3)
+	assert json.loads(statefile.delete_slot('1')) == {'type': 'delete_slot', 'uid': '1', 'seq': 4}
+	assert list(statefile.slots) == ['0', '2']
+	assert [u['uid'] for u in statefile.undos] == ['1']
+	assert statefile.delete_slot('1') is None
+
+	assert json.loads(statefile.undo_delete())['uid'] == '1'
+	assert list(statefile.slots) == ['1', '0', '2']
+	assert statefile.undo_delete() is None
+
+
+def test_delete_slots(tmp_path):
+	"""Bulk delete produces one message and skips unknown uids."""
+	statefile = make_statefile(tmp_path, 5)
+	message = json.loads(statefile.delete_slots(['4', 'x', '0']))
+	assert message['type'] == 'delete_many'
+	assert message['uids'] == ['4', '0']
+	assert list(statefile.slots) == ['1', '2', '3']
+	assert [u['uid'] for u in statefile.undos] == ['0', '4']
+	assert statefile.delete_slots(['x']) is None
+
+
+def test_undo_queue_length(tmp_path):
+	"""The undo queue keeps only the most recent deletions."""
+	statefile = make_statefile(tmp_path, config.UNDO_QUEUE_LENGTH + 10)
+	statefile.delete_slots(list(statefile.slots))
+	assert len(statefile.undos) == config.UNDO_QUEUE_LENGTH
+	assert statefile.undos[0]['uid'] == str(config.UNDO_QUEUE_LENGTH + 9)
+
+
+def test_changes_since(tmp_path):
+	"""Clients get the changes they missed, or None if a snapshot is needed."""
+	statefile = make_statefile(tmp_path, 3)
+	epoch = statefile.epoch
+	assert [json.loads(f)['seq'] for f in statefile.changes_since(epoch, 1)] == [2, 3]
+	assert statefile.changes_since(epoch, 3) == []
+	assert statefile.changes_since(epoch, 4) is None
+	assert statefile.changes_since('other', 1) is None
+
+	statefile.update_slot(statefile.slots['0'], text='edited')
+	assert statefile.changes_since(epoch, 3) is None
+
+
+def test_save_and_load(tmp_path):
+	"""State survives a save and reload."""
+	statefile = make_statefile(tmp_path, 3)
+	statefile.delete_slot('1')
+	statefile.save()
+
+	reloaded = Statefile(statefile.filename)
+	assert list(reloaded.slots) == ['0', '2']
+	assert [u['uid'] for u in reloaded.undos] == ['1']
+
+
+def test_journal_replay(tmp_path):
+	"""Changes recorded in journal mode survive a crash without a save."""
+	statefile = make_statefile(tmp_path)
+	statefile.start_journal()
+	for i in range(4):
+		statefile.add_slot(make_slot(str(i)))
+
+	statefile.delete_slots(['1', '2'])
+	statefile.undo_delete()
+	statefile.update_slot(statefile.slots['0'], text='edited')
+	statefile.storage.journal.close()
+
+	reloaded = Statefile(statefile.filename)
+	assert list(reloaded.slots) == ['2', '0', '3']
+	assert [u['uid'] for u in reloaded.undos] == ['1']
+	assert reloaded.slots['0']['text'] == 'edited'
+
+
+def test_journal_compaction(tmp_path, monkeypatch):
+	"""Large journals are folded into the statefile and removed."""
+	monkeypatch.setattr(config, 'JOURNAL_COMPACT_RECORDS', 10)
+	statefile = make_statefile(tmp_path)
+	statefile.start_journal()
+	for i in range(25):
+		statefile.add_slot(make_slot(str(i)))
+
+	statefile.storage.journal.close()
+	assert [g for g, _ in statefile.storage.journals()] == [2]
+	assert len(Statefile(statefile.filename).slots) == 25
+
+
+def test_journal_background(tmp_path, monkeypatch):
+	"""With background saves the journal is compacted by the next snapshot, and waiting
+	records are synced when asked without another change."""
+	monkeypatch.setattr(config, 'JOURNAL_COMPACT_RECORDS', 10)
+	monkeypatch.setattr(config, 'JOURNAL_FSYNC_RECORDS', 100)
+	monkeypatch.setattr(config, 'JOURNAL_FSYNC_INTERVAL', 1000)
+	statefile = make_statefile(tmp_path)
+	statefile.background_saves = True
+	statefile.start_journal()
+	for i in range(25):
+		statefile.add_slot(make_slot(str(i)))
+
+	assert statefile.compact
+	assert [g for g, _ in statefile.storage.journals()] == [0]
+	statefile.write_snapshot(statefile.begin_snapshot())
+	assert not statefile.compact
+	assert [g for g, _ in statefile.storage.journals()] == [1]
+
+	statefile.add_slot(make_slot('25'))
+	statefile.sync_journal()
+	assert statefile.storage.journal.unsynced == 1
+	monkeypatch.setattr(config, 'JOURNAL_FSYNC_INTERVAL', 0)
+	statefile.sync_journal()
+	assert statefile.storage.journal.unsynced == 0
+	statefile.stop_journal()
+
+
+def test_journal_damaged(tmp_path):
+	"""A partly written final record is dropped and later records still replay."""
+	statefile = make_statefile(tmp_path)
+	statefile.start_journal()
+	statefile.add_slot(make_slot('0'))
+	statefile.storage.journal.handle.write('{"op":"add","sl')
+	statefile.storage.journal.close()
+
+	reloaded = Statefile(statefile.filename)
+	assert list(reloaded.slots) == ['0']
+	reloaded.start_journal()
+	reloaded.add_slot(make_slot('1'))
+	reloaded.storage.journal.close()
+	assert list(Statefile(statefile.filename).slots) == ['0', '1']
+
+
+def test_sqlite(tmp_path):
+	"""Changes are written through to an SQLite database."""
+	statefile = Statefile(tmp_path / 'state.sqlite', backend='sqlite')
+	for i in range(4):
+		statefile.add_slot(make_slot(str(i)))
+
+	statefile.delete_slots(['1', '2'])
+	statefile.undo_delete()
+	statefile.update_slot(statefile.slots['0'], text='edited')
+
+	reloaded = Statefile(statefile.filename, backend='sqlite')
+	assert list(reloaded.slots) == ['2', '0', '3']
+	assert [u['uid'] for u in reloaded.undos] == ['1']
+	assert reloaded.slots['0']['text'] == 'edited'
+
+	reloaded.empty_undo()
+	assert len(Statefile(statefile.filename, backend='sqlite').undos) == 0
+
+
+def test_sqlite_undo_queue_length(tmp_path):
+	"""The database keeps no more undos than the in memory queue."""
+	statefile = Statefile(tmp_path / 'state.sqlite', backend='sqlite')
+	for i in range(config.UNDO_QUEUE_LENGTH + 10):
+		statefile.add_slot(make_slot(str(i)))
+		statefile.delete_slot(str(i))
+
+	count, = statefile.storage.conn.execute('SELECT COUNT(*) FROM undos').fetchone()
+	assert count == config.UNDO_QUEUE_LENGTH
+	reloaded = Statefile(statefile.filename, backend='sqlite')
+	assert list(reloaded.undos) == list(statefile.undos)
+
+
+def test_migrate(tmp_path):
+	"""A JSON statefile can be imported into SQLite."""
+	source = make_statefile(tmp_path, 3)
+	source.delete_slot('1')
+	source.save()
+
+	statefile = Statefile(tmp_path / 'state.sqlite', backend='sqlite')
+	statefile.import_state(Statefile(source.filename, backend='json'))
+	reloaded = Statefile(statefile.filename, backend='sqlite')
+	assert list(reloaded.slots) == ['0', '2']
+	assert [u['uid'] for u in reloaded.undos] == ['1']
+
+	# as with --migrate-from and --serve, loading again replaces what was imported
+	statefile.load()
+	assert list(statefile.slots) == ['0', '2']
+	assert [u['uid'] for u in statefile.undos] == ['1']
+
+
+def test_export_import(tmp_path):
+	"""Exported slots import in the same order, skipping uids already present, and the
+	import is journalled and written to SQLite."""
+	source = make_statefile(tmp_path, 4)
+	source.delete_slot('3')
+	lines = list(source.export_lines())
+	assert len(lines) == 3
+
+	statefile = Statefile(tmp_path / 'other')
+	statefile.start_journal()
+	statefile.add_slot(make_slot('1'))
+	statefile.add_slot(make_slot('3'))
+	statefile.delete_slot('3')
+	frames = statefile.import_slots(slot.decode_lines(lines))
+	assert [json.loads(f)['uid'] for f in frames] == ['0', '2']
+	assert list(statefile.slots) == ['1', '0', '2']
+	statefile.storage.journal.close()
+	assert list(Statefile(statefile.filename).slots) == ['1', '0', '2']
+
+	sqlite = Statefile(tmp_path / 'state.sqlite', backend='sqlite')
+	sqlite.import_slots(slot.decode_lines(lines))
+	sqlite.import_slots(slot.decode_lines(lines))
+	assert list(Statefile(sqlite.filename, backend='sqlite').slots) == ['0', '1', '2']
+
+	with pytest.raises(ValueError, match='Line 2'):
+		slot.decode_lines(['', '{"uid": "4"}'])
+
+
+def test_page(tmp_path, monkeypatch):
+	"""Slots are paged newest first by timestamp, following cursors."""
+	monkeypatch.setattr(config, 'PAGE_SIZE', 2)
+	statefile = make_statefile(tmp_path)
+	for i in range(5):
+		slot = make_slot(str(i))
+		slot['timestamp'] = '2017-06-01T10:09:0{i}'.format(i=i)
+		statefile.add_slot(slot)
+
+	slots, more = statefile.page()
+	assert [s['uid'] for s in slots] == ['4', '3']
+	slots, more = statefile.page(before=more)
+	assert [s['uid'] for s in slots] == ['2', '1']
+	statefile.delete_slot('0')
+	slots, more = statefile.page(before=more)
+	assert [s['uid'] for s in slots] == [] and more is None
+
+	statefile.undo_delete()
+	statefile.delete_slots(['4'])
+	slots, more = statefile.page(limit=10)
+	assert [s['uid'] for s in slots] == ['3', '2', '1', '0']
+	assert more is None
+
+
+def test_mixed_uids(tmp_path):
+	"""Slots with packed and unpacked uids at the same time are paged, imported and
+	journalled, and bad cursors raise ValueError."""
+	statefile = make_statefile(tmp_path)
+	statefile.start_journal()
+	statefile.add_slot(make_slot('0123456789abcdef0123456789abcdef'))
+	statefile.import_slots(slot.decode_lines([json.dumps(make_slot('legacy-1'))]))
+	statefile.add_slot(make_slot('fedcba9876543210fedcba9876543210'))
+	slots, more = statefile.page(limit=2)
+	assert [s.uid for s in slots] == ['legacy-1', 'fedcba9876543210fedcba9876543210']
+	slots, more = statefile.page(before=more)
+	assert [s.uid for s in slots] == ['0123456789abcdef0123456789abcdef']
+	slots, more = statefile.page(before='2017-06-01T10:09:08_zz')
+	assert len(slots) == 3
+
+	statefile.storage.journal.close()
+	assert [s.uid for s in Statefile(statefile.filename).page()[0]] == \
+		['legacy-1', 'fedcba9876543210fedcba9876543210', '0123456789abcdef0123456789abcdef']
+
+	for cursor in ('2017-06-01T10:09:08_a b', 'zz', '_1', 5):
+		with pytest.raises(ValueError):
+			statefile.page(before=cursor)
+
+	with pytest.raises(ValueError, match='Bad uid'):
+		slot.decode_lines([json.dumps(make_slot('a b'))])
+
+
+def test_retention(tmp_path, monkeypatch):
+	"""The oldest slots expire past the count, size or age limits, without an undo."""
+	statefile = make_statefile(tmp_path, 5)
+	monkeypatch.setattr(config, 'RETAIN_SLOTS', 3)
+	message = json.loads(statefile.expire())
+	assert message['type'] == 'delete_many'
+	assert message['expired']
+	assert message['uids'] == ['0', '1']
+	assert list(statefile.slots) == ['2', '3', '4']
+	assert len(statefile.undos) == 0
+	assert statefile.expire() is None
+
+	# each message is 9 bytes
+	monkeypatch.setattr(config, 'RETAIN_BYTES', 20)
+	assert json.loads(statefile.expire())['uids'] == ['2']
+	assert statefile.bytes == 18
+
+	monkeypatch.setattr(config, 'RETAIN_AGE', 60)
+	recent = make_slot('5')
+	recent['timestamp'] = datetime.datetime.utcnow().isoformat()
+	statefile.add_slot(recent)
+	assert json.loads(statefile.expire())['uids'] == ['3', '4']
+	assert list(statefile.slots) == ['5']
+	assert 59 < statefile.next_expiry() <= 60
+
+
+def test_retention_journal(tmp_path, monkeypatch):
+	"""Expiry is replayed from the journal and written to SQLite."""
+	monkeypatch.setattr(config, 'RETAIN_SLOTS', 2)
+	statefile = make_statefile(tmp_path)
+	statefile.start_journal()
+	sqlite = Statefile(tmp_path / 'state.sqlite', backend='sqlite')
+	for i in range(4):
+		statefile.add_slot(make_slot(str(i)))
+		sqlite.add_slot(make_slot(str(i)))
+
+	statefile.expire()
+	sqlite.expire()
+	statefile.storage.journal.close()
+	assert list(Statefile(statefile.filename).slots) == ['2', '3']
+	assert list(Statefile(sqlite.filename, backend='sqlite').slots) == ['2', '3']